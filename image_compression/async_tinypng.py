@@ -0,0 +1,324 @@
+import os
+import ssl
+import json
+import time
+import base64
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+import tinify
+
+from metrics import RunMetrics
+
+# 上传和下载时每次读写的字节数
+CHUNK_SIZE = 256 * 1024
+
+USER_AGENT = tinify.Client.USER_AGENT + ' asyncio'
+
+
+class HTTPConnection:
+    """一个 keep-alive 的 HTTP/1.1 连接，只实现 TinyPNG API 用到的部分
+
+    请求体可以是 bytes 或文件路径（分块读取发送），2xx 响应体可以分块写入文件，
+    都不需要把整个图片放在内存中。
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reusable = True
+        # 是否已经完成过请求（复用的连接可能已被服务器关闭）
+        self.used = False
+
+    @classmethod
+    async def open(cls, host, port, ssl_context, timeout):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_context,
+                                    server_hostname=host if ssl_context else None),
+            timeout)
+        return cls(reader, writer)
+
+    async def request(self, method, target, headers, body=None, body_path=None, sink=None, timeout=60):
+        """发送请求并读取响应
+
+        参数:
+            body: 请求体（bytes）
+            body_path: 从文件读取请求体，与 body 二选一
+            sink: 2xx 响应体写入的文件对象，为 None 时读入内存
+
+        返回:
+            int: 状态码
+            dict: 响应头（名称为小写）
+            bytes: 响应体，写入 sink 时为写入的字节数
+        """
+        size = os.path.getsize(body_path) if body_path else len(body or b'')
+        lines = [f"{method} {target} HTTP/1.1"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        lines.append(f"Content-Length: {size}")
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if body_path:
+            with open(body_path, 'rb') as f:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.writer.write(chunk)
+                    # 发送缓冲区满时等待，内存中最多只有几个分块
+                    await self.writer.drain()
+        elif body:
+            self.writer.write(body)
+        await asyncio.wait_for(self.writer.drain(), timeout)
+
+        status, response_headers = await asyncio.wait_for(self.read_head(), timeout)
+        if response_headers.get('connection', '').lower() == 'close':
+            self.reusable = False
+        target_file = sink if sink is not None and 200 <= status < 300 else None
+        content = await asyncio.wait_for(self.read_body(response_headers, target_file), timeout)
+        self.used = True
+        return status, response_headers, content
+
+    async def read_head(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("连接已被服务器关闭")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return status, headers
+
+    async def read_body(self, headers, sink):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            parts = []
+            written = 0
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # 跳过 trailer
+                    while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                written += await self.copy(size, sink, parts)
+                await self.reader.readexactly(2)
+            return written if sink is not None else b''.join(parts)
+
+        if 'content-length' in headers:
+            parts = []
+            written = await self.copy(int(headers['content-length']), sink, parts)
+            return written if sink is not None else b''.join(parts)
+
+        # 没有长度信息，读到连接关闭为止
+        self.reusable = False
+        data = await self.reader.read()
+        if sink is not None:
+            sink.write(data)
+            return len(data)
+        return data
+
+    async def copy(self, size, sink, parts):
+        """读取 size 字节，写入 sink 或追加到 parts"""
+        remaining = size
+        while remaining:
+            chunk = await self.reader.readexactly(min(CHUNK_SIZE, remaining))
+            remaining -= len(chunk)
+            if sink is not None:
+                sink.write(chunk)
+            else:
+                parts.append(chunk)
+        return size
+
+    def close(self):
+        self.reusable = False
+        self.writer.close()
+
+
+class ConnectionPool:
+    """同一个 key、同一个服务器的 keep-alive 连接池，最多 limit 个连接同时使用"""
+
+    def __init__(self, host, port, ssl_context, limit, timeout):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.idle = []
+        self.semaphore = asyncio.Semaphore(limit)
+
+    async def request(self, method, target, headers, body=None, body_path=None, sink=None):
+        async with self.semaphore:
+            while True:
+                if self.idle:
+                    connection = self.idle.pop()
+                else:
+                    connection = await HTTPConnection.open(self.host, self.port, self.ssl_context,
+                                                           self.timeout)
+                try:
+                    result = await connection.request(method, target, headers, body, body_path, sink,
+                                                      self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    connection.close()
+                    if connection.used:
+                        # 空闲期间被服务器关闭的连接，换一个连接重新发送
+                        continue
+                    raise
+                except BaseException:
+                    connection.close()
+                    raise
+                if connection.reusable:
+                    self.idle.append(connection)
+                else:
+                    connection.close()
+                return result
+
+    def close(self):
+        for connection in self.idle:
+            connection.close()
+        self.idle = []
+
+
+class AsyncTinifyEngine:
+    """直接调用 TinyPNG 的 /shrink 和 output 接口，所有请求在一个后台事件循环中执行
+
+    - 每个 key 有独立的 keep-alive 连接池（最多 max_connections_per_key 个连接），
+      请求只使用自己的 key，不依赖全局的 tinify.key
+    - 上传直接从源文件分块读取，下载分块写入输出文件，内存占用与图片大小无关
+    - 可以在下载时让服务器缩放（resize），代替本地缩放
+
+    压缩线程调用 compress_file() 后等待结果；等待中的线程不占用 CPU，
+    可以同时有上百个请求在进行。错误转换为与 tinify 相同的异常类型，
+    重试和熔断逻辑不需要区分两种实现。
+    """
+
+    def __init__(self, endpoint=None, max_connections_per_key=8, timeout=60, metrics=None):
+        self.endpoint = (endpoint or tinify.Client.API_ENDPOINT).rstrip('/')
+        self.max_connections_per_key = max(1, max_connections_per_key)
+        self.timeout = timeout
+        self.metrics = metrics or RunMetrics()
+        # 与 tinify 使用相同的证书
+        self.ssl_context = ssl.create_default_context(
+            cafile=os.path.join(os.path.dirname(tinify.__file__), 'data', 'cacert.pem'))
+        # (scheme, host, port, key) -> ConnectionPool，只在事件循环线程中访问
+        self.pools = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine):
+        """在事件循环中执行协程，阻塞当前线程直到完成"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def get_pool(self, url, key):
+        parts = urlsplit(url)
+        secure = parts.scheme == 'https'
+        port = parts.port or (443 if secure else 80)
+        pool_key = (parts.scheme, parts.hostname, port, key)
+        pool = self.pools.get(pool_key)
+        if pool is None:
+            pool = self.pools[pool_key] = ConnectionPool(
+                parts.hostname, port, self.ssl_context if secure else None,
+                self.max_connections_per_key, self.timeout)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        return pool, target, parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+
+    async def call(self, method, url, key, body=None, body_path=None, sink=None, content_type=None):
+        """发送一个 API 请求，失败时抛出与 tinify 相同的异常"""
+        if not url.lower().startswith(('https://', 'http://')):
+            url = self.endpoint + url
+        pool, target, host = self.get_pool(url, key)
+        headers = {
+            'Host': host,
+            'Authorization': 'Basic ' + base64.b64encode(f"api:{key}".encode('utf-8')).decode('ascii'),
+            'User-Agent': USER_AGENT,
+        }
+        if content_type:
+            headers['Content-Type'] = content_type
+        try:
+            status, response_headers, content = await pool.request(method, target, headers, body,
+                                                                   body_path, sink)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+            raise tinify.ConnectionError(f"Error while connecting: {e or type(e).__name__}", cause=e)
+
+        if 200 <= status < 300:
+            return response_headers, content
+        try:
+            details = json.loads(content)
+        except ValueError as e:
+            details = {'message': f"Error while parsing response: {e}", 'error': 'ParseError'}
+        raise tinify.Error.create(details.get('message'), details.get('error'), status)
+
+    async def compress_file_async(self, source_path, output_path, key, resize_width=None):
+        start = time.perf_counter()
+        headers, _ = await self.call('POST', '/shrink', key, body_path=source_path)
+        self.metrics.observe('upload', time.perf_counter() - start)
+        self.metrics.add_bytes('uploaded', os.path.getsize(source_path))
+        count = headers.get('compression-count')
+
+        # 先写入临时文件，下载中断时不会留下不完整的输出
+        temp_path = output_path + '.part'
+        start = time.perf_counter()
+        try:
+            with open(temp_path, 'wb') as sink:
+                if resize_width:
+                    # 服务器端缩放，TinyPNG 会把缩放计为一次额外的压缩
+                    body = json.dumps({'resize': {'method': 'scale', 'width': resize_width}},
+                                      separators=(',', ':')).encode('utf-8')
+                    output_headers, size = await self.call('POST', headers['location'], key, body=body,
+                                                           sink=sink, content_type='application/json')
+                else:
+                    output_headers, size = await self.call('GET', headers['location'], key, sink=sink)
+            os.replace(temp_path, output_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.metrics.observe('download', time.perf_counter() - start)
+        self.metrics.add_bytes('downloaded', size)
+        count = output_headers.get('compression-count') or count
+        return size, int(count) if count else None
+
+    async def compress_bytes_async(self, data, key):
+        start = time.perf_counter()
+        headers, _ = await self.call('POST', '/shrink', key, body=data)
+        self.metrics.observe('upload', time.perf_counter() - start)
+        self.metrics.add_bytes('uploaded', len(data))
+        count = headers.get('compression-count')
+        start = time.perf_counter()
+        _, content = await self.call('GET', headers['location'], key)
+        self.metrics.observe('download', time.perf_counter() - start)
+        self.metrics.add_bytes('downloaded', len(content))
+        return content, int(count) if count else None
+
+    def compress_file(self, source_path, output_path, key, resize_width=None):
+        """上传源文件，把结果写入 output_path
+
+        参数:
+            resize_width: 不为 None 时由服务器缩放到该宽度
+
+        返回:
+            int: 输出文件大小
+            int: API 返回的该 key 本月已压缩次数（未返回时为 None）
+        """
+        return self.run(self.compress_file_async(source_path, output_path, key, resize_width))
+
+    def compress_bytes(self, data, key):
+        """压缩内存中的图片数据（本地缩放后的图片），返回值与 TinyPNGBackend.compress 相同"""
+        return self.run(self.compress_bytes_async(data, key))
+
+    def close(self):
+        # ImageCompressor.close 可能被调用多次，重复调用时直接返回
+        if self.loop.is_closed():
+            return
+
+        async def close_pools():
+            for pool in self.pools.values():
+                pool.close()
+        self.run(close_pools())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
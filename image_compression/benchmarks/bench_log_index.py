@@ -0,0 +1,130 @@
+"""压缩日志索引基准测试：比较 json.load 读取为字典、完整解析为紧凑表示（packed）
+与按需解析（compact_index 使用的 lazy）的读取耗时和内存
+
+用法:
+    python benchmarks/bench_log_index.py
+    python benchmarks/bench_log_index.py --entries 100000 1000000
+
+生成包含 N 条压缩记录的 compression_log.json（路径、key、时间的格式与实际日志相同），
+每种方式在独立的子进程中读取，输出读取耗时、读取后占用的内存、查找耗时和写回耗时。
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+import multiprocessing
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from bench_resize import peak_rss_mb
+from compact_index import load_compact_log, load_packed_log, dump_log
+
+
+def generate_log(path, count, dirs=200):
+    """生成 count 条压缩记录的日志"""
+    keys = [f"{random.getrandbits(128):032x}"[:20] + "..." for _ in range(3)]
+    compressed_files = {}
+    for i in range(count):
+        rel_path = f"album{i % dirs:04d}/photo_{i:08d}.jpg"
+        original_size = random.randint(50_000, 5_000_000)
+        compressed_size = int(original_size * random.uniform(0.2, 0.9))
+        compressed_files[f"{random.getrandbits(128):032x}"] = {
+            'source_path': f"./images/{rel_path}",
+            'output_path': f"/data/compressed_images/{rel_path}",
+            'original_size': original_size,
+            'compressed_size': compressed_size,
+            'compression_ratio': f"{(1 - compressed_size / original_size) * 100:.2f}%",
+            'compressed_at': f"2025-{i % 12 + 1:02d}-{i % 28 + 1:02d}T12:{i % 60:02d}:00.{i % 1000000:06d}",
+            'api_key_index': i % 3,
+            'api_key_used': keys[i % 3],
+            'backend': 'tinypng'
+        }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'compressed_files': compressed_files, 'key_usage': {}, 'journal_seq': 0},
+                  f, indent=4, ensure_ascii=False)
+    return list(compressed_files)
+
+
+def run_case(path, mode, lookups, queue):
+    """子进程中执行：读取日志、查找、写回"""
+    def load():
+        if mode == 'lazy':
+            return load_compact_log(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        return load_packed_log(data) if mode == 'packed' else json.loads(data)
+
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    log_data = load()
+    load_time = time.perf_counter() - start
+
+    files = log_data['compressed_files']
+    start = time.perf_counter()
+    found = sum(1 for file_hash in lookups if file_hash in files)
+    lookup_time = (time.perf_counter() - start) / len(lookups)
+
+    start = time.perf_counter()
+    buffer = io.StringIO()
+    if mode != 'dict':
+        dump_log(log_data, buffer)
+    else:
+        json.dump(log_data, buffer, indent=4, ensure_ascii=False)
+    dump_time = time.perf_counter() - start
+
+    peak = peak_rss_mb()
+
+    # tracemalloc 会明显拖慢分配，单独再读取一次统计读取后占用的内存
+    del log_data, files
+    tracemalloc.start()
+    log_data = load()
+    memory = tracemalloc.get_traced_memory()[0] / 1024 / 1024
+    tracemalloc.stop()
+
+    queue.put((load_time, memory, lookup_time, dump_time, found,
+               None if peak is None else peak - baseline))
+
+
+def measure(path, mode, lookups):
+    # 与 bench_resize 相同，使用干净的子进程，峰值内存不受父进程生成日志的影响
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+    else:
+        context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_case, args=(path, mode, lookups, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="压缩日志索引基准测试")
+    parser.add_argument('--entries', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--lookups', type=int, default=10000, help="查找次数（一半命中）")
+    args = parser.parse_args()
+
+    print(f"{'记录数':<10}{'方式':<8}{'读取(s)':>9}{'内存(MB)':>10}{'峰值(MB)':>10}"
+          f"{'查找(us)':>10}{'写回(s)':>9}")
+    print("-" * 66)
+    with tempfile.TemporaryDirectory() as workdir:
+        for count in args.entries:
+            path = os.path.join(workdir, 'compression_log.json')
+            hashes = generate_log(path, count)
+            lookups = (random.sample(hashes, min(len(hashes), args.lookups // 2))
+                       + [f"{random.getrandbits(128):032x}" for _ in range(args.lookups // 2)])
+            for name in ('dict', 'packed', 'lazy'):
+                load_time, memory, lookup_time, dump_time, _, peak = measure(path, name, lookups)
+                peak_text = f"{peak:.1f}" if peak is not None else "N/A"
+                print(f"{count:<10}{name:<8}{load_time:>9.2f}{memory:>10.1f}{peak_text:>10}"
+                      f"{lookup_time * 1e6:>10.2f}{dump_time:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""离线端到端基准测试：对本地模拟的 TinyPNG API 运行 ImageCompressor.run()
+
+用法:
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --counts 200 --workers 1 8 16 --latency 0.3 --error-rate 0.02
+
+先生成测试图片（各尺寸、格式混合，内容互不相同），再对每个 (图片数, 并发数)
+组合在独立的子进程和空的工作目录中完整运行一次压缩，输出:
+    图片/秒、每张图片处理耗时的 p50/p99、子进程峰值内存、写日志（journal + 保存日志）耗时
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+from queue import Empty
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from bench_resize import make_image, peak_rss_mb
+from mock_tinypng import MockTinyPNGServer
+
+
+def generate_corpus(folder, count, sizes, formats):
+    """在 folder 中生成 count 张图片，尺寸和格式轮流使用"""
+    extensions = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp'}
+    os.makedirs(folder, exist_ok=True)
+    total_bytes = 0
+    for i in range(count):
+        width, height = (int(v) for v in sizes[i % len(sizes)].lower().split('x'))
+        fmt = formats[i % len(formats)]
+        data = make_image(width, height, fmt)
+        # 每 50 张放一个子目录，接近真实的目录结构
+        subdir = os.path.join(folder, f"dir{i // 50}")
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, f"img{i}{extensions[fmt]}"), 'wb') as f:
+            f.write(data)
+        total_bytes += len(data)
+    return total_bytes
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run_case(workdir, config, queue):
+    """子进程中执行：在 workdir 中完整运行一次压缩"""
+    from image_compressor import ImageCompressor
+
+    class TimedCompressor(ImageCompressor):
+        """记录每张图片的处理耗时和写日志耗时"""
+
+        def __init__(self):
+            self.latencies = []
+            self.log_write_time = 0.0
+            super().__init__()
+
+        def process_image(self, i, image_path):
+            start = time.perf_counter()
+            try:
+                return super().process_image(i, image_path)
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+
+        def append_journal(self, record):
+            start = time.perf_counter()
+            super().append_journal(record)
+            self.log_write_time += time.perf_counter() - start
+
+        def save_log(self):
+            start = time.perf_counter()
+            super().save_log()
+            self.log_write_time += time.perf_counter() - start
+
+    os.chdir(workdir)
+    with open('config.json', 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+
+    baseline = peak_rss_mb()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        compressor = TimedCompressor()
+        start = time.perf_counter()
+        compressor.run()
+        elapsed = time.perf_counter() - start
+    peak = peak_rss_mb()
+
+    queue.put({
+        'elapsed': elapsed,
+        'latencies': compressor.latencies,
+        'log_write_time': compressor.log_write_time,
+        'counts': compressor.counts,
+        'peak_rss': None if peak is None else peak - baseline,
+    })
+
+
+def measure(workdir, config):
+    # 与 bench_resize 相同：forkserver 子进程不继承父进程生成图片时的内存
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+    else:
+        context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_case, args=(workdir, config, queue))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            if not process.is_alive():
+                raise RuntimeError(f"基准测试子进程异常退出（退出码 {process.exitcode}）")
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线端到端基准测试（模拟 TinyPNG API）")
+    parser.add_argument('--counts', type=int, nargs='+', default=[100], help="图片数量")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8], help="并发数")
+    parser.add_argument('--sizes', nargs='+', default=['640x480', '1600x1200', '2400x1600'],
+                        help="测试图片尺寸，格式为 宽x高")
+    parser.add_argument('--formats', nargs='+', default=['JPEG', 'PNG'])
+    parser.add_argument('--latency', type=float, default=0.1, help="模拟 API 的平均延迟（秒）")
+    parser.add_argument('--jitter', type=float, default=0.02, help="延迟波动（秒）")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="上传返回 503 的概率")
+    parser.add_argument('--keys', type=int, default=3, help="模拟的 API key 数量")
+    parser.add_argument('--config', default=None,
+                        help="在此配置文件的基础上运行（api_keys、目录和并发数会被覆盖）")
+    args = parser.parse_args()
+
+    base_config = {}
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            base_config = json.load(f)
+
+    server = MockTinyPNGServer(latency=args.latency, jitter=args.jitter,
+                               error_rate=args.error_rate).start()
+    tmp = tempfile.mkdtemp(prefix='bench_pipeline_')
+    try:
+        print(f"模拟 API: {server.endpoint}，延迟 {args.latency}s ± {args.jitter}s，"
+              f"错误率 {args.error_rate:.1%}")
+        print(f"{'图片数':<8}{'并发':<6}{'耗时(s)':>9}{'图片/秒':>9}{'p50(ms)':>9}{'p99(ms)':>9}"
+              f"{'峰值内存(MB)':>14}{'写日志(ms)':>12}{'失败':>6}")
+        print("-" * 82)
+        for count in args.counts:
+            corpus = os.path.join(tmp, f"corpus_{count}")
+            generate_corpus(corpus, count, args.sizes, args.formats)
+            for workers in args.workers:
+                workdir = os.path.join(tmp, f"run_{count}_{workers}")
+                os.makedirs(workdir)
+                config = dict(base_config)
+                config.update({
+                    'api_keys': [f"bench-key-{i + 1}" for i in range(args.keys)],
+                    'max_compressions_per_key': count * 2,
+                    'source_folder': corpus,
+                    'output_folder': os.path.join(workdir, 'output'),
+                    'concurrency': workers,
+                    'backend': 'tinypng',
+                    'tinypng_options': {'api_endpoint': server.endpoint},
+                })
+                result = measure(workdir, config)
+                shutil.rmtree(workdir, ignore_errors=True)
+
+                latencies = result['latencies']
+                peak = result['peak_rss']
+                peak_text = f"{peak:.1f}" if peak is not None else "N/A"
+                print(f"{count:<8}{workers:<6}{result['elapsed']:>9.2f}"
+                      f"{len(latencies) / result['elapsed']:>9.1f}"
+                      f"{percentile(latencies, 50) * 1000:>9.0f}"
+                      f"{percentile(latencies, 99) * 1000:>9.0f}"
+                      f"{peak_text:>14}{result['log_write_time'] * 1000:>12.1f}"
+                      f"{result['counts']['failed']:>6}")
+    finally:
+        server.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
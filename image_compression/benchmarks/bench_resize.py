@@ -0,0 +1,112 @@
+"""本地缩放基准测试：比较各 resize_mode 的解码+缩放耗时和峰值内存
+
+用法:
+    python benchmarks/bench_resize.py
+    python benchmarks/bench_resize.py --sizes 4000x3000 8000x6000 --max-width 320
+
+每个用例在独立的子进程中运行，峰值内存取子进程的 ru_maxrss 增量
+（Windows 没有 resource 模块，只显示耗时）。
+"""
+import os
+import io
+import sys
+import time
+import argparse
+import multiprocessing
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from resize_pool import downscale_image, RESIZE_REDUCING_GAP
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss_mb():
+    """当前进程的峰值内存（MB）"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    if sys.platform == 'darwin':
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+def make_image(width, height, fmt):
+    """生成带噪点和渐变的测试图片，避免纯色图片解码过快"""
+    noise = Image.effect_noise((width, height), 64).convert('L')
+    gradient = Image.linear_gradient('L').resize((width, height))
+    img = Image.merge('RGB', (noise, gradient, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+    buffer = io.BytesIO()
+    if fmt == 'JPEG':
+        img.save(buffer, 'JPEG', quality=90)
+    else:
+        img.save(buffer, fmt)
+    return buffer.getvalue()
+
+
+def run_case(data, max_width, resize_mode, repeat, queue):
+    """子进程中执行：解码 + 缩放 repeat 次，返回最短耗时和峰值内存增量"""
+    baseline = peak_rss_mb()
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        img = Image.open(io.BytesIO(data))
+        width, height = img.size
+        size = (max_width, int(height * max_width / width))
+        resized = downscale_image(img, size, resize_mode)
+        resized.load()
+        elapsed = time.perf_counter() - start
+        img.close()
+        resized.close()
+        best = elapsed if best is None else min(best, elapsed)
+    peak = peak_rss_mb()
+    queue.put((best, None if peak is None else peak - baseline))
+
+
+def measure(data, max_width, resize_mode, repeat):
+    # 直接 fork 的子进程会继承父进程生成测试图片时的峰值内存，
+    # forkserver 从一个干净的小进程 fork，Windows 上只能用 spawn
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+    else:
+        context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_case, args=(data, max_width, resize_mode, repeat, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="resize_mode 基准测试")
+    parser.add_argument('--sizes', nargs='+', default=['4000x3000', '8000x6000'],
+                        help="测试图片尺寸，格式为 宽x高")
+    parser.add_argument('--formats', nargs='+', default=['JPEG', 'PNG'])
+    parser.add_argument('--max-width', type=int, default=320)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'尺寸':<12}{'格式':<6}{'模式':<10}{'耗时(ms)':>10}{'峰值内存(MB)':>14}{'加速比':>8}")
+    print("-" * 62)
+    for size in args.sizes:
+        width, height = (int(v) for v in size.lower().split('x'))
+        for fmt in args.formats:
+            data = make_image(width, height, fmt)
+            baseline_time = None
+            for resize_mode in RESIZE_REDUCING_GAP:
+                elapsed, peak = measure(data, args.max_width, resize_mode, args.repeat)
+                if baseline_time is None:
+                    baseline_time = elapsed
+                peak_text = f"{peak:.1f}" if peak is not None else "N/A"
+                print(f"{size:<12}{fmt:<6}{resize_mode:<10}{elapsed * 1000:>10.1f}"
+                      f"{peak_text:>14}{baseline_time / elapsed:>8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""缩放进程池基准测试：比较线程内缩放与不同进程数的 ResizePool 的吞吐量
+
+用法:
+    python benchmarks/bench_resize_pool.py
+    python benchmarks/bench_resize_pool.py --count 64 --size 6000x4000 --processes 1 8 16 32 --latency 0.2
+
+模拟压缩线程的工作方式：threads 个线程各自取图片，缩放后 sleep(latency) 模拟
+上传和下载。threads 默认等于进程数（与 concurrency 一致时进程池才能被占满）。
+"线程" 一行在压缩线程中直接缩放（原有方式），受 GIL 限制，线程再多也只能用一个核。
+"""
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from bench_resize import make_image
+from resize_pool import ResizePool, resize_image_data
+
+
+def run_batch(images, threads, latency, resize):
+    """threads 个线程处理所有图片，返回总耗时（秒）"""
+    work_queue = queue.Queue()
+    for data in images:
+        work_queue.put(data)
+
+    def worker():
+        while True:
+            try:
+                data = work_queue.get_nowait()
+            except queue.Empty:
+                return
+            resize(data)
+            if latency:
+                time.sleep(latency)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    default_processes = sorted({1, 2, 4, 8, 16, 32, cpu_count} & set(range(1, cpu_count + 1)))
+
+    parser = argparse.ArgumentParser(description="缩放进程池基准测试")
+    parser.add_argument('--count', type=int, default=32, help="图片数")
+    parser.add_argument('--size', default='4000x3000', help="测试图片尺寸，格式为 宽x高")
+    parser.add_argument('--format', default='JPEG')
+    parser.add_argument('--max-width', type=int, default=1920)
+    parser.add_argument('--resize-mode', default='quality')
+    parser.add_argument('--processes', type=int, nargs='+', default=default_processes,
+                        help=f"测试的进程数（默认按本机 {cpu_count} 核选择）")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="压缩线程数（默认等于进程数）")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="每张图片缩放后模拟的网络耗时（秒）")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    ext = '.jpg' if args.format == 'JPEG' else '.' + args.format.lower()
+    print(f"生成 {args.count} 张 {args.size} {args.format} 测试图片...")
+    # 内容相同不影响缩放耗时，只生成一张
+    data = make_image(width, height, args.format)
+    images = [data] * args.count
+
+    print(f"{'方式':<10}{'进程':>6}{'线程':>6}{'耗时(s)':>10}{'图片/秒':>10}{'加速比':>8}")
+    print("-" * 50)
+
+    threads = args.threads or max(args.processes)
+    elapsed = run_batch(images, threads, args.latency,
+                        lambda d: resize_image_data(d, ext, args.max_width, args.resize_mode))
+    baseline = elapsed
+    print(f"{'线程':<10}{'-':>6}{threads:>6}{elapsed:>10.2f}{args.count / elapsed:>10.1f}{1:>8.2f}x")
+
+    for processes in args.processes:
+        pool = ResizePool(processes)
+        try:
+            # 预先启动子进程，不把进程启动时间计入结果
+            pool.resize(data, ext, args.max_width, args.resize_mode)
+            threads = args.threads or processes
+            elapsed = run_batch(images, threads, args.latency,
+                                lambda d: pool.resize(d, ext, args.max_width, args.resize_mode))
+        finally:
+            pool.close()
+        print(f"{'进程池':<10}{processes:>6}{threads:>6}{elapsed:>10.2f}"
+              f"{args.count / elapsed:>10.1f}{baseline / elapsed:>8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""多尺寸变体基准测试：比较每个尺寸单独解码（分多次运行）与解码一次生成所有变体的耗时
+
+用法:
+    python benchmarks/bench_variants.py
+    python benchmarks/bench_variants.py --size 6000x4000 --widths 320 640 1280 --webp 1280
+
+"分别解码" 对每个变体调用一次 resize_image_data（相当于用不同的 max_width 运行多次），
+"解码一次" 调用 render_variants。两者的编码耗时相同，差别在于源图片的解码次数。
+"""
+import os
+import sys
+import time
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from bench_resize import make_image
+from resize_pool import RESIZE_REDUCING_GAP, resize_image_data, render_variants
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多尺寸变体基准测试")
+    parser.add_argument('--size', default='4000x3000', help="测试图片尺寸，格式为 宽x高")
+    parser.add_argument('--format', default='JPEG')
+    parser.add_argument('--widths', type=int, nargs='+', default=[320, 640, 1280])
+    parser.add_argument('--webp', type=int, nargs='*', default=[1280], help="额外生成 WebP 的宽度")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    ext = '.jpg' if args.format == 'JPEG' else '.' + args.format.lower()
+    data = make_image(width, height, args.format)
+    variants = [(w, ext) for w in args.widths] + [(w, '.webp') for w in args.webp]
+    print(f"{args.size} {args.format}，{len(variants)} 个变体: "
+          + ", ".join(f"{w}{e}" for w, e in variants))
+
+    print(f"{'resize_mode':<12}{'分别解码(s)':>12}{'解码一次(s)':>12}{'加速比':>8}")
+    print("-" * 44)
+    for resize_mode in RESIZE_REDUCING_GAP:
+        separate = once = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for max_width, output_ext in variants:
+                # resize_image_data 按源格式编码，WebP 变体的编码耗时略有不同，不影响比较解码次数
+                resize_image_data(data, output_ext, max_width, resize_mode)
+            separate = min(separate, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            render_variants(data, ext, variants, resize_mode)
+            once = min(once, time.perf_counter() - start)
+        print(f"{resize_mode:<12}{separate:>12.3f}{once:>12.3f}{separate / once:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
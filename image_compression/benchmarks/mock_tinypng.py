@@ -0,0 +1,212 @@
+"""本地模拟的 TinyPNG API，用于离线基准测试，不消耗真实额度
+
+支持:
+    POST /shrink          上传图片，返回 201 和 Location: /output/<id>
+    GET  /output/<id>     下载结果（原样返回上传的数据）
+    POST /output/<id>     按 {"resize": {"method": "scale", "width": W}} 缩放后下载，
+                          与真实 API 一样额外计一次压缩
+
+每个 key 单独计数，响应头 Compression-Count 与真实 API 一致。
+可配置延迟（latency ± jitter 秒）、服务器错误率（返回 503，tinify 会重试一次）
+和额度错误率（返回 429，压缩器会停用该 key）。
+
+单独运行（在配置中设置 "tinypng_options": {"api_endpoint": "http://127.0.0.1:8765"}）:
+    python benchmarks/mock_tinypng.py --port 8765 --latency 0.3
+"""
+import io
+import json
+import time
+import base64
+import random
+import argparse
+import itertools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+
+class MockTinyPNGHandler(BaseHTTPRequestHandler):
+    # 使用 HTTP/1.1，与真实 API 一样保持 keep-alive 连接
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def get_key(self):
+        auth = self.headers.get('Authorization', '')
+        if not auth.startswith('Basic '):
+            return None
+        user_pass = base64.b64decode(auth[6:]).decode('utf-8', 'replace')
+        return user_pass.split(':', 1)[1] if ':' in user_pass else None
+
+    def send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, error, message):
+        body = json.dumps({'error': error, 'message': message}).encode('utf-8')
+        self.send(status, body, {'Content-Type': 'application/json'})
+
+    def do_POST(self):
+        server = self.server
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server.simulate_latency()
+
+        if self.path.startswith('/output/'):
+            self.resize_output(data)
+            return
+        if self.path != '/shrink':
+            self.send_error_json(404, 'NotFound', 'Not found')
+            return
+        key = self.get_key()
+        if not key:
+            self.send_error_json(401, 'Unauthorized', 'Credentials are invalid')
+            return
+
+        roll = random.random()
+        if roll < server.quota_error_rate:
+            self.send_error_json(429, 'TooManyRequests', 'Your monthly limit has been exceeded')
+            return
+        if roll < server.quota_error_rate + server.error_rate:
+            self.send_error_json(503, 'ServiceUnavailable', 'Simulated server error')
+            return
+
+        output_id, count = server.store(key, data)
+        self.send(201, json.dumps({'output': {'size': len(data)}}).encode('utf-8'), {
+            'Content-Type': 'application/json',
+            'Location': f'/output/{output_id}',
+            'Compression-Count': str(count),
+        })
+
+    def resize_output(self, body):
+        server = self.server
+        key = self.get_key()
+        if not key:
+            self.send_error_json(401, 'Unauthorized', 'Credentials are invalid')
+            return
+        try:
+            width = int(json.loads(body)['resize']['width'])
+        except (ValueError, KeyError, TypeError):
+            self.send_error_json(400, 'BadRequest', 'Invalid resize options')
+            return
+        data = server.fetch(self.path.rsplit('/', 1)[-1])
+        if data is None:
+            self.send_error_json(404, 'NotFound', 'Output not found')
+            return
+        with Image.open(io.BytesIO(data)) as img:
+            image_format = img.format
+            if img.width > width:
+                img = img.resize((width, max(1, img.height * width // img.width)))
+            buffer = io.BytesIO()
+            img.save(buffer, image_format)
+        self.send(200, buffer.getvalue(), {
+            'Content-Type': 'application/octet-stream',
+            'Compression-Count': str(server.count(key)),
+        })
+
+    def do_GET(self):
+        server = self.server
+        server.simulate_latency()
+        data = server.fetch(self.path.rsplit('/', 1)[-1]) if self.path.startswith('/output/') else None
+        if data is None:
+            self.send_error_json(404, 'NotFound', 'Output not found')
+            return
+        self.send(200, data, {'Content-Type': 'application/octet-stream'})
+
+
+class MockTinyPNGServer(ThreadingHTTPServer):
+    """模拟 TinyPNG API 的 HTTP 服务
+
+    参数:
+        latency: 每个请求的平均延迟（秒）
+        jitter: 延迟的随机波动范围（秒）
+        error_rate: 上传返回 503 的概率
+        quota_error_rate: 上传返回 429（额度用完）的概率
+        initial_count: 每个 key 的初始 Compression-Count
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, quota_error_rate=0.0, initial_count=0):
+        super().__init__((host, port), MockTinyPNGHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota_error_rate = quota_error_rate
+        self.initial_count = initial_count
+        self.counts = {}
+        self.outputs = {}
+        self.ids = itertools.count(1)
+        self.state_lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def simulate_latency(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def store(self, key, data):
+        """保存上传的数据，返回 (结果 id, 该 key 的压缩次数)"""
+        with self.state_lock:
+            self.counts[key] = self.counts.get(key, self.initial_count) + 1
+            output_id = str(next(self.ids))
+            self.outputs[output_id] = data
+            return output_id, self.counts[key]
+
+    def count(self, key):
+        """额外计一次压缩（服务器端缩放），返回该 key 的压缩次数"""
+        with self.state_lock:
+            self.counts[key] = self.counts.get(key, self.initial_count) + 1
+            return self.counts[key]
+
+    def fetch(self, output_id):
+        # 每个结果只下载一次，下载后释放内存
+        with self.state_lock:
+            return self.outputs.pop(output_id, None)
+
+    def start(self):
+        """在后台线程中运行"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的 TinyPNG API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.2, help="平均延迟（秒）")
+    parser.add_argument('--jitter', type=float, default=0.05, help="延迟波动（秒）")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="返回 503 的概率")
+    parser.add_argument('--quota-error-rate', type=float, default=0.0, help="返回 429 的概率")
+    parser.add_argument('--initial-count', type=int, default=0, help="每个 key 的初始压缩次数")
+    args = parser.parse_args()
+
+    server = MockTinyPNGServer(args.host, args.port, args.latency, args.jitter,
+                               args.error_rate, args.quota_error_rate, args.initial_count)
+    print(f"模拟 TinyPNG API 已启动: {server.endpoint}（按 Ctrl+C 退出）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,415 @@
+import copy
+import re
+import json
+import threading
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta
+
+from log_store import FILE_COLUMNS
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# 有专门属性的字段，其余字段（例如 duplicates）原样保存在 extra 中
+KNOWN_FIELDS = frozenset(FILE_COLUMNS)
+
+
+def pack_time(text):
+    """ISO 时间字符串转为整数微秒，无法原样还原的值保持不变"""
+    try:
+        moment = datetime.fromisoformat(text)
+    except (TypeError, ValueError):
+        return text
+    if moment.tzinfo is not None or moment.isoformat() != text:
+        return text
+    return (moment - EPOCH) // MICROSECOND
+
+
+def unpack_time(value):
+    if isinstance(value, int):
+        return (EPOCH + value * MICROSECOND).isoformat()
+    return value
+
+
+def format_ratio(original_size, compressed_size):
+    """与 record_compression 中 compression_ratio 的格式相同"""
+    return f"{(1 - compressed_size / original_size) * 100:.2f}%"
+
+
+# 紧凑记录是一个元组，各位置依次为:
+# (源目录前缀, 源文件名, 输出目录前缀, 输出文件名, 原始大小, 压缩后大小,
+#  压缩率文本, 压缩时间, key 索引, key 标识, 后端, 其他字段)
+# 日志中没有的字段为 MISSING，还原时不会多出字段
+MISSING = object()
+
+
+def record_ratio(record):
+    """紧凑记录的压缩率（百分比）"""
+    original_size, compressed_size = record[4], record[5]
+    if not isinstance(original_size, int) or not original_size or not isinstance(compressed_size, int):
+        return 0.0
+    return (1 - compressed_size / original_size) * 100
+
+
+class CompactFileTable(MutableMapping):
+    """compressed_files 的紧凑字典视图（文件哈希 -> 压缩信息）
+
+    - 源路径和输出路径拆分为目录前缀和文件名，目录前缀在整张表中共用同一个字符串
+    - compression_ratio 能由大小算出时不保存，压缩时间保存为整数微秒
+    - api_key_used、backend 等重复的短字符串也共用
+
+    内存中每条记录只是一个元组，取出时才还原成与日志相同的字典。
+    与 SQLiteFileTable 一样，取出的压缩信息是副本，修改后需要重新赋值才会写回。
+    判断是否已压缩只是一次哈希查找，不会还原任何记录。
+    """
+
+    def __init__(self, items=()):
+        self.entries = {}
+        # 共用的字符串（目录前缀、key 标识、后端名）
+        self.strings = {}
+        for file_hash, entry in items:
+            self[file_hash] = entry
+
+    def pack(self, entry):
+        """压缩信息字典转为紧凑记录"""
+        strings = self.strings
+        get = entry.get
+        # 字段少见的日志（旧版本、手工修改）保留原值
+        unknown = set() if KNOWN_FIELDS.issuperset(entry) else entry.keys() - KNOWN_FIELDS
+
+        source_dir = source_name = output_dir = output_name = MISSING
+        source_path = get('source_path', MISSING)
+        if type(source_path) is str:
+            i = max(source_path.rfind('/'), source_path.rfind('\\')) + 1
+            source_dir = strings.setdefault(source_path[:i], source_path[:i])
+            source_name = source_path[i:]
+        elif source_path is not MISSING:
+            unknown.add('source_path')
+        output_path = get('output_path', MISSING)
+        if type(output_path) is str:
+            i = max(output_path.rfind('/'), output_path.rfind('\\')) + 1
+            output_dir = strings.setdefault(output_path[:i], output_path[:i])
+            output_name = output_path[i:]
+            # 输出文件名通常与源文件名相同，共用同一个字符串
+            if output_name == source_name:
+                output_name = source_name
+        elif output_path is not MISSING:
+            unknown.add('output_path')
+
+        original_size = get('original_size', MISSING)
+        compressed_size = get('compressed_size', MISSING)
+        ratio_text = get('compression_ratio', MISSING)
+        if (ratio_text is not MISSING and type(original_size) is int and original_size
+                and type(compressed_size) is int
+                and ratio_text == format_ratio(original_size, compressed_size)):
+            # 能由大小算出，不保存
+            ratio_text = None
+
+        compressed_at = get('compressed_at', MISSING)
+        if compressed_at is not MISSING:
+            compressed_at = pack_time(compressed_at)
+        key_used = get('api_key_used', MISSING)
+        if type(key_used) is str:
+            key_used = strings.setdefault(key_used, key_used)
+        backend = get('backend', MISSING)
+        if type(backend) is str:
+            backend = strings.setdefault(backend, backend)
+
+        extra = {name: entry[name] for name in entry if name in unknown} if unknown else None
+        return (source_dir, source_name, output_dir, output_name, original_size, compressed_size,
+                ratio_text, compressed_at, get('api_key_index', MISSING), key_used, backend, extra)
+
+    def unpack(self, record):
+        """紧凑记录还原为压缩信息字典"""
+        (source_dir, source_name, output_dir, output_name, original_size, compressed_size,
+         ratio_text, compressed_at, key_index, key_used, backend, extra) = record
+        entry = {}
+        if source_dir is not MISSING:
+            entry['source_path'] = source_dir + source_name
+        if output_dir is not MISSING:
+            entry['output_path'] = output_dir + output_name
+        if original_size is not MISSING:
+            entry['original_size'] = original_size
+        if compressed_size is not MISSING:
+            entry['compressed_size'] = compressed_size
+        if ratio_text is None:
+            entry['compression_ratio'] = format_ratio(original_size, compressed_size)
+        elif ratio_text is not MISSING:
+            entry['compression_ratio'] = ratio_text
+        if compressed_at is not MISSING:
+            entry['compressed_at'] = unpack_time(compressed_at)
+        for name, value in (('api_key_index', key_index), ('api_key_used', key_used), ('backend', backend)):
+            if value is not MISSING:
+                entry[name] = value
+        if extra:
+            # duplicates 等可变字段复制一份，修改副本不会影响表中的记录
+            entry.update(copy.deepcopy(extra))
+        return entry
+
+    def __getitem__(self, file_hash):
+        return self.unpack(self.entries[file_hash])
+
+    def get(self, file_hash, default=None):
+        packed = self.entries.get(file_hash)
+        return default if packed is None else self.unpack(packed)
+
+    def __contains__(self, file_hash):
+        return file_hash in self.entries
+
+    def __setitem__(self, file_hash, entry):
+        self.entries[file_hash] = self.pack(entry)
+
+    def __delitem__(self, file_hash):
+        del self.entries[file_hash]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def items(self):
+        """逐条还原，不会一次生成所有记录的字典"""
+        for file_hash, packed in self.entries.items():
+            yield file_hash, self.unpack(packed)
+
+    def values(self):
+        for _, entry in self.items():
+            yield entry
+
+
+# dump_log / json.dump(indent=4) 写出的日志中，compressed_files 段和每条压缩信息的边界
+SECTION_START = b'\n    "compressed_files": {'
+SECTION_END = b'\n    }'
+ENTRY_START = b'\n        "'
+ENTRY_END = b'\n        }'
+# 文件哈希不含需要转义的字符；含有时匹配不到，由记录数检查退回完整解析
+ENTRY_PATTERN = re.compile(rb'\n        "([^"\\\n]*)": \{')
+COMMA = ord(',')
+
+# 记录在文件中的位置保存为一个整数：起始位置 << LENGTH_BITS | 长度
+LENGTH_BITS = 32
+LENGTH_MASK = (1 << LENGTH_BITS) - 1
+
+
+def index_entries(data):
+    """不解析内容，找出每条压缩信息在日志中的位置
+
+    只依赖缩进：更深层的键和右括号缩进更多，不会被误认为记录的边界。
+    返回 (compressed_files 段的起止位置, {文件哈希: 位置})，格式不符（手工修改、
+    其他工具写出、Windows 换行）时返回 None，由调用方完整解析。
+    """
+    section = data.find(SECTION_START)
+    if section < 0:
+        return None
+    start = section + len(SECTION_START) - 1
+    if data.startswith(b'{}', start):
+        return start, start + 2, {}
+    # 第一层的右括号是 compressed_files 段的结束
+    end = data.find(SECTION_END, start)
+    if end < 0:
+        return None
+    end += len(SECTION_END)
+
+    offsets = {}
+    value_start = None
+    for match in ENTRY_PATTERN.finditer(data, start, end):
+        if value_start is None:
+            if match.start() != start + 1:
+                return None
+        elif not (data[match.start() - 1] == COMMA and data.endswith(ENTRY_END, value_start, match.start() - 1)):
+            return None
+        else:
+            offsets[key] = value_start << LENGTH_BITS | (match.start() - 1 - value_start)
+        key = match.group(1).decode('utf-8')
+        value_start = match.end() - 1
+    value_end = end - len(SECTION_END)
+    if value_start is None or not data.endswith(ENTRY_END, value_start, value_end):
+        return None
+    offsets[key] = value_start << LENGTH_BITS | (value_end - value_start)
+    # 每个第二层的键都应是一条记录的开始，否则（例如值不是对象）边界不可靠
+    if len(offsets) != data.count(ENTRY_START, start, end):
+        return None
+    return start, end, offsets
+
+
+class LazyFileTable(CompactFileTable):
+    """按需读取的 compressed_files（读取日志快照时使用）
+
+    内存中只有 文件哈希 -> 记录在日志文件中的位置，取出时才从文件读取并解析；
+    修改或新增的记录按 CompactFileTable 的紧凑表示保存，并优先于文件中的记录。
+    写回时未修改的记录直接复制原文，写回后改为读取新文件（见 reopen）。
+    """
+
+    def __init__(self, path, offsets):
+        super().__init__()
+        self.offsets = offsets
+        # entries 中不在 offsets 里的记录数（新增的记录）
+        self.added = 0
+        self.read_lock = threading.Lock()
+        self.path = path
+        self.file = open(path, 'rb')
+
+    def raw(self, location):
+        """一条压缩信息的原文"""
+        with self.read_lock:
+            self.file.seek(location >> LENGTH_BITS)
+            return self.file.read(location & LENGTH_MASK)
+
+    def close(self):
+        """关闭日志文件（Windows 上打开的文件不能被替换）"""
+        self.file.close()
+
+    def reopen(self, path=None, offsets=None):
+        """重新打开日志文件
+
+        参数:
+            path/offsets: 写回的新日志和 dump_log 返回的记录位置，此时所有记录都已在
+                新文件中，内存中的修改随之清空；不传时重新打开原来的文件
+        """
+        if offsets is not None:
+            self.path = path
+            self.offsets = offsets
+            self.entries = {}
+            self.strings = {}
+            self.added = 0
+        self.file = open(self.path, 'rb')
+
+    def __getitem__(self, file_hash):
+        packed = self.entries.get(file_hash)
+        if packed is not None:
+            return self.unpack(packed)
+        return json.loads(self.raw(self.offsets[file_hash]))
+
+    def get(self, file_hash, default=None):
+        packed = self.entries.get(file_hash)
+        if packed is not None:
+            return self.unpack(packed)
+        location = self.offsets.get(file_hash)
+        return default if location is None else json.loads(self.raw(location))
+
+    def __contains__(self, file_hash):
+        return file_hash in self.entries or file_hash in self.offsets
+
+    def __setitem__(self, file_hash, entry):
+        # 文件中的记录不删除（遍历时也可以修改已有的记录），由 entries 覆盖
+        if file_hash not in self.entries and file_hash not in self.offsets:
+            self.added += 1
+        self.entries[file_hash] = self.pack(entry)
+
+    def __delitem__(self, file_hash):
+        if file_hash in self.offsets:
+            del self.offsets[file_hash]
+            self.entries.pop(file_hash, None)
+        else:
+            del self.entries[file_hash]
+            self.added -= 1
+
+    def __iter__(self):
+        yield from self.offsets
+        for file_hash in self.entries:
+            if file_hash not in self.offsets:
+                yield file_hash
+
+    def __len__(self):
+        return len(self.offsets) + self.added
+
+    def items(self):
+        """逐条读取，不会一次生成所有记录的字典"""
+        for file_hash in self:
+            yield file_hash, self[file_hash]
+
+    def json_items(self):
+        """逐条返回 (文件哈希, 缩进后的 JSON 文本)，未修改的记录直接使用原文"""
+        entries = self.entries
+        for file_hash in self:
+            packed = entries.get(file_hash)
+            if packed is None:
+                yield file_hash, self.raw(self.offsets[file_hash]).decode('utf-8')
+            else:
+                yield file_hash, json.dumps(self.unpack(packed), indent=4,
+                                            ensure_ascii=False).replace('\n', '\n        ')
+
+
+def load_packed_log(data):
+    """完整解析 JSON 日志，compressed_files 读取为 CompactFileTable
+
+    每条压缩信息解析出来后立即转为紧凑表示，读取过程中不会同时保留所有记录的字典。
+    """
+    table = CompactFileTable()
+
+    def object_hook(obj):
+        if 'source_path' in obj and 'compressed_size' in obj:
+            return table.pack(obj)
+        return obj
+
+    log_data = json.loads(data, object_hook=object_hook)
+    table.entries = {file_hash: entry if isinstance(entry, tuple) else table.pack(entry)
+                     for file_hash, entry in log_data.get('compressed_files', {}).items()}
+    log_data['compressed_files'] = table
+    return log_data
+
+
+def load_compact_log(path):
+    """读取 JSON 日志，compressed_files 读取为 LazyFileTable
+
+    只解析 compressed_files 以外的字段，压缩信息在取出时才从文件读取。
+    日志不是 dump_log 写出的格式时退回完整解析（load_packed_log）。
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    located = index_entries(data)
+    if located is None:
+        return load_packed_log(data)
+    start, end, offsets = located
+    log_data = json.loads(data[:start] + b'{}' + data[end:])
+    del data
+    log_data['compressed_files'] = LazyFileTable(path, offsets)
+    return log_data
+
+
+def dump_log(log_data, f):
+    """输出与 json.dump(log_data, f, indent=4, ensure_ascii=False) 相同
+
+    compressed_files 逐条还原写入，不需要先生成包含所有记录的字典；
+    LazyFileTable 中未修改的记录直接复制日志原文。
+
+    返回:
+        compressed_files 为 LazyFileTable 时返回每条记录在输出中的位置（f 需要以
+        newline='\\n' 打开），供 LazyFileTable.reopen 改为读取新文件；否则返回 None
+    """
+    files = log_data.get('compressed_files')
+    offsets = {} if isinstance(files, LazyFileTable) else None
+    position = 0
+
+    def write(text):
+        nonlocal position
+        f.write(text)
+        if offsets is not None:
+            position += len(text) if text.isascii() else len(text.encode('utf-8'))
+
+    write('{')
+    for i, (name, value) in enumerate(log_data.items()):
+        write(',\n    ' if i else '\n    ')
+        write(json.dumps(name, ensure_ascii=False) + ': ')
+        if name != 'compressed_files':
+            write(json.dumps(value, indent=4, ensure_ascii=False).replace('\n', '\n    '))
+            continue
+        if isinstance(value, LazyFileTable):
+            entries = value.json_items()
+        else:
+            entries = ((file_hash, json.dumps(entry, indent=4, ensure_ascii=False).replace('\n', '\n        '))
+                       for file_hash, entry in value.items())
+        write('{')
+        count = 0
+        for file_hash, text in entries:
+            write(',\n        ' if count else '\n        ')
+            write(json.dumps(file_hash, ensure_ascii=False) + ': ')
+            start = position
+            write(text)
+            if offsets is not None:
+                offsets[file_hash] = start << LENGTH_BITS | (position - start)
+            count += 1
+        write('\n    }' if count else '}')
+    write('\n}' if log_data else '}')
+    return offsets
@@ -0,0 +1,172 @@
+import io
+import threading
+
+import tinify
+from PIL import Image
+
+from metrics import RunMetrics
+from async_tinypng import AsyncTinifyEngine
+
+
+class TinyPNGBackend:
+    """通过 TinyPNG API 压缩，每次调用消耗一次 key 额度
+
+    每个 key 使用独立的 tinify.Client（各自的 keep-alive 连接），
+    不依赖全局的 tinify.key，多个 key 可以同时使用。
+
+    参数:
+        api_endpoint: API 地址，默认 https://api.tinify.com（基准测试时指向本地模拟服务）
+        engine: "tinify"（默认，使用 tinify 库）或 "async"（AsyncTinifyEngine，
+                上传和下载直接读写文件，每个 key 一个 keep-alive 连接池）
+        max_connections_per_key: async 引擎每个 key 最多同时使用的连接数
+        timeout: async 引擎单次请求的超时时间（秒）
+    """
+
+    name = 'tinypng'
+    uses_api_key = True
+
+    def __init__(self, options=None, metrics=None):
+        self.options = options or {}
+        self.metrics = metrics or RunMetrics()
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        self.engine = None
+        if self.options.get('engine', 'tinify') == 'async':
+            self.engine = AsyncTinifyEngine(self.options.get('api_endpoint'),
+                                            self.options.get('max_connections_per_key', 8),
+                                            self.options.get('timeout', 60), self.metrics)
+        # 可以使用 compress_file 直接压缩文件
+        self.streams_files = self.engine is not None
+
+    def get_client(self, key):
+        with self.clients_lock:
+            if key not in self.clients:
+                client = tinify.Client(key, tinify.app_identifier, tinify.proxy)
+                if self.options.get('api_endpoint'):
+                    client.API_ENDPOINT = self.options['api_endpoint'].rstrip('/')
+                self.clients[key] = client
+            return self.clients[key]
+
+    def compress(self, data, file_ext, key=None):
+        """压缩图片数据
+
+        返回:
+            bytes: 压缩后的数据
+            int: API 返回的该 key 本月已压缩次数（未返回时为 None）
+        """
+        if self.engine:
+            return self.engine.compress_bytes(data, key)
+        client = self.get_client(key)
+        with self.metrics.timer('upload'):
+            response = client.request('POST', '/shrink', data)
+        self.metrics.add_bytes('uploaded', len(data))
+        count = response.headers.get('compression-count')
+        with self.metrics.timer('download'):
+            result = client.request('GET', response.headers['location'])
+        self.metrics.add_bytes('downloaded', len(result.content))
+        return result.content, int(count) if count else None
+
+    def compress_file(self, source_path, output_path, key, resize_width=None):
+        """压缩文件并写入 output_path，不把图片读入内存（只有 async 引擎支持）
+
+        参数:
+            resize_width: 不为 None 时由服务器缩放到该宽度（额外消耗一次额度）
+
+        返回:
+            int: 压缩后的文件大小
+            int: API 返回的该 key 本月已压缩次数（未返回时为 None）
+        """
+        return self.engine.compress_file(source_path, output_path, key, resize_width)
+
+    def close(self):
+        if self.engine:
+            self.engine.close()
+
+
+class LocalBackend:
+    """使用 Pillow 在本地压缩，不消耗 API 额度，也没有网络往返
+
+    - PNG: 量化为调色板图片后 optimize 保存
+    - JPEG: 渐进式 + optimize 保存
+    - WebP: 按 webp_method 设置压缩力度
+    """
+
+    name = 'local'
+    uses_api_key = False
+    streams_files = False
+
+    def __init__(self, options=None, metrics=None):
+        options = options or {}
+        self.metrics = metrics or RunMetrics()
+        self.jpeg_quality = options.get('jpeg_quality', 80)
+        self.png_quantize = options.get('png_quantize', True)
+        self.png_colors = options.get('png_colors', 256)
+        self.webp_quality = options.get('webp_quality', 80)
+        self.webp_method = options.get('webp_method', 6)
+
+    def compress(self, data, file_ext, key=None):
+        """压缩图片数据，压缩结果比原数据还大时返回原数据
+
+        返回:
+            bytes: 压缩后的数据
+            None: 本地压缩没有 API 计数
+        """
+        with self.metrics.timer('compress'):
+            return self.encode(data, file_ext)
+
+    def encode(self, data, file_ext):
+        img = Image.open(io.BytesIO(data))
+        buffer = io.BytesIO()
+
+        if file_ext in ['.jpg', '.jpeg']:
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            img.save(buffer, 'JPEG', quality=self.jpeg_quality, optimize=True, progressive=True)
+        elif file_ext == '.png':
+            if self.png_quantize and img.mode != 'P':
+                if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+                    # 只有 FASTOCTREE 支持带透明通道的量化
+                    img = img.convert('RGBA').quantize(self.png_colors, method=Image.Quantize.FASTOCTREE)
+                else:
+                    img = img.convert('RGB').quantize(self.png_colors)
+            img.save(buffer, 'PNG', optimize=True)
+        elif file_ext == '.webp':
+            img.save(buffer, 'WEBP', quality=self.webp_quality, method=self.webp_method)
+        else:
+            img.save(buffer, img.format, optimize=True)
+
+        img.close()
+        result = buffer.getvalue()
+        return (result if len(result) < len(data) else data), None
+
+
+class CopyBackend:
+    """不压缩，原样输出（预计压缩不了多少的图片，或不需要压缩的格式）"""
+
+    name = 'copy'
+    uses_api_key = False
+    streams_files = False
+
+    def __init__(self, options=None, metrics=None):
+        self.options = options or {}
+
+    def compress(self, data, file_ext, key=None):
+        return data, None
+
+
+BACKENDS = {
+    TinyPNGBackend.name: TinyPNGBackend,
+    LocalBackend.name: LocalBackend,
+    CopyBackend.name: CopyBackend,
+}
+
+
+def create_backend(name, options=None, metrics=None):
+    """根据名称创建压缩后端
+
+    参数:
+        metrics: 记录各阶段耗时的 RunMetrics，为 None 时后端自己记录（不输出）
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"未知的压缩后端: {name}（可选: {', '.join(BACKENDS)}）")
+    return BACKENDS[name](options, metrics)
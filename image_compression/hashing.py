@@ -0,0 +1,89 @@
+import os
+import mmap
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# 每次读取 1MB，hashlib 处理大块数据时会释放 GIL
+HASH_CHUNK_SIZE = 1024 * 1024
+# 超过该大小的文件用 mmap 直接交给 hashlib，省去读入缓冲区的复制
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+HASH_ALGORITHMS = ('md5', 'blake2b', 'xxh3')
+
+
+def resolve_algorithm(algorithm):
+    """检查哈希算法是否可用，xxhash 未安装时退回 blake2b"""
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"未知的哈希算法: {algorithm}（可选: {', '.join(HASH_ALGORITHMS)}）")
+    if algorithm == 'xxh3' and xxhash is None:
+        print("警告: 未安装 xxhash（pip install xxhash），改用 blake2b")
+        return 'blake2b'
+    return algorithm
+
+
+def new_hasher(algorithm):
+    if algorithm == 'md5':
+        return hashlib.md5()
+    if algorithm == 'blake2b':
+        return hashlib.blake2b()
+    return xxhash.xxh3_128()
+
+
+def format_hash(algorithm, hexdigest):
+    """compressed_files 中的键
+
+    md5 保持旧版本日志的格式（纯十六进制），其他算法加上 "算法:" 前缀，
+    迁移后残留的旧记录不会与新记录混淆。
+    """
+    if algorithm == 'md5':
+        return hexdigest
+    return f"{algorithm}:{hexdigest}"
+
+
+def hash_algorithm_of(file_hash):
+    """根据 compressed_files 中的键判断其哈希算法"""
+    if ':' in file_hash:
+        return file_hash.split(':', 1)[0]
+    return 'md5'
+
+
+def hash_bytes(data, algorithm='md5'):
+    """计算内存中数据的哈希值"""
+    hasher = new_hasher(algorithm)
+    hasher.update(data)
+    return format_hash(algorithm, hasher.hexdigest())
+
+
+def hash_file_multi(file_path, algorithms):
+    """只读取一次文件，同时计算多种哈希值
+
+    返回:
+        list: 与 algorithms 顺序一致的哈希值
+    """
+    hashers = [new_hasher(algorithm) for algorithm in algorithms]
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for hasher in hashers:
+                    hasher.update(data)
+        else:
+            buffer = bytearray(HASH_CHUNK_SIZE)
+            view = memoryview(buffer)
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                for hasher in hashers:
+                    hasher.update(view[:n])
+    return [format_hash(algorithm, hasher.hexdigest())
+            for algorithm, hasher in zip(algorithms, hashers)]
+
+
+def hash_file(file_path, algorithm='md5'):
+    """计算文件的哈希值"""
+    return hash_file_multi(file_path, [algorithm])[0]
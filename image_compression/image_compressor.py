@@ -1,21 +1,279 @@
 import os
 import json
-import hashlib
+import shutil
+import queue
+import time
+import signal
+import fnmatch
+import argparse
+import threading
+import contextlib
+import cProfile
+import pstats
 import tinify
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from datetime import datetime
-from PIL import Image
-import tempfile
+
+from compression_backends import BACKENDS, create_backend
+from watchers import Debouncer, create_watcher
+from key_scheduler import KeyScheduler
+from metrics import RunMetrics
+from log_store import SQLiteLogStore, export_log
+from compact_index import CompactFileTable, LazyFileTable, load_compact_log, dump_log
+from log_summary import new_summary, add_compression, add_duplicate, build_summary, is_skipped, SKIPPED
+from retry import TRANSIENT_ERRORS, RetryPolicy, CircuitBreaker
+from skip_predictor import SkipPredictor, image_features, header_features
+from planner import estimate_item, select_by_savings, take_in_order, plan_totals
+from sharding import SHARD_METHODS, parse_shard, shard_of, node_quota, merge_logs
+from resize_pool import ResizePool, resize_image_data, render_variants
+from hashing import (hash_file, hash_file_multi, hash_bytes, hash_algorithm_of,
+                     resolve_algorithm)
+
+
+def materialize_output(existing_path, output_path, method='auto'):
+    """用已有的压缩结果生成新的输出文件
+
+    auto 依次尝试 reflink（写时复制，互不影响）、硬链接、普通复制；
+    copy 总是普通复制。
+
+    返回:
+        str: 实际使用的方式
+    """
+    if method == 'auto':
+        try:
+            import fcntl
+            FICLONE = 0x40049409
+            with open(existing_path, 'rb') as src, open(output_path, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return 'reflink'
+        except (ImportError, OSError):
+            if os.path.exists(output_path):
+                os.remove(output_path)
+        
+        try:
+            os.link(existing_path, output_path)
+            return '硬链接'
+        except OSError:
+            pass
+    
+    shutil.copyfile(existing_path, output_path)
+    return '复制'
+
+
+def write_output(output_path, data):
+    """写入输出文件：先写同目录的临时文件再替换
+
+    输出文件可能与其他输出共用同一个 inode（materialize_output 的硬链接），
+    直接覆盖写入会把另一个文件一起改掉；替换只会断开链接。
+    """
+    temp_path = output_path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# 变体的 format -> 输出扩展名
+VARIANT_FORMATS = {'jpeg': '.jpg', 'png': '.png', 'webp': '.webp'}
+
+
+def variant_key(file_hash, name):
+    """变体在 compressed_files 中的键，每个变体单独记录"""
+    return f"{file_hash}#{name}"
+
+
+def read_journal(journal_file):
+    """逐条读取压缩日志的追加记录（journal）
+
+    进程在写入途中被杀死时最后一行可能不完整，直接忽略。
+    """
+    if not os.path.exists(journal_file):
+        return
+    with open(journal_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def trim_journal_tail(journal_file):
+    """把 journal 截断到最后一个换行符，去掉写入途中中断留下的不完整的最后一行
+
+    否则下一条记录会接在残缺的内容后面，整行在重放时都无法解析。
+    """
+    if not os.path.exists(journal_file):
+        return
+    with open(journal_file, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+        # 从末尾向前分块查找最后一个换行符
+        end = size
+        while end > 0:
+            start = max(0, end - 64 * 1024)
+            f.seek(start)
+            position = f.read(end - start).rfind(b'\n')
+            if position >= 0:
+                f.truncate(start + position + 1)
+                return
+            end = start
+        f.truncate(0)
+
+
+def apply_journal_record(log_data, record, files=True):
+    """把一条压缩记录合并到日志数据中
+
+    新压缩和从 journal 重放使用同一套逻辑，保证两者结果一致。
+    已经合并进快照的记录（seq 不大于 journal_seq）会被忽略。
+    
+    参数:
+        files: 为 False 时只更新计数和汇总统计，不更新 compressed_files
+               （查看统计时基于 compression_summary.json 重放）
+    """
+    if record['seq'] <= log_data.get('journal_seq', 0):
+        return
+    
+    if record.get('type') == 'duplicate':
+        # 内容相同的另一个路径，复用了已有的压缩结果，不消耗 API 次数
+        if files:
+            entry = log_data['compressed_files'][record['hash']]
+            entry.setdefault('duplicates', {})[record['source_path']] = record['output_path']
+            # 重新赋值，SQLite 存储取出的是副本
+            log_data['compressed_files'][record['hash']] = entry
+        if 'summary' in log_data:
+            add_duplicate(log_data['summary'])
+        log_data['journal_seq'] = record['seq']
+        return
+    
+    key = record['key']
+    entry = record['entry']
+    current_time = entry['compressed_at']
+    
+    # 预测跳过的图片没有压缩，不计入压缩次数
+    if not is_skipped(entry):
+        log_data['total_compressions'] = log_data.get('total_compressions', 0) + 1
+    
+    # 本地压缩后端不使用 API key（key 为 None）
+    if key:
+        # 本次压缩消耗的 API 次数（服务器端缩放计为 2 次）
+        calls = record.get('calls', 1)
+        usage = log_data['key_usage'].get(key, 0)
+        if log_data.get('shard'):
+            # 分片运行：只计本节点的使用次数（合并日志时各节点相加），
+            # API 返回的总次数单独保存，用于确认 key 的总额度没有用完
+            log_data['key_usage'][key] = usage + calls
+            if record.get('compression_count'):
+                reported = log_data.setdefault('key_reported_usage', {})
+                reported[key] = max(reported.get(key, 0), record['compression_count'])
+        elif record.get('compression_count'):
+            # 更新使用计数：有 API 返回的 compression_count 时以它为准（其他机器共用 key 时
+            # 本地计数会偏低），并发请求的返回顺序可能乱序，因此只取较大值
+            log_data['key_usage'][key] = max(usage, record['compression_count'])
+        else:
+            log_data['key_usage'][key] = usage + calls
+        
+        # 更新 key 详细信息
+        if key not in log_data['key_details']:
+            log_data['key_details'][key] = {
+                'first_used': current_time,
+                'last_used': current_time,
+                'total_usage': 1
+            }
+        else:
+            log_data['key_details'][key]['last_used'] = current_time
+            log_data['key_details'][key]['total_usage'] = log_data['key_usage'][key]
+        
+        log_data['current_key_index'] = entry['api_key_index']
+    
+    if 'summary' in log_data:
+        add_compression(log_data['summary'], entry, key, record.get('calls', 1))
+    if files:
+        log_data['compressed_files'][record['hash']] = entry
+    log_data['journal_seq'] = record['seq']
+
 
 class ImageCompressor:
-    def __init__(self, config_file='config.json'):
-        """初始化图片压缩器"""
+    def __init__(self, config_file='config.json', workers=None, backend=None, profile_file=None,
+                 shard=None):
+        """初始化图片压缩器
+
+        参数:
+            workers: 并发压缩数，为 None 时读取配置中的 concurrency
+            backend: 本次运行所有图片使用的压缩后端，为 None 时按配置选择
+            profile_file: 不为 None 时用 cProfile 分析所有处理线程，结果保存到该文件
+            shard: 本节点处理的分片 "序号/总数"，为 None 时读取配置 shard_index/shard_count
+        """
         self.config_file = config_file
         self.log_file = 'compression_log.json'
+        # 追加写入的压缩记录，定期合并回 compression_log.json
+        self.journal_file = 'compression_log.journal'
+        # 日志中除 compressed_files 外的部分（计数和汇总统计），查看统计时不必读取整个日志
+        self.summary_file = 'compression_summary.json'
+        self.journal = None
+        self.journal_pending = 0
+        # 文件路径 -> [大小, 修改时间(ns), inode, 哈希]，文件未变化时跳过重新计算哈希
+        self.index_file = 'hash_index.json'
+        self.index_dirty = False
+        # 上次运行中全部处理完成的目录，目录及子目录都未变化时扫描可以整个跳过
+        self.dir_index_file = 'dir_index.json'
+        # 保护 log_data 与 key 切换的锁，并发模式下多个线程共享
+        self.lock = threading.Condition(threading.RLock())
+        # 正在压缩中的文件哈希，内容相同的图片等待其完成后复用结果
+        self.pending_hashes = set()
+        # 处理图片期间的输出先放在当前线程的 lines 中，处理完成后在 print_lock 下一次输出
+        self.output_local = threading.local()
+        self.print_lock = threading.Lock()
+        # 各阶段耗时和传输字节数，运行结束时写入 metrics_file
+        self.metrics = RunMetrics()
+        self.profile_file = profile_file
+        self.profilers = []
+        self.profile_local = threading.local()
         self.load_config()
+        self.workers = max(1, int(workers or self.config.get('concurrency', 1)))
+        self.backend_override = backend
+        self.load_backends()
+        self.hash_algorithm = resolve_algorithm(self.config.get('hash_algorithm', 'md5'))
+        self.load_hash_index()
         self.load_log()
+        self.migrate_hash_algorithm()
+        self.load_shard(shard)
         self.current_key_index = self.log_data.get('current_key_index', 0)
-        self.set_api_key()
+        self.key_scheduler = KeyScheduler(
+            self.config['api_keys'],
+            self.log_data,
+            self.config.get('max_compressions_per_key', 500),
+            self.lock,
+            strategy=self.config.get('key_strategy', 'sequential'),
+            node_quota=self.node_quota
+        )
+        # 暂时性错误（服务器错误、网络错误）先退避重试，连续失败时熔断暂停所有线程
+        self.retry_policy = RetryPolicy(
+            self.config.get('retry_max_attempts', 4),
+            self.config.get('retry_base_delay', 1),
+            self.config.get('retry_max_delay', 30)
+        )
+        self.breaker = CircuitBreaker(
+            self.config.get('circuit_failure_threshold', 5),
+            self.config.get('circuit_cooldown', 30)
+        )
+        # 失败的图片 -> 原因，保存后可以用 --retry-failed 只重新处理这些图片
+        self.failed_list_file = self.config.get('failed_list_file', 'failed_images.json')
+        self.load_skip_predictor()
+        self.load_variants()
+        self.load_resize_pool()
         
     def load_config(self):
         """加载配置文件"""
@@ -32,6 +290,8 @@ class ImageCompressor:
                 "max_compressions_per_key": 500,
                 "max_width": 1920,
                 "enable_resize": True,
+                "concurrency": 1,
+                "backend": "tinypng",
                 "supported_formats": [".jpg", ".jpeg", ".png", ".webp"]
             }
             with open(self.config_file, 'w', encoding='utf-8') as f:
@@ -43,32 +303,275 @@ class ImageCompressor:
             with open(self.config_file, 'r', encoding='utf-8') as f:
                 self.config = json.load(f)
     
-    def load_log(self):
-        """加载压缩日志"""
-        if os.path.exists(self.log_file):
-            with open(self.log_file, 'r', encoding='utf-8') as f:
-                self.log_data = json.load(f)
+    def load_skip_predictor(self):
+        """skip_min_savings 大于 0 时，上传前预测压缩率，预计节省太少的图片不调用 API"""
+        self.predictor = None
+        min_savings = self.config.get('skip_min_savings', 0)
+        if not min_savings:
+            return
+        
+        self.predictor = SkipPredictor(
+            min_savings,
+            self.config.get('skip_stats_file', 'skip_stats.json'),
+            self.config.get('skip_log_file', 'skip_decisions.jsonl'),
+            self.config.get('skip_min_samples', 5)
+        )
+        # 跳过的图片改用 skip_action 指定的后端：copy 原样输出，local 本地压缩
+        action = self.config.get('skip_action', 'copy')
+        self.skip_backend = create_backend(action, self.config.get(f'{action}_options'), self.metrics)
+        max_width = self.config.get('max_width', 1920) if self.config.get('enable_resize', False) else None
+        self.predictor.bootstrap(self.log_data['compressed_files'],
+                                 self.config.get('skip_bootstrap_limit', 2000), max_width)
+    
+    def load_variants(self):
+        """读取 variants：每张源图片只解码一次，生成多个尺寸或格式的输出
+        
+        每个变体在 compressed_files 中单独记录（键为 "<文件哈希>#<变体名>"），可以各自续传，
+        同一张图片的各变体在 variant_executor 中同时压缩。
+        """
+        self.variants = []
+        self.variant_executor = None
+        for variant in self.config.get('variants') or []:
+            max_width = variant.get('max_width')
+            image_format = variant.get('format')
+            if image_format is not None and image_format not in VARIANT_FORMATS:
+                raise ValueError(f"未知的变体格式: {image_format}（可选: {', '.join(VARIANT_FORMATS)}）")
+            name = str(variant.get('name') or '-'.join(
+                str(part) for part in (max_width or 'full', image_format) if part))
+            if any(v['name'] == name for v in self.variants):
+                raise ValueError(f"变体名称重复: {name}")
+            self.variants.append({
+                'name': name,
+                'max_width': max_width,
+                'format': image_format,
+                'suffix': variant.get('suffix', f"-{name}"),
+            })
+        if self.variants:
+            self.variant_executor = ThreadPoolExecutor(
+                self.config.get('variant_concurrency', max(self.workers, len(self.variants))))
+    
+    def variant_output_path(self, source_path, variant):
+        """变体的输出路径：文件名加上 suffix，指定 format 时换成对应的扩展名"""
+        root, ext = os.path.splitext(self.get_output_path(source_path))
+        if variant['format']:
+            ext = VARIANT_FORMATS[variant['format']]
+        return root + variant['suffix'] + ext
+    
+    def load_resize_pool(self):
+        """启用缩放（或 variants）且多个压缩任务同时进行时，缩放交给进程池，不受 GIL 限制"""
+        self.resize_pool = None
+        processes = self.config.get('resize_processes', os.cpu_count() or 1)
+        resizing = self.config.get('enable_resize', False) or self.variants
+        if resizing and self.workers > 1 and processes > 1:
+            self.resize_pool = ResizePool(processes, self.config.get('resize_max_pending'))
+    
+    def close(self):
+        """结束缩放进程池、变体压缩线程和后端的连接，提交并关闭日志"""
+        if self.variant_executor:
+            self.variant_executor.shutdown()
+        if self.resize_pool:
+            self.resize_pool.close()
+        for backend in self.backends.values():
+            if hasattr(backend, 'close'):
+                backend.close()
+        if isinstance(self.log_data.get('compressed_files'), LazyFileTable):
+            self.log_data['compressed_files'].close()
+        if self.store:
+            self.store.close()
+    
+    def load_shard(self, shard=None):
+        """分片运行：多台机器各自只处理 source_folder 中属于自己的一份图片
+        
+        shard_by 为 path 时按相对路径划分，扫描时即可判断，不需要读取其他节点的文件；
+        为 content 时按文件哈希划分，内容相同的图片总在同一节点，但每个节点都要计算所有文件的哈希。
+        每个 key 的额度按节点平均预留（shard_key_quota 可以指定），节点之间不会重复消耗。
+        """
+        self.shard = None
+        self.node_quota = None
+        if shard:
+            index, count = parse_shard(shard)
         else:
-            self.log_data = {
-                'compressed_files': {},  # 文件哈希 -> 压缩信息
-                'key_usage': {},  # API key 使用计数
-                'key_details': {},  # API key 详细信息（首次使用、最后使用时间等）
-                'current_key_index': 0,
-                'total_compressions': 0,  # 总压缩次数
-                'last_run_time': None  # 最后运行时间
-            }
+            index, count = self.config.get('shard_index', 1), self.config.get('shard_count', 1)
+        if count <= 1:
+            if self.log_data.pop('shard', None):
+                self.log_data.pop('key_reported_usage', None)
+                print("提示: 已关闭分片，key 使用次数恢复按 API 返回的总次数同步")
+            return
+        if not 1 <= index <= count:
+            raise ValueError(f"分片序号应在 1 ~ {count} 之间: {index}")
+        shard_by = self.config.get('shard_by', 'path')
+        if shard_by not in SHARD_METHODS:
+            raise ValueError(f"未知的分片方式: {shard_by}（可选: {', '.join(SHARD_METHODS)}）")
         
-        # 确保旧版本日志也有新字段
-        if 'key_details' not in self.log_data:
-            self.log_data['key_details'] = {}
-        if 'total_compressions' not in self.log_data:
-            self.log_data['total_compressions'] = 0
-        if 'last_run_time' not in self.log_data:
-            self.log_data['last_run_time'] = None
+        self.shard = (index, count, shard_by)
+        max_usage = self.config.get('max_compressions_per_key', 500)
+        self.node_quota = self.config.get('shard_key_quota', node_quota(max_usage, index, count))
+        info = {'index': index, 'count': count, 'by': shard_by}
+        previous = self.log_data.get('shard')
+        if previous and previous != info:
+            print(f"提示: 分片由 {previous['index']}/{previous['count']} 改为 {index}/{count}，"
+                  f"本节点的 key 使用次数继续累计")
+        self.log_data['shard'] = info
+        print(f"分片运行: 第 {index}/{count} 份（按{'路径' if shard_by == 'path' else '内容'}划分），"
+              f"每个 key 预留 {self.node_quota} 次")
+    
+    def in_shard(self, image_path, file_hash=None):
+        """图片是否属于本节点
+        
+        按内容划分时需要文件哈希，file_hash 为 None 时先视为属于本节点，计算哈希后再判断。
+        """
+        if self.shard is None:
+            return True
+        index, count, shard_by = self.shard
+        if shard_by == 'content':
+            return file_hash is None or shard_of(file_hash, count) == index - 1
+        rel_path = os.path.relpath(image_path, self.config['source_folder']).replace(os.sep, '/')
+        return shard_of(rel_path, count) == index - 1
+    
+    def merge_logs(self, paths):
+        """合并各节点的压缩日志，结果替换本地日志（compression_log.json 或 SQLite 数据库）
+        
+        每个日志同目录下同名的 .journal 文件（尚未合并进快照的记录）也会一起读取。
+        需要保留本地已有的记录时，把本地日志也作为一个输入。
+        """
+        logs = []
+        for path in paths:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"日志文件不存在: {path}")
+            journal_file = os.path.splitext(path)[0] + '.journal'
+            log_data = self.read_json_log(path, journal_file)
+            logs.append((path, log_data))
+            print(f"读取 {path}: {len(log_data['compressed_files'])} 条压缩记录")
+        
+        compact = self.config.get('compact_index', True) and not self.store
+        merged = merge_logs(logs, CompactFileTable() if compact else {})
+        del logs
+        with self.lock:
+            self.log_data = merged
+            self.key_scheduler.log_data = merged
+            self.save_log()
+        print(f"已合并 {len(paths)} 个日志: {len(merged['compressed_files'])} 条压缩记录，"
+              f"{len(merged['merged_nodes'])} 个节点，总压缩次数 {merged['total_compressions']}")
+    
+    def load_backends(self):
+        """创建配置中用到的压缩后端"""
+        names = {self.backend_override or self.config.get('backend', 'tinypng')}
+        if not self.backend_override:
+            names.update(self.config.get('format_backends', {}).values())
+        
+        # 各后端的参数放在 "<后端名>_options" 中，例如 local_options
+        self.backends = {name: create_backend(name, self.config.get(f'{name}_options'), self.metrics)
+                         for name in names}
+    
+    def get_backend(self, file_path):
+        """根据文件格式选择压缩后端"""
+        if self.backend_override:
+            return self.backends[self.backend_override]
+        
+        file_ext = os.path.splitext(file_path)[1].lower()
+        default = self.config.get('backend', 'tinypng')
+        return self.backends[self.config.get('format_backends', {}).get(file_ext, default)]
+    
+    def load_log(self):
+        """加载压缩日志
+        
+        log_store 为 sqlite 时从数据库读取，数据库为空且存在 JSON 日志时先一次性导入；
+        否则读取 JSON 快照并重放 journal 中尚未合并的记录。
+        """
+        self.store = None
+        if self.config.get('log_store', 'json') == 'sqlite':
+            self.store = SQLiteLogStore(self.config.get('log_db', 'compression_log.db'),
+                                        self.config.get('log_db_batch_size', 100),
+                                        self.config.get('log_db_batch_ms', 500))
+            if not self.store.is_empty():
+                self.log_data = self.store.load()
+                # 旧数据库没有汇总统计，或上次运行在检查点之后中途退出
+                if 'summary' not in self.log_data:
+                    self.log_data['summary'] = build_summary(self.log_data['compressed_files'])
+            elif os.path.exists(self.log_file) or os.path.exists(self.journal_file):
+                print(f"正在把 {self.log_file} 导入 SQLite 数据库 {self.store.db_file}...")
+                self.log_data = self.store.import_log(self.read_json_log())
+                # 改名保留作为备份：之后删除数据库重新开始时不会再次导入旧日志
+                for path in (self.log_file, self.journal_file):
+                    if os.path.exists(path):
+                        os.replace(path, path + '.imported')
+                print(f"已导入 {len(self.log_data['compressed_files'])} 条压缩记录"
+                      f"（{self.log_file} 已改名为 {self.log_file}.imported 作为备份）")
+            else:
+                self.discard_stale_indexes()
+                self.log_data = self.store.import_log(self.new_log_data())
+        else:
+            self.log_data = self.read_json_log()
         
         # 修复 API keys 与配置不一致的问题
         self.fix_api_keys_mismatch()
     
+    def discard_stale_indexes(self):
+        """压缩日志不存在（例如为了重新压缩所有图片而删除）时，删除基于旧日志的汇总文件和已完成目录索引
+        
+        否则查看统计仍显示旧的汇总，prune_unchanged_dirs 会跳过上次已完成的目录。
+        """
+        for path in (self.summary_file, self.dir_index_file):
+            if os.path.exists(path):
+                os.remove(path)
+                print(f"提示: 压缩日志不存在，已删除基于旧日志的 {path}")
+    
+    def new_log_data(self):
+        """空的压缩日志"""
+        return {
+            'compressed_files': {},  # 文件哈希 -> 压缩信息
+            'key_usage': {},  # API key 使用计数
+            'key_details': {},  # API key 详细信息（首次使用、最后使用时间等）
+            'current_key_index': 0,
+            'total_compressions': 0,  # 总压缩次数
+            'last_run_time': None,  # 最后运行时间
+            'journal_seq': 0,  # 已合并进快照的最后一条 journal 记录序号
+            'hash_algorithm': self.hash_algorithm,  # compressed_files 键使用的哈希算法
+            'summary': new_summary()  # 增量更新的汇总统计
+        }
+    
+    def read_json_log(self, log_file=None, journal_file=None):
+        """读取 JSON 日志快照，并重放 journal 中尚未合并的压缩记录
+        
+        参数:
+            log_file/journal_file: 读取其他节点的日志（合并时使用），默认为本地日志
+        """
+        own_log = log_file is None
+        log_file = log_file or self.log_file
+        journal_file = journal_file or self.journal_file
+        compact = self.config.get('compact_index', True)
+        if compact and os.path.exists(log_file):
+            log_data = load_compact_log(log_file)
+        elif os.path.exists(log_file):
+            with open(log_file, 'r', encoding='utf-8') as f:
+                log_data = json.load(f)
+        else:
+            log_data = self.new_log_data()
+            if compact:
+                log_data['compressed_files'] = CompactFileTable()
+            if own_log and not os.path.exists(journal_file):
+                self.discard_stale_indexes()
+        
+        # 确保旧版本日志也有新字段
+        if 'key_details' not in log_data:
+            log_data['key_details'] = {}
+        if 'total_compressions' not in log_data:
+            log_data['total_compressions'] = 0
+        if 'last_run_time' not in log_data:
+            log_data['last_run_time'] = None
+        if 'journal_seq' not in log_data:
+            log_data['journal_seq'] = 0
+        if 'summary' not in log_data:
+            # 旧版本日志没有汇总统计，遍历一次生成，之后增量更新
+            log_data['summary'] = build_summary(log_data['compressed_files'])
+        
+        # 重放上次运行中尚未合并进快照的压缩记录
+        for record in read_journal(journal_file):
+            apply_journal_record(log_data, record)
+            if own_log:
+                self.journal_pending += 1
+        return log_data
+    
     def fix_api_keys_mismatch(self):
         """修复日志中的 API keys 与配置文件不一致的问题"""
         config_keys = set(self.config['api_keys'])
@@ -119,259 +622,890 @@ class ImageCompressor:
                         break
     
     def save_log(self):
-        """保存压缩日志"""
-        with open(self.log_file, 'w', encoding='utf-8') as f:
-            json.dump(self.log_data, f, indent=4, ensure_ascii=False)
-    
-    def get_file_hash(self, file_path):
-        """计算文件的MD5哈希值"""
-        md5_hash = hashlib.md5()
-        with open(file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b''):
-                md5_hash.update(chunk)
-        return md5_hash.hexdigest()
-    
-    def set_api_key(self):
-        """设置当前使用的 API key"""
-        if self.current_key_index >= len(self.config['api_keys']):
-            raise Exception("所有 API keys 已用完！")
-        
-        current_key = self.config['api_keys'][self.current_key_index]
-        tinify.key = current_key
-        
-        # 初始化当前 key 的使用计数
-        if current_key not in self.log_data['key_usage']:
-            self.log_data['key_usage'][current_key] = 0
-        
-        # 初始化当前 key 的详细信息
-        if current_key not in self.log_data['key_details']:
-            self.log_data['key_details'][current_key] = {
-                'first_used': datetime.now().isoformat(),
-                'last_used': None,
-                'total_usage': 0
-            }
+        """保存压缩日志快照，并清空已合并进快照的 journal"""
+        if self.store:
+            with self.lock, self.metrics.timer('save_log'):
+                self.store.save(self.log_data)
+                self.journal_pending = 0
+                self.save_hash_index()
+            return
         
-        usage = self.log_data['key_usage'][current_key]
-        max_usage = self.config.get('max_compressions_per_key', 500)
-        remaining = max_usage - usage
+        with self.lock, self.metrics.timer('save_log'):
+            # 汇总文件先于快照写入：即使在两者之间中断，汇总文件也只会比快照新，
+            # 查看统计时重放 journal 会跳过汇总文件中已包含的记录
+            summary_data = {name: value for name, value in self.log_data.items()
+                            if name != 'compressed_files'}
+            temp_path = self.summary_file + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(summary_data, f, indent=4, ensure_ascii=False)
+            os.replace(temp_path, self.summary_file)
+            
+            # 先写临时文件再替换，避免中途被杀死时损坏快照
+            temp_path = self.log_file + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8', newline='\n') as f:
+                # compressed_files 逐条写入，紧凑索引不需要先还原成完整的字典
+                offsets = dump_log(self.log_data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            compressed_files = self.log_data['compressed_files']
+            if offsets is None:
+                os.replace(temp_path, self.log_file)
+            else:
+                # 按需读取的记录来自旧快照，替换前关闭，替换后改为读取新快照
+                compressed_files.close()
+                try:
+                    os.replace(temp_path, self.log_file)
+                except OSError:
+                    compressed_files.reopen()
+                    raise
+                compressed_files.reopen(self.log_file, offsets)
+            
+            # 快照中的 journal_seq 保证即使在这里中断，重放时也不会重复计数
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+            if os.path.exists(self.journal_file):
+                os.remove(self.journal_file)
+            self.journal_pending = 0
+            
+            self.save_hash_index()
+    
+    def append_journal(self, record):
+        """追加一条压缩记录并落盘，达到合并间隔时写入完整快照
+
+        调用方需持有 self.lock。使用 SQLite 存储时不写 journal，
+        而是把这条记录和 key 使用次数写入同一个事务，按 log_db_batch_size /
+        log_db_batch_ms 合并提交，汇总统计同样每隔 journal_compact_interval 条记录写入一次。
+        """
+        if self.store:
+            with self.metrics.timer('journal'):
+                self.store.save(self.log_data, checkpoint=False)
+        else:
+            with self.metrics.timer('journal'):
+                if self.journal is None:
+                    trim_journal_tail(self.journal_file)
+                    self.journal = open(self.journal_file, 'a', encoding='utf-8')
+                self.journal.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
         
-        print(f"正在使用 API key [{self.current_key_index + 1}/{len(self.config['api_keys'])}]")
-        print(f"当前 key 已使用: {usage} 次，剩余: {remaining} 次")
+        self.journal_pending += 1
+        if self.journal_pending >= self.config.get('journal_compact_interval', 1000):
+            self.save_log()
     
-    def switch_api_key(self):
-        """切换到下一个 API key"""
-        self.current_key_index += 1
-        self.log_data['current_key_index'] = self.current_key_index
+    def load_hash_index(self):
+        """加载文件哈希索引（哈希算法与配置不一致时丢弃）"""
+        self.hash_index = {}
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if 'algorithm' not in data:
+                    # 旧版本索引直接保存路径映射，使用 md5
+                    data = {'algorithm': 'md5', 'files': data}
+                if data['algorithm'] == self.hash_algorithm:
+                    self.hash_index = data['files']
+            except ValueError:
+                # 索引只是缓存，损坏时重新建立即可
+                print(f"警告: 哈希索引已损坏，将重新建立: {self.index_file}")
+    
+    def save_hash_index(self):
+        """保存文件哈希索引（随日志快照一起保存）"""
+        if not self.index_dirty:
+            return
+        with self.lock:
+            temp_path = self.index_file + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'algorithm': self.hash_algorithm, 'files': self.hash_index},
+                          f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(temp_path, self.index_file)
+            self.index_dirty = False
+    
+    def lookup_file_hash(self, file_path):
+        """索引中的文件哈希，文件不在索引中或大小、修改时间、inode 有变化时返回 None"""
+        stat = os.stat(file_path)
+        cached = self.hash_index.get(os.path.abspath(file_path))
+        if cached and cached[:3] == [stat.st_size, stat.st_mtime_ns, stat.st_ino]:
+            return cached[3]
+        return None
+    
+    def get_cached_file_hash(self, file_path, data=None):
+        """获取文件哈希，大小、修改时间和 inode 都未变化时直接使用索引中的值
         
-        if self.current_key_index >= len(self.config['api_keys']):
-            raise Exception("所有 API keys 已达到使用上限！")
+        参数:
+            data: 已读入内存的文件内容，索引未命中时直接对其计算哈希
+        """
+        file_hash = self.lookup_file_hash(file_path)
+        if file_hash is not None:
+            return file_hash
         
-        self.set_api_key()
-        print(f"已切换到下一个 API key")
+        stat = os.stat(file_path)
+        signature = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        with self.metrics.timer('hash'):
+            if data is not None:
+                file_hash = hash_bytes(data, self.hash_algorithm)
+            else:
+                file_hash = self.get_file_hash(file_path)
+        with self.lock:
+            self.hash_index[os.path.abspath(file_path)] = signature + [file_hash]
+            self.index_dirty = True
+        return file_hash
     
-    def check_and_switch_key(self):
-        """检查当前 key 使用次数，必要时切换"""
-        current_key = self.config['api_keys'][self.current_key_index]
-        usage = self.log_data['key_usage'][current_key]
-        max_usage = self.config.get('max_compressions_per_key', 500)
+    def get_file_hash(self, file_path):
+        """按配置的哈希算法计算文件的哈希值（默认 MD5）"""
+        return hash_file(file_path, self.hash_algorithm)
+    
+    def migrate_hash_algorithm(self):
+        """hash_algorithm 改变后，把 compressed_files 迁移到新算法
         
-        if usage >= max_usage:
-            print(f"当前 API key 已达到 {max_usage} 次使用上限")
-            self.switch_api_key()
+        源文件仍然存在且内容未变（旧哈希一致）的记录换成新哈希；
+        源文件已不存在的记录保留旧哈希，仅用于统计。
+        """
+        old_algorithm = self.log_data.get('hash_algorithm', 'md5')
+        if old_algorithm == self.hash_algorithm:
+            return
+        
+        print(f"哈希算法由 {old_algorithm} 改为 {self.hash_algorithm}，正在迁移压缩记录...")
+        migrated = 0
+        compact = isinstance(self.log_data['compressed_files'], CompactFileTable)
+        compressed_files = CompactFileTable() if compact else {}
+        for file_hash, entry in self.log_data['compressed_files'].items():
+            new_hash = None
+            # 变体的键为 "<文件哈希>#<变体名>"，只迁移文件哈希部分
+            source_hash, sep, variant = file_hash.partition('#')
+            if hash_algorithm_of(source_hash) == old_algorithm and os.path.exists(entry['source_path']):
+                # 一次读取同时计算新旧两种哈希
+                old_hash, candidate = hash_file_multi(entry['source_path'],
+                                                      [old_algorithm, self.hash_algorithm])
+                if old_hash == source_hash:
+                    new_hash = candidate + sep + variant
+                    # 顺便写入哈希索引，之后的运行不必再读取这些文件
+                    stat = os.stat(entry['source_path'])
+                    self.hash_index[os.path.abspath(entry['source_path'])] = [
+                        stat.st_size, stat.st_mtime_ns, stat.st_ino, candidate
+                    ]
+                    self.index_dirty = True
+            
+            if new_hash:
+                compressed_files[new_hash] = entry
+                migrated += 1
+            else:
+                compressed_files[file_hash] = entry
+        
+        self.log_data['compressed_files'] = compressed_files
+        self.log_data['hash_algorithm'] = self.hash_algorithm
+        self.save_log()
+        print(f"已迁移 {migrated} 条记录，{len(compressed_files) - migrated} 条记录的源文件不存在或已变化，保留旧哈希")
     
-    def resize_image_if_needed(self, image_path):
+    def acquire_key(self, calls=1):
+        """分配一个 key 并占用 calls 次使用额度"""
+        current_key, key_index = self.key_scheduler.acquire(calls)
+        self.current_key_index = key_index
+        return current_key, key_index
+    
+    def release_key(self, key, calls=1):
+        """释放 acquire_key 占用的额度（请求结束后调用）"""
+        self.key_scheduler.release(key, calls)
+    
+    def resize_image_if_needed(self, image_path, source_data):
         """如果需要，对图片进行等比缩放
         
+        缩放后的图片直接编码到内存中，不再写临时文件。
+        多个压缩任务同时进行时在进程池中缩放（见 ResizePool）。
+        
+        参数:
+            image_path: 源文件路径（用于判断输出格式）
+            source_data: 源文件内容
+        
         返回:
-            str: 缩放后的临时文件路径，如果不需要缩放则返回原路径
+            bytes: 缩放后的图片数据，如果不需要缩放则返回原数据
             bool: 是否进行了缩放
         """
         # 检查是否启用缩放功能
         if not self.config.get('enable_resize', False):
-            return image_path, False
+            return source_data, False
         
         max_width = self.config.get('max_width', 1920)
+        resize_mode = self.config.get('resize_mode', 'quality')
+        file_ext = os.path.splitext(image_path)[1].lower()
         
         try:
-            # 打开图片
-            img = Image.open(image_path)
-            original_width, original_height = img.size
-            
-            # 如果宽度不超过最大宽度，不需要缩放
-            if original_width <= max_width:
-                return image_path, False
+            if self.resize_pool:
+                resized_data, original_size, new_size = self.resize_pool.resize(
+                    source_data, file_ext, max_width, resize_mode)
+            else:
+                resized_data, original_size, new_size = resize_image_data(
+                    source_data, file_ext, max_width, resize_mode)
+        except BrokenProcessPool:
+            # 重建进程池后仍然崩溃：不上传未缩放的原图，由 compress_image 记为失败
+            raise
+        except Exception as e:
+            self.emit(f"  警告: 图片缩放失败，将使用原图: {e or type(e).__name__}")
+            return source_data, False
+        
+        # 如果宽度不超过最大宽度，不需要缩放
+        if resized_data is None:
+            return source_data, False
+        
+        self.emit(f"  本地缩放: {original_size[0]}x{original_size[1]} -> {new_size[0]}x{new_size[1]}")
+        return resized_data, True
+    
+    def read_source(self, source_path):
+        """把源文件读入内存"""
+        with self.metrics.timer('read'):
+            with open(source_path, 'rb') as f:
+                source_data = f.read()
+        self.metrics.add_bytes('read', len(source_data))
+        return source_data
+    
+    def compress_image(self, source_path, output_path, source_data=None, skipped_entry=None):
+        """压缩单个图片
+        
+        参数:
+            source_data: process_image 计算哈希时已读入的源文件内容，为 None 时在这里读取
+            skipped_entry: 上次预测跳过时的记录，仍然跳过且输出未变时不再重新生成
+        """
+        try:
+            backend = self.get_backend(source_path)
             
-            # 计算新的尺寸（等比缩放）
-            ratio = max_width / original_width
-            new_width = max_width
-            new_height = int(original_height * ratio)
+            # 确保输出目录存在
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
             
-            print(f"  本地缩放: {original_width}x{original_height} -> {new_width}x{new_height}")
+            # 后端可以直接读写文件时（async 引擎）不把图片读入内存
+            if backend.streams_files:
+                streamed = self.compress_streaming(source_path, output_path, backend)
+                if streamed is not None:
+                    return streamed
             
-            # 缩放图片
-            resized_img = img.resize((new_width, new_height), Image.LANCZOS)
+            # 源文件只读取一次，缩放、上传和哈希都使用这份数据
+            if source_data is None:
+                source_data = self.read_source(source_path)
             
-            # 创建临时文件保存缩放后的图片
-            file_ext = os.path.splitext(image_path)[1].lower()
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=file_ext)
-            temp_path = temp_file.name
-            temp_file.close()
+            # 先进行本地缩放（如果需要）
+            with self.metrics.timer('resize'):
+                upload_data, was_resized = self.resize_image_if_needed(source_path, source_data)
+            file_ext = os.path.splitext(source_path)[1].lower()
             
-            # 保存缩放后的图片，保持原格式和质量
-            if file_ext in ['.jpg', '.jpeg']:
-                resized_img.save(temp_path, 'JPEG', quality=95, optimize=True)
-            elif file_ext == '.png':
-                resized_img.save(temp_path, 'PNG', optimize=True)
-            elif file_ext == '.webp':
-                resized_img.save(temp_path, 'WEBP', quality=95)
-            else:
-                resized_img.save(temp_path)
+            # 缩放后的图片是重新编码的，总能压缩，只预测未缩放的图片
+            prediction = None
+            status = None
+            if self.predictor and backend.uses_api_key and not was_resized:
+                predicted_backend, prediction = self.predict_savings(source_path, source_data, file_ext, backend)
+                if predicted_backend is not backend:
+                    backend, status = predicted_backend, SKIPPED
+                    if (skipped_entry and skipped_entry.get('output_path') == output_path
+                            and self.output_matches(output_path, skipped_entry)):
+                        self.emit(f"[跳过] 仍预计节省太少，保留上次的输出: {os.path.basename(source_path)}")
+                        return True
             
-            img.close()
-            resized_img.close()
+            def attempt(current_key, key_index):
+                # 压缩图片（使用缩放后的数据或原数据）
+                output_data, compression_count = backend.compress(upload_data, file_ext, current_key)
+                with self.metrics.timer('write'):
+                    write_output(output_path, output_data)
+                self.metrics.add_bytes('written', len(output_data))
+                
+                self.record_compression(source_path, output_path, len(source_data), len(output_data),
+                                        backend, current_key, key_index, compression_count,
+                                        prediction, source_data, output_data=output_data, status=status)
             
-            return temp_path, True
+            return self.call_backend(source_path, backend, attempt)
             
         except Exception as e:
-            print(f"  警告: 图片缩放失败，将使用原图: {e}")
-            return image_path, False
+            return self.report_failure(source_path, e)
     
-    def is_compressed(self, file_path):
-        """检查文件是否已压缩"""
-        file_hash = self.get_file_hash(file_path)
-        return file_hash in self.log_data['compressed_files']
+    def report_failure(self, source_path, error):
+        """输出压缩失败的原因并记录到失败列表，返回 False"""
+        if isinstance(error, tinify.AccountError):
+            self.emit(f"[错误] API key 错误: {error}")
+            self.record_failure(source_path, error)
+        elif isinstance(error, tinify.ClientError):
+            self.emit(f"[错误] 请求错误: {error}")
+            self.record_failure(source_path, error)
+        elif isinstance(error, tinify.ServerError):
+            self.emit(f"[错误] 服务器错误: {error}")
+            self.record_failure(source_path, error, transient=True)
+        elif isinstance(error, tinify.ConnectionError):
+            self.emit(f"[错误] 连接错误: {error}")
+            self.record_failure(source_path, error, transient=True)
+        else:
+            self.emit(f"[失败] 压缩失败: {source_path}")
+            self.emit(f"  错误: {error}")
+            self.record_failure(source_path, error)
+        return False
     
-    def compress_image(self, source_path, output_path):
-        """压缩单个图片"""
-        temp_file_to_delete = None
+    def compress_variants(self, source_path, variants, source_data=None):
+        """解码一次源图片，生成缺少的变体并同时压缩
+        
+        参数:
+            source_data: 与 compress_image 相同
+        
+        返回:
+            bool: 所有变体是否都压缩成功
+        """
         try:
-            # 检查并切换 key
-            self.check_and_switch_key()
+            if source_data is None:
+                source_data = self.read_source(source_path)
             
-            # 确保输出目录存在
+            file_ext = os.path.splitext(source_path)[1].lower()
+            output_paths = [self.variant_output_path(source_path, variant) for variant in variants]
+            specs = [(variant['max_width'], os.path.splitext(path)[1].lower())
+                     for variant, path in zip(variants, output_paths)]
+            resize_mode = self.config.get('resize_mode', 'quality')
+            with self.metrics.timer('resize'):
+                if self.resize_pool:
+                    rendered = self.resize_pool.render(source_data, file_ext, specs, resize_mode)
+                else:
+                    rendered = render_variants(source_data, file_ext, specs, resize_mode)
+        except Exception as e:
+            return self.report_failure(source_path, e)
+        
+        self.emit("  生成变体: " + ", ".join(f"{variant['name']} ({width}x{height})"
+                                             for variant, (_, (width, height)) in zip(variants, rendered)))
+        # 各变体单独分配 key、重试和记录，一个变体失败不影响其他变体
+        lines = getattr(self.output_local, 'lines', None)
+        futures = [self.variant_executor.submit(self.compress_variant, source_path, output_path,
+                                                variant['name'], data or source_data, source_data, lines)
+                   for variant, output_path, (data, _) in zip(variants, output_paths, rendered)]
+        return all([future.result() for future in futures])
+    
+    def compress_variant(self, source_path, output_path, variant, upload_data, source_data, lines=None):
+        """压缩一个已生成的变体并记录
+        
+        参数:
+            lines: 所属图片的输出（见 image_output），为 None 时直接输出
+        """
+        if lines is not None:
+            with self.image_output(lines):
+                return self.compress_variant(source_path, output_path, variant, upload_data, source_data)
+        try:
             os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            # 按输出格式选择后端（例如 WebP 变体可以交给 local 后端）
+            backend = self.get_backend(output_path)
+            file_ext = os.path.splitext(output_path)[1].lower()
             
-            # 先进行本地缩放（如果需要）
-            process_path, was_resized = self.resize_image_if_needed(source_path)
-            if was_resized:
-                temp_file_to_delete = process_path
-            
-            # 压缩图片（使用缩放后的文件或原文件）
-            source = tinify.from_file(process_path)
-            source.to_file(output_path)
+            def attempt(current_key, key_index):
+                output_data, compression_count = backend.compress(upload_data, file_ext, current_key)
+                with self.metrics.timer('write'):
+                    write_output(output_path, output_data)
+                self.metrics.add_bytes('written', len(output_data))
+                self.record_compression(source_path, output_path, len(source_data), len(output_data),
+                                        backend, current_key, key_index, compression_count,
+                                        source_data=source_data, variant=variant,
+                                        output_data=output_data)
             
-            # 更新使用计数
-            current_key = self.config['api_keys'][self.current_key_index]
-            self.log_data['key_usage'][current_key] += 1
-            self.log_data['total_compressions'] += 1
+            return self.call_backend(source_path, backend, attempt)
+        except Exception as e:
+            return self.report_failure(source_path, e)
+    
+    def compress_streaming(self, source_path, output_path, backend):
+        """上传直接读取源文件，下载直接写入输出文件
+        
+        只读取图片头部判断是否需要缩放和预测压缩率。需要本地缩放（未开启
+        resize_on_server）、无法识别图片或预测跳过时返回 None，由 compress_image
+        按原有方式读入内存处理。
+        """
+        file_ext = os.path.splitext(source_path)[1].lower()
+        original_size = os.path.getsize(source_path)
+        enable_resize = self.config.get('enable_resize', False)
+        features = None
+        if enable_resize or self.predictor:
+            features = header_features(source_path, original_size, file_ext)
+            if features is None:
+                return None
+        
+        resize_width = None
+        if enable_resize:
+            max_width = self.config.get('max_width', 1920)
+            if features['width'] > max_width:
+                if not self.config.get('resize_on_server', False):
+                    return None
+                resize_width = max_width
+        
+        # 与 compress_image 相同，只预测不缩放的图片
+        prediction = None
+        if self.predictor and resize_width is None:
+            skip, predicted, samples = self.predictor.should_skip(features)
+            if skip:
+                return None
+            prediction = (features, predicted, samples)
+        
+        if resize_width:
+            new_height = int(features['height'] * resize_width / features['width'])
+            self.emit(f"  服务器端缩放: {features['width']}x{features['height']} -> {resize_width}x{new_height}")
+        
+        def attempt(current_key, key_index):
+            compressed_size, compression_count = backend.compress_file(
+                source_path, output_path, current_key, resize_width)
+            self.metrics.add_bytes('written', compressed_size)
+            self.record_compression(source_path, output_path, original_size, compressed_size,
+                                    backend, current_key, key_index, compression_count, prediction,
+                                    api_calls=2 if resize_width else 1)
+        
+        return self.call_backend(source_path, backend, attempt, calls=2 if resize_width else 1)
+    
+    def call_backend(self, source_path, backend, attempt, calls=1):
+        """分配 key 后执行 attempt(key, key_index)，处理 key 停用和暂时性错误重试
+        
+        attempt 在占用 key 额度期间执行，需要完成压缩、写入输出和记录，
+        这样记录的使用次数在释放额度之前就已更新，并发时不会超出上限。
+        熔断期间在 breaker.call 中等待。
+        
+        参数:
+            calls: 每次尝试消耗的 API 次数（服务器端缩放为 2），按此占用 key 的额度
+        """
+        attempt_count = 0
+        while True:
+            current_key, key_index = None, None
+            retry_delay = None
+            if backend.uses_api_key:
+                # 分配 key，占用本次请求消耗的额度
+                current_key, key_index = self.acquire_key(calls)
+            try:
+                self.breaker.call(attempt, current_key, key_index)
+                return True
+            except tinify.AccountError as e:
+                if current_key is None:
+                    raise
+                # key 无效或本月额度已用完：停用该 key，换一个 key 重试这张图片
+                self.key_scheduler.retire(current_key, e)
+                self.emit(f"[警告] API key [{key_index + 1}] 不可用，已停用并换一个 key 重试: {e}")
+            except TRANSIENT_ERRORS as e:
+                attempt_count += 1
+                if attempt_count >= self.retry_policy.max_attempts:
+                    raise
+                retry_delay = self.retry_policy.delay(attempt_count)
+                self.emit(f"[重试] {os.path.basename(source_path)}: {e}，"
+                           f"{retry_delay:.1f} 秒后第 {attempt_count} 次重试")
+            finally:
+                if current_key is not None:
+                    self.release_key(current_key, calls)
             
-            # 更新 key 详细信息
-            current_time = datetime.now().isoformat()
-            if current_key not in self.log_data['key_details']:
-                self.log_data['key_details'][current_key] = {
-                    'first_used': current_time,
-                    'last_used': current_time,
-                    'total_usage': 1
-                }
+            # 等待期间不占用 key 的额度
+            if retry_delay is not None:
+                time.sleep(retry_delay)
+    
+    def predict_savings(self, source_path, source_data, file_ext, backend):
+        """预测压缩率，低于 skip_min_savings 时改用 skip_backend
+        
+        返回:
+            实际使用的后端
+            tuple: (特征, 预计压缩率, 样本数)，跳过或无法预测时为 None
+        """
+        features = image_features(source_data, file_ext)
+        if features is None:
+            return backend, None
+        
+        skip, predicted, samples = self.predictor.should_skip(features)
+        if not skip:
+            return backend, (features, predicted, samples)
+        
+        self.predictor.log_decision(source_path, features, predicted, samples, 'skip')
+        self.metrics.increment('predicted_skip')
+        self.emit(f"  预计只能节省 {predicted:.1f}%，不调用 API（{self.skip_backend.name}）")
+        return self.skip_backend, None
+    
+    def record_compression(self, source_path, output_path, original_size, compressed_size,
+                           backend, current_key, key_index, compression_count, prediction=None,
+                           source_data=None, api_calls=1, variant=None, output_data=None, status=None):
+        """记录一次成功的压缩并输出结果
+        
+        参数:
+            prediction: 上传前的压缩率预测，用实际结果更新预测统计
+            source_data: 已读入内存的源文件内容（用于计算哈希），为 None 时读取文件
+            api_calls: 消耗的 API 次数（服务器端缩放为 2）
+            variant: 变体名，变体以 "<文件哈希>#<变体名>" 单独记录
+            output_data: 已写入的输出内容（用于计算输出的哈希），为 None 时读取输出文件
+            status: 预测跳过时为 SKIPPED，不计入压缩统计，之后的运行重新预测
+        """
+        # 记录压缩信息（process_image 已计算过哈希，这里直接命中索引）
+        file_hash = self.get_cached_file_hash(source_path, source_data)
+        if variant:
+            file_hash = variant_key(file_hash, variant)
+        compression_ratio = (1 - compressed_size / original_size) * 100
+        # 输出的哈希：复用结果前确认输出文件没有被之后的压缩覆盖
+        with self.metrics.timer('hash'):
+            if output_data is not None:
+                output_hash = hash_bytes(output_data, self.hash_algorithm)
             else:
-                self.log_data['key_details'][current_key]['last_used'] = current_time
-                self.log_data['key_details'][current_key]['total_usage'] = self.log_data['key_usage'][current_key]
-            
-            # 记录压缩信息
-            file_hash = self.get_file_hash(source_path)
-            original_size = os.path.getsize(source_path)
-            compressed_size = os.path.getsize(output_path)
-            compression_ratio = (1 - compressed_size / original_size) * 100
-            
-            self.log_data['compressed_files'][file_hash] = {
-                'source_path': source_path,
-                'output_path': output_path,
-                'original_size': original_size,
-                'compressed_size': compressed_size,
-                'compression_ratio': f"{compression_ratio:.2f}%",
-                'compressed_at': current_time,
-                'api_key_index': self.current_key_index,
-                'api_key_used': current_key[:20] + "..."  # 只保存 key 的前20个字符用于识别
+                output_hash = hash_file(output_path, self.hash_algorithm)
+        
+        if prediction:
+            features, predicted, samples = prediction
+            self.predictor.learn(features, compression_ratio)
+            self.predictor.log_decision(source_path, features, predicted, samples, 'compress',
+                                        compression_ratio)
+        
+        with self.lock:
+            record = {
+                'seq': self.log_data['journal_seq'] + 1,
+                'hash': file_hash,
+                'key': current_key,
+                # API 返回的该 key 已压缩次数，用于同步本地计数
+                'compression_count': compression_count,
+                'calls': api_calls,
+                'entry': {
+                    'source_path': source_path,
+                    'output_path': output_path,
+                    'original_size': original_size,
+                    'compressed_size': compressed_size,
+                    'compression_ratio': f"{compression_ratio:.2f}%",
+                    'compressed_at': datetime.now().isoformat(),
+                    'api_key_index': key_index,
+                    # 只保存 key 的前20个字符用于识别
+                    'api_key_used': current_key[:20] + "..." if current_key else None,
+                    'backend': backend.name,
+                    'output_hash': output_hash
+                }
             }
+            if variant:
+                record['entry']['variant'] = variant
+            if status:
+                record['entry']['status'] = status
+            if current_key and api_calls != 1:
+                # 重建汇总统计（build_summary）时使用
+                record['entry']['api_calls'] = api_calls
+            apply_journal_record(self.log_data, record)
             
-            # 保存日志（每次压缩后立即保存，确保断点续传数据准确）
-            self.save_log()
+            # 追加写入 journal（每次压缩后立即落盘，确保断点续传数据准确）
+            self.append_journal(record)
             
             # 计算当前 key 剩余次数
-            max_usage = self.config.get('max_compressions_per_key', 500)
-            remaining = max_usage - self.log_data['key_usage'][current_key]
-            
-            print(f"[OK] 压缩成功: {os.path.basename(source_path)}")
-            print(f"  原始大小: {original_size / 1024:.2f} KB")
-            print(f"  压缩后: {compressed_size / 1024:.2f} KB")
-            print(f"  压缩率: {compression_ratio:.2f}%")
-            print(f"  当前 Key 剩余次数: {remaining}")
-            
-            # 清理临时文件
-            if temp_file_to_delete and os.path.exists(temp_file_to_delete):
-                try:
-                    os.unlink(temp_file_to_delete)
-                except:
-                    pass
-            
-            return True
-            
-        except tinify.AccountError as e:
-            print(f"[错误] API key 错误: {e}")
-            if temp_file_to_delete and os.path.exists(temp_file_to_delete):
-                try:
-                    os.unlink(temp_file_to_delete)
-                except:
-                    pass
-            return False
-        except tinify.ClientError as e:
-            print(f"[错误] 请求错误: {e}")
-            if temp_file_to_delete and os.path.exists(temp_file_to_delete):
-                try:
-                    os.unlink(temp_file_to_delete)
-                except:
-                    pass
-            return False
-        except tinify.ServerError as e:
-            print(f"[错误] 服务器错误: {e}")
-            if temp_file_to_delete and os.path.exists(temp_file_to_delete):
-                try:
-                    os.unlink(temp_file_to_delete)
-                except:
-                    pass
+            if current_key:
+                max_usage = self.config.get('max_compressions_per_key', 500)
+                remaining = max_usage - self.log_data['key_usage'][current_key]
+                usage_line = f"  当前 Key 剩余次数: {remaining}"
+            else:
+                usage_line = f"  压缩后端: {backend.name}（不消耗 API 次数）"
+        
+        name = os.path.basename(source_path) + (f" [{variant}]" if variant else "")
+        self.emit(f"[OK] 压缩成功: {name}\n"
+                   f"  原始大小: {original_size / 1024:.2f} KB\n"
+                   f"  压缩后: {compressed_size / 1024:.2f} KB\n"
+                   f"  压缩率: {compression_ratio:.2f}%\n"
+                   f"{usage_line}")
+    
+    def get_scan_filters(self):
+        """扫描规则，规则变化后上次记录的已完成目录不再可信
+        
+        变体也包含在内：新增变体后已完成的目录中的图片仍需要生成新的变体。
+        分片运行时目录只对本分片的图片算完成，分片设置不同时同样不可信。
+        """
+        return [
+            sorted(self.config.get('supported_formats', ['.jpg', '.jpeg', '.png', '.webp'])),
+            self.config.get('include', []),
+            self.config.get('exclude', []),
+            self.variants,
+            list(self.shard) if self.shard else None
+        ]
+    
+    def load_dir_index(self):
+        """加载已完成目录索引"""
+        self.dir_index = {}
+        if os.path.exists(self.dir_index_file):
+            try:
+                with open(self.dir_index_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('filters') == self.get_scan_filters():
+                    self.dir_index = data.get('dirs', {})
+            except ValueError:
+                print(f"警告: 目录索引已损坏，将重新建立: {self.dir_index_file}")
+    
+    def save_dir_index(self, failed_paths):
+        """记录本次全部处理完成的目录
+        
+        有失败图片、扫描出错或预测跳过的图片的目录及其所有上级目录都不算完成。
+        """
+        incomplete = set()
+        for path in failed_paths:
+            directory = os.path.dirname(os.path.abspath(path))
+            while directory in self.scanned_dirs and directory not in incomplete:
+                incomplete.add(directory)
+                directory = os.path.dirname(directory)
+        
+        for directory, record in self.scanned_dirs.items():
+            if directory in incomplete:
+                self.dir_index.pop(directory, None)
+            else:
+                self.dir_index[directory] = record
+        
+        temp_path = self.dir_index_file + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'filters': self.get_scan_filters(), 'dirs': self.dir_index},
+                      f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_path, self.dir_index_file)
+    
+    def count_unchanged_images(self, directory):
+        """目录在上次运行中已全部完成且至今未变化时，返回其中的图片数，否则返回 None
+        
+        新增、删除、重命名文件都会改变所在目录的修改时间，
+        因此只需要比较目录及所有子目录的修改时间，不用列出文件。
+        """
+        record = self.dir_index.get(directory)
+        if record is None:
+            return None
+        mtime_ns, children, image_count = record
+        try:
+            if os.stat(directory).st_mtime_ns != mtime_ns:
+                return None
+        except OSError:
+            return None
+        
+        for child in children:
+            child_count = self.count_unchanged_images(child)
+            if child_count is None:
+                return None
+            image_count += child_count
+        return image_count
+    
+    def accept_path(self, rel_path, is_dir=False):
+        """按 supported_formats/include/exclude 判断是否处理该路径
+        
+        参数:
+            rel_path: 相对 source_folder 的路径，使用 / 分隔
+            is_dir: 是否为目录（目录只检查 exclude）
+        """
+        if any(fnmatch.fnmatch(rel_path, pattern) for pattern in self.config.get('exclude', [])):
             return False
-        except tinify.ConnectionError as e:
-            print(f"[错误] 连接错误: {e}")
-            if temp_file_to_delete and os.path.exists(temp_file_to_delete):
-                try:
-                    os.unlink(temp_file_to_delete)
-                except:
-                    pass
+        if is_dir:
+            return True
+        
+        supported_formats = self.config.get('supported_formats', ['.jpg', '.jpeg', '.png', '.webp'])
+        if os.path.splitext(rel_path)[1].lower() not in supported_formats:
             return False
-        except Exception as e:
-            print(f"[失败] 压缩失败: {source_path}")
-            print(f"  错误: {e}")
-            if temp_file_to_delete and os.path.exists(temp_file_to_delete):
+        include = self.config.get('include', [])
+        return not include or any(fnmatch.fnmatch(rel_path, pattern) for pattern in include)
+    
+    def iter_images(self, folder):
+        """用 os.scandir 逐个目录扫描，边扫描边产出图片路径
+        
+        - include: 只处理匹配的图片（相对 folder 的路径，glob 规则）
+        - exclude: 跳过匹配的图片和目录
+        - prune_unchanged_dirs: 跳过上次已全部完成且未变化的目录
+        """
+        prune = self.config.get('prune_unchanged_dirs', False)
+        
+        # (目录路径, 相对路径, 修改时间)
+        stack = [(folder, '', os.stat(folder).st_mtime_ns)]
+        while stack:
+            directory, rel_dir, mtime_ns = stack.pop()
+            abs_dir = os.path.abspath(directory)
+            children = []
+            image_count = 0
+            subdirs = []
+            
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        rel_path = rel_dir + entry.name
+                        
+                        if entry.is_dir():
+                            # 与 os.walk 一致，不进入符号链接指向的目录
+                            if entry.is_symlink() or not self.accept_path(rel_path, is_dir=True):
+                                continue
+                            abs_subdir = os.path.abspath(entry.path)
+                            children.append(abs_subdir)
+                            
+                            if prune:
+                                unchanged = self.count_unchanged_images(abs_subdir)
+                                if unchanged is not None:
+                                    self.pruned_dirs += 1
+                                    self.pruned_images += unchanged
+                                    continue
+                            subdirs.append((entry.path, rel_path + '/', entry.stat().st_mtime_ns))
+                            continue
+                        
+                        if not self.accept_path(rel_path):
+                            continue
+                        if not self.in_shard(entry.path):
+                            self.other_shard_images += 1
+                            continue
+                        
+                        image_count += 1
+                        yield entry.path
+            except OSError as e:
+                # 与 os.walk 一致，无法读取的目录直接跳过，但不记为已完成
+                print(f"警告: 无法读取目录: {directory} ({e})")
+                self.scan_failed_dirs.append(directory)
+                continue
+            
+            self.scanned_dirs[abs_dir] = [mtime_ns, children, image_count]
+            # 倒序入栈，保持与 os.walk 相同的先后顺序
+            stack.extend(reversed(subdirs))
+    
+    def start_scan(self, folder):
+        """在后台线程中扫描图片，返回有界的工作队列
+        
+        队列中依次放入 (序号, 图片路径)，扫描结束时放入 None。
+        队列满时扫描线程会等待，内存占用不随图片总数增长。
+        """
+        work_queue = queue.Queue(maxsize=self.config.get('scan_queue_size', 1000))
+        self.reset_scan_state()
+        
+        def scan():
+            # 只统计列目录的时间，不含队列满时等待处理线程的时间
+            scan_time = 0.0
+            images = self.iter_images(folder)
+            try:
+                with self.profile_thread():
+                    while True:
+                        start = time.perf_counter()
+                        image_path = next(images, None)
+                        scan_time += time.perf_counter() - start
+                        if image_path is None:
+                            break
+                        self.discovered += 1
+                        work_queue.put((self.discovered, image_path))
+                self.scan_finished = True
+            finally:
+                self.metrics.observe('scan', scan_time)
+                work_queue.put(None)
+        
+        threading.Thread(target=scan, daemon=True).start()
+        return work_queue
+    
+    def reset_scan_state(self):
+        """重置扫描进度和目录记录"""
+        self.discovered = 0
+        self.scan_finished = False
+        self.scanned_dirs = {}
+        self.scan_failed_dirs = []
+        self.pruned_dirs = 0
+        self.pruned_images = 0
+        # 分片运行时扫描到的属于其他节点的图片数
+        self.other_shard_images = 0
+    
+    def pending_api_outputs(self, file_path, has_log=True):
+        """处理这张图片还需要调用 API 压缩的输出数：未压缩为 1，
+        启用 variants 时为尚未压缩、且使用 API key 的后端的变体数，已全部压缩时为 0
+        
+        哈希索引命中（文件未变化）时不读取文件内容；未命中时计算哈希并写入索引，
+        处理时不再重复计算。
+        
+        参数:
+            has_log: 日志中是否有压缩记录，没有时不需要计算哈希
+        """
+        if self.variants:
+            outputs = [(variant['name'], self.variant_output_path(file_path, variant))
+                       for variant in self.variants]
+        else:
+            outputs = [(None, file_path)]
+        outputs = [(name, path) for name, path in outputs if self.get_backend(path).uses_api_key]
+        if not outputs:
+            return 0
+        
+        file_hash = self.lookup_file_hash(file_path)
+        if file_hash is None:
+            if not has_log:
+                return len(outputs)
+            file_hash = self.get_cached_file_hash(file_path)
+        compressed_files = self.log_data['compressed_files']
+        pending = 0
+        for name, _ in outputs:
+            key = variant_key(file_hash, name) if name else file_hash
+            if key not in compressed_files:
+                pending += 1
+            elif not name and is_skipped(compressed_files[key]):
+                # 上次预测跳过，需要重新预测
+                pending += 1
+        return pending
+    
+    def start_plan(self, folder, dry_run=False):
+        """先扫描全部图片，按预计节省的字节数安排 API 调用，额度不足时只处理最值得压缩的图片
+        
+        只读取文件状态和图片头部；哈希索引中没有的图片需要计算哈希，确认是否已经压缩过
+        （例如移动过的文件），已压缩的图片不占用额度。
+        不消耗额度的图片（已压缩、本地后端、预测跳过）排在最前面，
+        其余图片按每次调用预计节省从大到小排列，超出剩余额度的推迟到以后处理。
+        启用 variants 时每个尚未压缩的变体各消耗一次额度。
+        
+        返回:
+            queue.Queue: 工作队列，dry_run 时只输出计划，返回 None
+        """
+        self.reset_scan_state()
+        max_width = self.config.get('max_width', 1920) if self.config.get('enable_resize', False) else None
+        free = []
+        candidates = []
+        has_log = len(self.log_data['compressed_files']) > 0
+        # 变体在本地缩放，不使用服务器端缩放
+        server_resize = bool(max_width and self.config.get('resize_on_server', False) and not self.variants)
+        with self.metrics.timer('plan'):
+            for path in self.iter_images(folder):
+                self.discovered += 1
                 try:
-                    os.unlink(temp_file_to_delete)
-                except:
-                    pass
-            return False
+                    stat = os.stat(path)
+                    if self.shard and self.shard[2] == 'content' and not self.in_shard(
+                            path, self.get_cached_file_hash(path)):
+                        self.other_shard_images += 1
+                        continue
+                    pending = self.pending_api_outputs(path, has_log)
+                except OSError:
+                    # 交给处理线程记录失败
+                    free.append(path)
+                    continue
+                if not pending:
+                    free.append(path)
+                    continue
+                item = estimate_item(path, stat.st_size, self.predictor, max_width)
+                item.cost = pending
+                if item.resized and server_resize and self.get_backend(path).streams_files:
+                    # 服务器端缩放（async 引擎）计为两次（压缩 + 缩放）
+                    item.cost *= 2
+                if (self.predictor and not item.resized and item.predicted is not None
+                        and item.predicted < self.predictor.min_savings):
+                    free.append(path)
+                    continue
+                candidates.append(item)
+        self.scan_finished = True
+        
+        quota = self.key_scheduler.available()
+        selected, deferred = select_by_savings(candidates, quota)
+        self.print_plan(free, candidates, selected, deferred, quota, dry_run)
+        if dry_run:
+            return None
+        
+        self.deferred_paths = [item.path for item in deferred]
+        work_queue = queue.Queue()
+        for i, path in enumerate(free + [item.path for item in selected], 1):
+            work_queue.put((i, path))
+        work_queue.put(None)
+        self.discovered = len(free) + len(selected)
+        return work_queue
     
-    def get_all_images(self, folder):
-        """递归获取文件夹中的所有图片"""
-        images = []
-        supported_formats = self.config.get('supported_formats', ['.jpg', '.jpeg', '.png', '.webp'])
+    def print_plan(self, free, candidates, selected, deferred, quota, dry_run=False):
+        """输出压缩计划和预计节省的空间"""
+        def mb(n):
+            return f"{n / 1024 / 1024:.2f} MB"
         
-        for root, dirs, files in os.walk(folder):
-            for file in files:
-                file_path = os.path.join(root, file)
-                ext = os.path.splitext(file)[1].lower()
-                
-                if ext in supported_formats:
-                    images.append(file_path)
+        print("\n" + "="*60)
+        print("压缩计划（按预计节省空间排序）")
+        print("="*60)
+        print(f"图片总数: {len(free) + len(candidates)}")
+        print(f"不消耗额度: {len(free)} 个（已压缩、本地后端或预测跳过）")
+        print(f"需要调用 API: {len(candidates)} 个（{plan_totals(candidates)['calls']} 次），"
+              f"剩余额度: {quota} 次")
+        
+        planned = plan_totals(selected)
+        print(f"本次压缩: {planned['files']} 个，预计节省 {mb(planned['expected_saved_bytes'])}"
+              f"（{planned['expected_saved_percent']:.1f}%）")
+        if deferred:
+            postponed = plan_totals(deferred)
+            # 不做规划时，额度会用在扫描顺序的前几个图片上
+            in_scan_order = plan_totals(take_in_order(candidates, quota))
+            print(f"推迟处理: {postponed['files']} 个，预计可节省 {mb(postponed['expected_saved_bytes'])}")
+            print(f"按扫描顺序使用同样额度预计节省 {mb(in_scan_order['expected_saved_bytes'])}")
+        if planned['calls']:
+            print(f"平均每次调用预计节省 {planned['expected_saved_bytes'] / planned['calls'] / 1024:.1f} KB")
         
-        return images
+        if dry_run:
+            limit = self.config.get('plan_report_limit', 20)
+            if selected:
+                print(f"\n预计节省最多的 {min(limit, len(selected))} 个图片:")
+                for item in selected[:limit]:
+                    predicted = f"{item.predicted:.1f}%" if item.predicted is not None else "?"
+                    print(f"  {item.expected_saved / 1024:>10.1f} KB  {predicted:>6}  {item.path}")
+            print("\n（--plan-dry-run 只输出计划，没有压缩任何图片）")
+        print("="*60)
     
     def get_output_path(self, source_path):
         """根据源文件路径生成输出路径，保持目录结构"""
@@ -394,6 +1528,11 @@ class ImageCompressor:
         print("="*60)
         
         max_usage = self.config.get('max_compressions_per_key', 500)
+        if self.node_quota is not None:
+            # 分片运行时显示本节点的使用次数和预留额度
+            max_usage = self.node_quota
+            print(f"分片 {self.shard[0]}/{self.shard[1]}：使用次数只计本节点，每个 key 预留 {max_usage} 次")
+        reported_usage = self.log_data.get('key_reported_usage', {})
         
         for i, key in enumerate(self.config['api_keys'], 1):
             usage = self.log_data['key_usage'].get(key, 0)
@@ -413,6 +1552,10 @@ class ImageCompressor:
             print(f"  使用: {usage} / {max_usage} ({percentage:.1f}%)")
             print(f"  进度: [{bar}]")
             print(f"  剩余: {remaining} 次")
+            if self.node_quota is not None and key in reported_usage:
+                print(f"  API 返回的总次数: {reported_usage[key]}")
+            if key in self.key_scheduler.retired:
+                print(f"  状态: 本次运行已停用（{self.key_scheduler.retired[key]}）")
             
             # 如果有详细信息，显示首次和最后使用时间
             if key in self.log_data.get('key_details', {}):
@@ -431,8 +1574,190 @@ class ImageCompressor:
             print(f"上次运行时间: {last_run}")
         print("="*60 + "\n")
     
-    def run(self):
-        """执行批量压缩"""
+    def process_image(self, i, image_path):
+        """处理单个图片：检查是否已压缩，未压缩则压缩
+        
+        返回:
+            str: 'compressed'、'deduplicated'、'skipped'、'predicted_skip'、'failed' 或 'other_shard'
+        """
+        # 扫描时已按路径分片，这里处理监视模式的路径和按内容分片
+        if not self.in_shard(image_path):
+            return 'other_shard'
+        
+        discovered = f"已发现 {self.discovered}" if not self.scan_finished else f"{self.discovered}"
+        self.emit(f"\n[{i}/{discovered}] 处理: {image_path}")
+        
+        # 哈希索引未命中时源文件需要读取一次计算哈希，压缩时直接使用这份数据，不再读取第二次；
+        # 可以流式上传的后端（async 引擎）分块计算哈希，不把图片读入内存
+        source_data = None
+        file_hash = self.lookup_file_hash(image_path)
+        if file_hash is None:
+            if self.variants or not self.get_backend(image_path).streams_files:
+                source_data = self.read_source(image_path)
+            file_hash = self.get_cached_file_hash(image_path, source_data)
+        if not self.in_shard(image_path, file_hash):
+            self.emit(f"[跳过] 属于其他分片: {os.path.basename(image_path)}")
+            return 'other_shard'
+        if self.variants:
+            return self.process_variants(image_path, file_hash, source_data)
+        
+        # 获取输出路径
+        output_path = self.get_output_path(image_path)
+        
+        # 检查是否已压缩
+        with self.lock:
+            # 相同内容的图片正在被其他线程压缩，等它完成后直接复用结果
+            while file_hash in self.pending_hashes:
+                self.lock.wait()
+            entry = self.log_data['compressed_files'].get(file_hash)
+            skipped_entry = None
+            if entry is not None and is_skipped(entry):
+                # 上次预测跳过，没有压缩；样本增加后预测可能改变，重新判断
+                skipped_entry, entry = entry, None
+            if entry is None:
+                self.pending_hashes.add(file_hash)
+        
+        if entry is not None:
+            result = self.reuse_compressed(image_path, output_path, file_hash, entry)
+            if result is not None:
+                return result
+            with self.lock:
+                while file_hash in self.pending_hashes:
+                    self.lock.wait()
+                self.pending_hashes.add(file_hash)
+        
+        # 压缩图片
+        try:
+            success = self.compress_image(image_path, output_path, source_data, skipped_entry)
+        finally:
+            with self.lock:
+                self.pending_hashes.discard(file_hash)
+                self.lock.notify_all()
+        
+        if not success:
+            return 'failed'
+        entry = self.log_data['compressed_files'].get(file_hash)
+        return 'predicted_skip' if entry is not None and is_skipped(entry) else 'compressed'
+    
+    def process_variants(self, image_path, file_hash, source_data=None):
+        """启用 variants 时处理单个图片：已压缩的变体复用，缺少的变体一起生成
+        
+        参数:
+            source_data: 计算哈希时已读入的源文件内容
+        
+        返回:
+            str: 与 process_image 相同
+        """
+        with self.lock:
+            # 相同内容的图片正在被其他线程处理，等它完成后直接复用结果
+            while file_hash in self.pending_hashes:
+                self.lock.wait()
+            entries = {variant['name']: self.log_data['compressed_files'].get(
+                variant_key(file_hash, variant['name'])) for variant in self.variants}
+            missing = [variant for variant in self.variants if entries[variant['name']] is None]
+            if missing:
+                self.pending_hashes.add(file_hash)
+        
+        results = []
+        stale = []
+        for variant in self.variants:
+            entry = entries[variant['name']]
+            output_path = self.variant_output_path(image_path, variant)
+            if entry is not None and not os.path.exists(output_path):
+                result = self.reuse_compressed(image_path, output_path,
+                                               variant_key(file_hash, variant['name']), entry)
+                if result is None:
+                    stale.append(variant)
+                else:
+                    results.append(result)
+        if stale:
+            # 已有结果被覆盖的变体重新压缩
+            with self.lock:
+                if not missing:
+                    while file_hash in self.pending_hashes:
+                        self.lock.wait()
+                    self.pending_hashes.add(file_hash)
+            missing = [variant for variant in self.variants if variant in missing or variant in stale]
+        if not missing:
+            if not results:
+                self.emit(f"[跳过] 跳过（{len(self.variants)} 个变体均已压缩）: {os.path.basename(image_path)}")
+            return 'deduplicated' if 'deduplicated' in results else 'skipped'
+        
+        try:
+            success = self.compress_variants(image_path, missing, source_data)
+        finally:
+            with self.lock:
+                self.pending_hashes.discard(file_hash)
+                self.lock.notify_all()
+        
+        return 'compressed' if success else 'failed'
+    
+    def output_matches(self, path, entry):
+        """输出文件仍是该记录的压缩结果（没有被之后的压缩覆盖）
+        
+        比较文件大小，记录中有输出的哈希时再比较哈希（旧版本日志没有）。
+        """
+        try:
+            if os.path.getsize(path) != entry.get('compressed_size'):
+                return False
+            output_hash = entry.get('output_hash')
+            if output_hash:
+                with self.metrics.timer('hash'):
+                    return hash_file(path, hash_algorithm_of(output_hash)) == output_hash
+        except (OSError, ValueError, AttributeError):
+            return False
+        return True
+    
+    def reuse_compressed(self, source_path, output_path, file_hash, entry):
+        """源文件内容已压缩过时，用已有的压缩结果生成输出文件，不调用 API
+        
+        已有的输出文件可能被内容不同的压缩结果覆盖（例如源文件修改后重新压缩到同一路径），
+        只复用内容仍与记录一致的文件。
+        
+        返回:
+            str: 'deduplicated' 或 'skipped'；已有的输出都已被覆盖时返回 None，需要重新压缩
+        """
+        method = self.config.get('dedup_method', 'auto')
+        if method == 'none' or os.path.exists(output_path):
+            self.emit(f"[跳过] 跳过（已压缩）: {os.path.basename(source_path)}")
+            return 'skipped'
+        
+        candidates = [path for path in [entry['output_path']] + list(entry.get('duplicates', {}).values())
+                      if os.path.exists(path)]
+        existing_output = next((path for path in candidates if self.output_matches(path, entry)), None)
+        if existing_output is None:
+            if candidates:
+                self.emit(f"  已有的压缩结果已被其他图片覆盖，重新压缩: {os.path.basename(source_path)}")
+                return None
+            self.emit(f"[跳过] 跳过（已压缩，但找不到已有的压缩结果）: {os.path.basename(source_path)}")
+            return 'skipped'
+        
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with self.metrics.timer('dedup'):
+            how = materialize_output(existing_output, output_path, method)
+        
+        with self.lock:
+            record = {
+                'seq': self.log_data['journal_seq'] + 1,
+                'hash': file_hash,
+                'type': 'duplicate',
+                'source_path': source_path,
+                'output_path': output_path
+            }
+            apply_journal_record(self.log_data, record)
+            self.append_journal(record)
+        
+        self.emit(f"[复用] 内容与已压缩的图片相同，{how}已有结果: {os.path.basename(source_path)}")
+        return 'deduplicated'
+    
+    def run(self, retry_failed=False, plan=None, dry_run=False):
+        """执行批量压缩
+        
+        参数:
+            retry_failed: 不扫描目录，只重新处理失败列表中的图片
+            plan: 按预计节省空间安排处理顺序，None 时读取配置 plan_by_savings
+            dry_run: 只输出压缩计划，不处理图片
+        """
         # 显示当前 API keys 状态
         self.display_api_keys_status()
         
@@ -442,39 +1767,187 @@ class ImageCompressor:
             print(f"错误: 源文件夹不存在: {source_folder}")
             return
         
-        print(f"开始扫描文件夹: {source_folder}")
-        images = self.get_all_images(source_folder)
+        self.previous_failures = self.load_failures()
+        self.reset_stats()
+        if plan is None:
+            plan = self.config.get('plan_by_savings', False)
+        if retry_failed:
+            work_queue = self.start_retry_failed()
+            if work_queue is None:
+                return
+        elif plan or dry_run:
+            print(f"开始扫描文件夹并规划: {source_folder}")
+            self.load_dir_index()
+            work_queue = self.start_plan(source_folder, dry_run)
+            if work_queue is None:
+                return
+        else:
+            print(f"开始扫描文件夹: {source_folder}")
+            self.load_dir_index()
+            work_queue = self.start_scan(source_folder)
+        
+        if self.workers > 1:
+            print(f"并发模式: {self.workers} 个压缩任务同时进行\n")
+        self.drain(work_queue)
+        self.requeue_transient_failures()
         
-        if not images:
+        total = self.discovered
+        if not total and not self.pruned_images:
             print("未找到任何图片文件！")
             return
         
-        print(f"找到 {len(images)} 个图片文件\n")
+        if self.scan_finished and not retry_failed:
+            self.save_dir_index(self.failed_paths + self.scan_failed_dirs + self.deferred_paths
+                                + self.predicted_skip_paths)
         
-        # 统计信息
-        total = len(images)
-        compressed = 0
-        skipped = 0
-        failed = 0
+        self.finish_run(total)
+    
+    def drain(self, work_queue):
+        """处理工作队列中的所有图片，直到取到结束标记 None"""
+        if self.workers > 1:
+            for thread in self.start_workers(work_queue):
+                thread.join()
+        else:
+            self.worker(work_queue)
+    
+    def reset_stats(self):
+        """重置本次运行的统计信息"""
+        self.counts = {'compressed': 0, 'deduplicated': 0, 'skipped': 0, 'predicted_skip': 0,
+                       'failed': 0, 'other_shard': 0}
+        self.failed_paths = []
+        # 预测跳过的图片，所在目录不算完成，之后的运行重新预测
+        self.predicted_skip_paths = []
+        # 图片路径 -> 失败原因
+        self.failures = {}
+        # 额度不足、按计划推迟到以后处理的图片
+        self.deferred_paths = []
+    
+    def record_failure(self, image_path, error, transient=False):
+        """记录图片失败的原因，transient 表示暂时性错误，稍后重试可能成功"""
+        with self.lock:
+            self.failures[image_path] = {
+                'error': str(error) or type(error).__name__,
+                'transient': transient,
+                'failed_at': datetime.now().isoformat()
+            }
+    
+    def load_failures(self):
+        """读取失败列表"""
+        if not os.path.exists(self.failed_list_file):
+            return {}
+        try:
+            with open(self.failed_list_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except ValueError:
+            print(f"警告: 失败列表已损坏，将重新建立: {self.failed_list_file}")
+            return {}
+    
+    def save_failures(self):
+        """保存失败列表：上次的失败中本次没有处理到的，加上本次的失败"""
+        failures = dict(self.previous_failures)
+        for path in self.failed_paths:
+            failures[path] = self.failures.get(path, {'error': '未知错误', 'transient': False,
+                                                      'failed_at': datetime.now().isoformat()})
         
-        for i, image_path in enumerate(images, 1):
-            print(f"\n[{i}/{total}] 处理: {image_path}")
-            
-            # 检查是否已压缩
-            if self.is_compressed(image_path):
-                print(f"[跳过] 跳过（已压缩）: {os.path.basename(image_path)}")
-                skipped += 1
-                continue
-            
-            # 获取输出路径
-            output_path = self.get_output_path(image_path)
-            
-            # 压缩图片
-            if self.compress_image(image_path, output_path):
-                compressed += 1
-            else:
-                failed += 1
+        if not failures:
+            # 没有失败时不创建失败列表，全部处理成功后删除上次的列表
+            if os.path.exists(self.failed_list_file):
+                os.remove(self.failed_list_file)
+        else:
+            temp_path = self.failed_list_file + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(failures, f, indent=4, ensure_ascii=False)
+            os.replace(temp_path, self.failed_list_file)
+        # 监视模式会多次结束统计，之后以本次保存的列表为准
+        self.previous_failures = failures
+        return failures
+    
+    def start_retry_failed(self):
+        """把失败列表中的图片放入工作队列，没有需要重试的图片时返回 None"""
+        paths = [path for path in self.previous_failures if os.path.exists(path)]
+        missing = len(self.previous_failures) - len(paths)
+        if missing:
+            print(f"失败列表中有 {missing} 个图片已不存在，从列表中移除")
+            self.previous_failures = {path: self.previous_failures[path] for path in paths}
+        if not paths:
+            print("失败列表为空，没有需要重新处理的图片")
+            if missing:
+                self.save_failures()
+            return None
+        
+        print(f"重新处理上次失败的 {len(paths)} 个图片")
+        work_queue = queue.Queue()
+        for i, path in enumerate(paths, 1):
+            work_queue.put((i, path))
+        work_queue.put(None)
+        self.discovered = len(paths)
+        self.scan_finished = True
+        self.scan_failed_dirs = []
+        self.pruned_dirs = 0
+        self.pruned_images = 0
+        self.other_shard_images = 0
+        return work_queue
+    
+    def requeue_transient_failures(self):
+        """运行结束时，把因暂时性错误失败的图片再处理一次"""
+        if not self.config.get('requeue_failed', True):
+            return
+        requeue = [path for path in self.failed_paths
+                   if self.failures.get(path, {}).get('transient')]
+        if not requeue:
+            return
         
+        print(f"\n{len(requeue)} 个图片因暂时性错误失败，重新处理一次...")
+        requeue_set = set(requeue)
+        with self.lock:
+            self.failed_paths = [path for path in self.failed_paths if path not in requeue_set]
+            self.counts['failed'] -= len(requeue)
+        work_queue = queue.Queue()
+        for i, path in enumerate(requeue, 1):
+            work_queue.put((i, path))
+        work_queue.put(None)
+        self.drain(work_queue)
+    
+    def worker(self, work_queue):
+        """从工作队列取图片处理，直到取到结束标记 None"""
+        with self.profile_thread():
+            while True:
+                item = work_queue.get()
+                if item is None:
+                    # 留给其他线程
+                    work_queue.put(None)
+                    return
+                
+                i, image_path = item
+                with self.image_output():
+                    try:
+                        with self.metrics.timer('image'):
+                            result = self.process_image(i, image_path)
+                    except Exception as e:
+                        self.emit(f"[失败] 处理失败: {image_path}")
+                        self.emit(f"  错误: {e}")
+                        self.record_failure(image_path, e)
+                        result = 'failed'
+                
+                with self.lock:
+                    self.counts[result] += 1
+                    # 处理过的图片以本次结果为准，不再保留上次的失败记录
+                    self.previous_failures.pop(image_path, None)
+                    if result == 'failed':
+                        self.failed_paths.append(image_path)
+                    elif result == 'predicted_skip':
+                        self.predicted_skip_paths.append(image_path)
+    
+    def start_workers(self, work_queue):
+        """启动 self.workers 个处理线程，返回线程列表"""
+        threads = [threading.Thread(target=self.worker, args=(work_queue,), daemon=True)
+                   for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+    
+    def finish_run(self, total):
+        """保存日志并输出本次运行的统计信息"""
         # 更新最后运行时间
         self.log_data['last_run_time'] = datetime.now().isoformat()
         self.save_log()
@@ -484,22 +1957,217 @@ class ImageCompressor:
         print("压缩完成！")
         print("="*60)
         print(f"总文件数: {total}")
-        print(f"成功压缩: {compressed}")
-        print(f"跳过（已压缩）: {skipped}")
-        print(f"失败: {failed}")
+        if self.pruned_dirs:
+            print(f"跳过未变化的目录: {self.pruned_dirs} 个（共 {self.pruned_images} 个图片）")
+        print(f"成功压缩: {self.counts['compressed']}")
+        print(f"复用已有结果: {self.counts['deduplicated']}")
+        print(f"跳过（已压缩）: {self.counts['skipped']}")
+        print(f"失败: {self.counts['failed']}")
+        if self.shard:
+            other = self.counts['other_shard'] + self.other_shard_images
+            print(f"属于其他分片: {other} 个（本节点为第 {self.shard[0]}/{self.shard[1]} 份）")
+        if self.deferred_paths:
+            print(f"额度不足，推迟处理: {len(self.deferred_paths)} 个（下次运行时继续）")
+        failures = self.save_failures()
+        if failures:
+            print(f"失败列表已保存到 {self.failed_list_file}（共 {len(failures)} 个），"
+                  f"可用 --retry-failed 只重新处理这些图片")
+        if self.breaker.trips:
+            print(f"熔断次数: {self.breaker.trips}")
+        if self.predictor:
+            self.predictor.save()
+            skipped = self.metrics.counters.get('predicted_skip', 0)
+            if skipped:
+                # 省下的 API 往返分摊到并发的压缩任务上
+                round_trip = self.metrics.average('upload') + self.metrics.average('download')
+                saved_time = f"，约节省 {skipped * round_trip / self.workers:.1f} 秒" if round_trip else ""
+                print(f"预测跳过: {skipped} 个（节省 API 次数 {skipped}{saved_time}）")
         print("="*60)
         
+        self.write_metrics()
+        print("各阶段耗时:")
+        for line in self.metrics.summary_lines():
+            print(line)
+        
         # 显示详细的 API key 使用统计
         self.display_api_keys_status()
+    
+    def write_metrics(self):
+        """写入 metrics_file（JSON）和 prometheus_textfile（可选）"""
+        metrics_file = self.config.get('metrics_file', 'run_metrics.json')
+        prometheus_file = self.config.get('prometheus_textfile')
+        try:
+            if metrics_file:
+                self.metrics.write_json(metrics_file, self.counts, self.workers)
+            if prometheus_file:
+                self.metrics.write_prometheus(prometheus_file, self.counts)
+        except OSError as e:
+            print(f"警告: 写入运行指标失败: {e}")
+    
+    def emit(self, text):
+        """输出一条消息，处理图片期间（image_output）先加入该图片的输出"""
+        lines = getattr(self.output_local, 'lines', None)
+        if lines is not None:
+            lines.append(text)
+            return
+        with self.print_lock:
+            print(text)
+    
+    @contextlib.contextmanager
+    def image_output(self, lines=None):
+        """收集一张图片的所有输出，结束时作为一个整体输出，并发时不同图片的输出不会交错
+        
+        参数:
+            lines: 加入已有的输出（变体在 variant_executor 的线程中压缩），由创建者负责输出
+        """
+        previous = getattr(self.output_local, 'lines', None)
+        self.output_local.lines = [] if lines is None else lines
+        try:
+            yield self.output_local.lines
+        finally:
+            collected = self.output_local.lines
+            self.output_local.lines = previous
+            if lines is None and collected:
+                self.emit('\n'.join(collected))
+    
+    @contextlib.contextmanager
+    def profile_thread(self):
+        """使用 --profile 时分析当前线程（cProfile 只记录启用它的线程）"""
+        if self.profile_file is None or getattr(self.profile_local, 'active', False):
+            yield
+            return
+        profiler = cProfile.Profile()
+        self.profile_local.active = True
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.profile_local.active = False
+            with self.lock:
+                self.profilers.append(profiler)
+    
+    def dump_profile(self):
+        """合并所有线程的分析结果，保存到 profile_file 并输出最耗时的函数"""
+        if self.profile_file is None or not self.profilers:
+            return
+        stats = pstats.Stats(*self.profilers)
+        stats.dump_stats(self.profile_file)
+        print(f"\n性能分析结果已保存到 {self.profile_file}（可用 python -m pstats 或 snakeviz 查看）")
+        stats.sort_stats('cumulative').print_stats(25)
+    
+    def watch(self):
+        """常驻运行：先处理现有图片，然后持续压缩 source_folder 中新增或修改的图片
+        
+        日志、哈希索引和 API key 状态一直保存在内存中，每个变化的文件
+        在写入完成（watch_settle_seconds 内大小和修改时间不再变化）后立即处理。
+        """
+        source_folder = self.config['source_folder']
+        if not os.path.exists(source_folder):
+            print(f"错误: 源文件夹不存在: {source_folder}")
+            return
+        
+        # 先建立监视，避免处理现有图片期间出现的新文件被漏掉
+        watcher = create_watcher(source_folder, self.accept_path,
+                                 self.config.get('watch_full_scan_interval', 600),
+                                 self.config.get('watch_stat_files', True))
+        self.run()
+        
+        debouncer = Debouncer(self.config.get('watch_settle_seconds', 2))
+        poll_interval = self.config.get('watch_poll_interval', 1)
+        work_queue = queue.Queue()
+        self.reset_stats()
+        self.discovered = 0
+        self.scan_finished = True
+        self.pruned_dirs = 0
+        self.other_shard_images = 0
+        threads = self.start_workers(work_queue)
+        
+        # 作为后台服务运行时通常收到的是 SIGTERM，与 Ctrl+C 一样正常退出
+        def handle_sigterm(signum, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, handle_sigterm)
+        
+        # 常驻运行时定期更新指标文件，供 Prometheus textfile collector 采集
+        metrics_interval = self.config.get('metrics_write_interval', 60)
+        last_metrics_write = time.monotonic()
+        
+        print(f"\n开始监视文件夹: {source_folder}（{watcher.name}，按 Ctrl+C 退出）")
+        try:
+            while True:
+                time.sleep(poll_interval)
+                for path in watcher.poll():
+                    debouncer.add(path)
+                for path in debouncer.ready():
+                    self.discovered += 1
+                    work_queue.put((self.discovered, path))
+                if time.monotonic() - last_metrics_write >= metrics_interval:
+                    self.write_metrics()
+                    last_metrics_write = time.monotonic()
+        except KeyboardInterrupt:
+            print("\n正在停止监视，等待进行中的任务完成...")
+        finally:
+            watcher.stop()
+            work_queue.put(None)
+            for thread in threads:
+                thread.join()
+        
+        self.finish_run(self.discovered)
 
 def main():
     """主函数"""
+    parser = argparse.ArgumentParser(description="图片压缩工具 - TinyPNG API")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="同时进行的压缩任务数（默认读取 config.json 中的 concurrency）")
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default=None,
+                        help="本次运行所有图片使用的压缩后端（默认按 config.json 选择）")
+    parser.add_argument('--watch', action='store_true',
+                        help="常驻运行，持续压缩新增或修改的图片")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="不扫描目录，只重新处理上次失败的图片")
+    parser.add_argument('--plan', action='store_true',
+                        help="先扫描全部图片，优先压缩预计节省空间最多的图片，超出剩余额度的推迟处理")
+    parser.add_argument('--plan-dry-run', action='store_true',
+                        help="只输出压缩计划和预计节省的空间，不压缩图片")
+    parser.add_argument('--export-json', metavar='FILE', default=None,
+                        help="把压缩日志导出为 JSON 文件后退出（SQLite 存储切换回 JSON 时使用）")
+    parser.add_argument('--profile', nargs='?', const='profile.prof', default=None, metavar='FILE',
+                        help="用 cProfile 分析本次运行，结果保存到 FILE（默认 profile.prof）")
+    parser.add_argument('--shard', metavar='I/N', default=None,
+                        help="多台机器分片运行，本机只处理第 I 份（共 N 份，默认读取 config.json）")
+    parser.add_argument('--merge', nargs='+', metavar='LOG', default=None,
+                        help="合并各节点的 compression_log.json，结果替换本地日志后退出")
+    args = parser.parse_args()
+    
     print("="*60)
     print("图片压缩工具 - TinyPNG API")
     print("="*60)
     
-    compressor = ImageCompressor()
-    compressor.run()
+    compressor = ImageCompressor(workers=args.workers, backend=args.backend,
+                                 profile_file=args.profile, shard=args.shard)
+    if args.merge:
+        try:
+            compressor.merge_logs(args.merge)
+        except (OSError, ValueError) as e:
+            print(f"[错误] 合并失败: {e}")
+            return
+        compressor.display_api_keys_status()
+        return
+    if args.export_json:
+        count = export_log(compressor.log_data, args.export_json)
+        print(f"已导出 {count} 条压缩记录到 {args.export_json}")
+        return
+    
+    try:
+        with compressor.profile_thread():
+            if args.watch:
+                compressor.watch()
+            else:
+                compressor.run(retry_failed=args.retry_failed, plan=args.plan or None,
+                               dry_run=args.plan_dry_run)
+    finally:
+        compressor.close()
+    compressor.dump_profile()
 
 if __name__ == '__main__':
     main()
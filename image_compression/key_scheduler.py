@@ -0,0 +1,87 @@
+class KeyScheduler:
+    """在多个 API key 之间分配压缩请求
+
+    key 的已用次数取自 log_data['key_usage']，每次调用后用 API 返回的
+    compression_count 同步（多台机器共用 key 时本地计数不会偏低），
+    再加上正在进行中的请求数，保证不会超出 max_compressions_per_key。
+
+    分配策略:
+        sequential: 用完一个 key 再用下一个（原有行为）
+        spread: 每次选择剩余次数最多的 key，并发请求分散到所有可用的 key 上
+
+    分片运行时 node_quota 为本节点在每个 key 上预留的次数，key_usage 只计本节点的使用，
+    同时不超过 API 返回的总次数（key_reported_usage）所剩的额度。
+    """
+
+    STRATEGIES = ('sequential', 'spread')
+
+    def __init__(self, keys, log_data, max_usage, lock, strategy='sequential', node_quota=None):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"未知的 key 分配策略: {strategy}（可选: {', '.join(self.STRATEGIES)}）")
+        self.keys = keys
+        self.log_data = log_data
+        self.max_usage = max_usage
+        self.node_quota = node_quota
+        self.strategy = strategy
+        self.lock = lock
+        # key -> 正在进行中的请求数
+        self.in_flight = {key: 0 for key in keys}
+        # 已停用的 key -> 原因（本次运行中不再使用）
+        self.retired = {}
+
+    def remaining(self, key):
+        """key 还能分配的次数（已扣除进行中的请求）"""
+        usage = self.log_data['key_usage'].get(key, 0)
+        if self.node_quota is None:
+            return self.max_usage - usage - self.in_flight[key]
+        reported = self.log_data.get('key_reported_usage', {}).get(key, 0)
+        return min(self.node_quota - usage, self.max_usage - reported) - self.in_flight[key]
+
+    def available(self):
+        """所有可用 key 的剩余次数之和"""
+        with self.lock:
+            return sum(max(0, self.remaining(key)) for key in self.keys if key not in self.retired)
+
+    def acquire(self, calls=1):
+        """占用一个 key 的使用额度，额度被进行中的请求占满时等待
+
+        参数:
+            calls: 这次请求消耗的 API 次数（服务器端缩放为 2），占用相同数量的额度
+
+        返回:
+            str: 分配到的 key
+            int: key 在配置中的索引
+        """
+        with self.lock:
+            while True:
+                candidates = [(index, key) for index, key in enumerate(self.keys)
+                              if key not in self.retired and self.remaining(key) >= calls]
+                if candidates:
+                    break
+                # 额度只是被进行中的请求占用时等待它们结束（请求失败时额度会释放），
+                # 所有 key 的额度确实已用完才报错
+                if not any(self.in_flight[key] and self.remaining(key) + self.in_flight[key] >= calls
+                           for key in self.keys if key not in self.retired):
+                    raise Exception("所有 API keys 已达到使用上限！")
+                self.lock.wait()
+
+            if self.strategy == 'spread':
+                index, key = max(candidates, key=lambda item: (self.remaining(item[1]), -item[0]))
+            else:
+                index, key = candidates[0]
+
+            self.in_flight[key] += calls
+            return key, index
+
+    def release(self, key, calls=1):
+        """释放 acquire 占用的额度（请求结束后调用，calls 与 acquire 相同）"""
+        with self.lock:
+            self.in_flight[key] -= calls
+            self.lock.notify_all()
+
+    def retire(self, key, reason):
+        """停用 key（例如 API 返回 AccountError），本次运行中不再分配"""
+        with self.lock:
+            self.retired[key] = str(reason)
+            # 等待额度的线程重新判断
+            self.lock.notify_all()
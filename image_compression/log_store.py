@@ -0,0 +1,257 @@
+import os
+import json
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+
+# 压缩信息中有独立列的字段，其余字段（例如 duplicates）保存在 extra 列的 JSON 中
+FILE_COLUMNS = ('source_path', 'output_path', 'original_size', 'compressed_size',
+                'compression_ratio', 'compressed_at', 'api_key_index', 'api_key_used', 'backend')
+
+# 保存在 meta 表中的日志字段
+META_FIELDS = ('current_key_index', 'total_compressions', 'last_run_time',
+               'journal_seq', 'hash_algorithm', 'summary',
+               'shard', 'key_reported_usage', 'merged_nodes')
+
+# 随记录数增长、只在检查点写入的字段（每条记录都重新序列化的开销与历史记录数成正比）
+CHECKPOINT_FIELDS = ('summary', 'merged_nodes')
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS files (
+    hash TEXT PRIMARY KEY,
+    {', '.join(f'{column} {"INTEGER" if column.endswith(("_size", "_index")) else "TEXT"}'
+               for column in FILE_COLUMNS)},
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS files_source_path ON files (source_path);
+CREATE INDEX IF NOT EXISTS files_compressed_at ON files (compressed_at);
+CREATE TABLE IF NOT EXISTS api_keys (
+    api_key TEXT PRIMARY KEY,
+    usage INTEGER NOT NULL,
+    first_used TEXT,
+    last_used TEXT,
+    total_usage INTEGER
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def entry_to_row(file_hash, entry):
+    extra = {name: value for name, value in entry.items() if name not in FILE_COLUMNS}
+    return (file_hash,) + tuple(entry.get(column) for column in FILE_COLUMNS) + (
+        json.dumps(extra, ensure_ascii=False) if extra else None,)
+
+
+def row_to_entry(row):
+    entry = {column: row[i] for i, column in enumerate(FILE_COLUMNS)}
+    if row[-1]:
+        entry.update(json.loads(row[-1]))
+    return entry
+
+
+class SQLiteFileTable(MutableMapping):
+    """files 表的字典视图，替代日志中的 compressed_files
+
+    查询和写入都是按主键（文件哈希）的单行操作，不需要把所有记录载入内存。
+    取出的压缩信息是副本，修改后需要重新赋值才会写回。
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, file_hash):
+        entry = self.get(file_hash)
+        if entry is None:
+            raise KeyError(file_hash)
+        return entry
+
+    def get(self, file_hash, default=None):
+        row = self.store.query_one(
+            f"SELECT {', '.join(FILE_COLUMNS)}, extra FROM files WHERE hash = ?", (file_hash,))
+        return row_to_entry(row) if row else default
+
+    def __contains__(self, file_hash):
+        return self.store.query_one("SELECT 1 FROM files WHERE hash = ?", (file_hash,)) is not None
+
+    def __setitem__(self, file_hash, entry):
+        self.store.execute(
+            f"INSERT OR REPLACE INTO files VALUES ({', '.join('?' * (len(FILE_COLUMNS) + 2))})",
+            entry_to_row(file_hash, entry))
+
+    def __delitem__(self, file_hash):
+        if self.store.execute("DELETE FROM files WHERE hash = ?", (file_hash,)).rowcount == 0:
+            raise KeyError(file_hash)
+
+    def __iter__(self):
+        return iter([row[0] for row in self.store.query_all("SELECT hash FROM files")])
+
+    def __len__(self):
+        return self.store.query_one("SELECT COUNT(*) FROM files")[0]
+
+    def items(self):
+        rows = self.store.query_all(f"SELECT hash, {', '.join(FILE_COLUMNS)}, extra FROM files")
+        return [(row[0], row_to_entry(row[1:])) for row in rows]
+
+    def values(self):
+        return [entry for _, entry in self.items()]
+
+    def replace_all(self, compressed_files):
+        """用 compressed_files 字典替换整张表（导入、哈希算法迁移时使用）"""
+        self.store.execute("DELETE FROM files")
+        self.store.executemany(
+            f"INSERT OR REPLACE INTO files VALUES ({', '.join('?' * (len(FILE_COLUMNS) + 2))})",
+            (entry_to_row(file_hash, entry) for file_hash, entry in compressed_files.items()))
+
+
+class SQLiteLogStore:
+    """用 SQLite 保存压缩日志
+
+    compressed_files 按需查询，key 使用次数和其他字段很小，仍然放在内存中的
+    log_data 里，每条压缩记录后写回。使用 WAL 模式，提交只追加 WAL 文件，
+    不需要每次 fsync 整个数据库。
+
+    每条记录不单独提交：累计 batch_size 条或第一条未提交的记录已等待 batch_ms 毫秒时
+    提交一次，检查点和 close 时也会提交。压缩信息和 key 使用次数总在同一个事务中，
+    进程被杀死时数据库仍然一致，只会丢失最后一批尚未提交的记录（这些图片下次重新压缩，
+    key 使用次数以 API 返回的 compression_count 为准）。
+
+    汇总统计只在检查点（save_log）写入，并记下当时的 journal_seq（summary_seq）；
+    中途退出时汇总统计落后于压缩记录，读取时丢弃，由调用方重新生成。
+    """
+
+    def __init__(self, db_file, batch_size=100, batch_ms=500):
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self.batch_ms = batch_ms
+        # 尚未提交的记录数，以及到时提交的定时器
+        self.pending = 0
+        self.commit_timer = None
+        self.closed = False
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        self.files = SQLiteFileTable(self)
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params)
+
+    def executemany(self, sql, rows):
+        with self.lock:
+            return self.conn.executemany(sql, rows)
+
+    def query_one(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def query_all(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def is_empty(self):
+        return self.query_one("SELECT 1 FROM meta LIMIT 1") is None
+
+    def load(self):
+        """读取日志，compressed_files 为 SQLiteFileTable，其余字段与 JSON 日志相同"""
+        log_data = {'compressed_files': self.files, 'key_usage': {}, 'key_details': {}}
+        for key, usage, first_used, last_used, total_usage in self.query_all(
+                "SELECT api_key, usage, first_used, last_used, total_usage FROM api_keys"):
+            log_data['key_usage'][key] = usage
+            if first_used or last_used:
+                log_data['key_details'][key] = {
+                    'first_used': first_used,
+                    'last_used': last_used,
+                    'total_usage': total_usage
+                }
+        for name, value in self.query_all("SELECT name, value FROM meta"):
+            log_data[name] = json.loads(value)
+        if log_data.pop('summary_seq', None) != log_data.get('journal_seq'):
+            log_data.pop('summary', None)
+        return log_data
+
+    def save(self, log_data, checkpoint=True):
+        """写回 key 使用次数和其他字段，与之前写入的压缩信息在同一个事务中提交
+
+        参数:
+            checkpoint: 为 False 时不写入 CHECKPOINT_FIELDS（每条压缩记录后调用），
+                        并按 batch_size / batch_ms 合并提交；为 True 时立即提交
+        """
+        fields = [name for name in META_FIELDS if checkpoint or name not in CHECKPOINT_FIELDS]
+        with self.lock:
+            if log_data['compressed_files'] is not self.files:
+                # 整体替换过 compressed_files（例如哈希算法迁移）
+                self.files.replace_all(log_data['compressed_files'])
+                log_data['compressed_files'] = self.files
+
+            key_usage = log_data.get('key_usage', {})
+            key_details = log_data.get('key_details', {})
+            self.conn.execute("DELETE FROM api_keys WHERE api_key NOT IN (%s)"
+                              % ', '.join('?' * len(key_usage)), tuple(key_usage))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO api_keys VALUES (?, ?, ?, ?, ?)",
+                [(key, usage, key_details.get(key, {}).get('first_used'),
+                  key_details.get(key, {}).get('last_used'),
+                  key_details.get(key, {}).get('total_usage'))
+                 for key, usage in key_usage.items()])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [(name, json.dumps(log_data[name], ensure_ascii=False))
+                 for name in fields if name in log_data])
+            # 分片等可选字段从日志中移除后，数据库中也不再保留
+            self.conn.executemany(
+                "DELETE FROM meta WHERE name = ?",
+                [(name,) for name in fields if name not in log_data])
+            if checkpoint:
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('summary_seq', ?)",
+                                  (json.dumps(log_data.get('journal_seq')),))
+                self.commit()
+                return
+
+            self.pending += 1
+            if self.pending >= self.batch_size or self.batch_ms <= 0:
+                self.commit()
+            elif self.commit_timer is None:
+                # 之后没有新的记录（例如监视模式空闲）时也会按时提交
+                self.commit_timer = threading.Timer(self.batch_ms / 1000, self.commit)
+                self.commit_timer.daemon = True
+                self.commit_timer.start()
+
+    def commit(self):
+        """提交尚未提交的记录"""
+        with self.lock:
+            if self.closed:
+                # 定时器在 close 之后才拿到锁
+                return
+            if self.commit_timer is not None:
+                self.commit_timer.cancel()
+                self.commit_timer = None
+            self.conn.commit()
+            self.pending = 0
+
+    def import_log(self, log_data):
+        """一次性导入 JSON 日志（整个导入在一个事务中），返回导入后的日志"""
+        imported = dict(log_data)
+        self.save(imported)
+        return imported
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.conn.close()
+            self.closed = True
+
+
+def export_log(log_data, path):
+    """把日志导出为与 compression_log.json 相同格式的 JSON 文件，返回导出的记录数"""
+    exported = dict(log_data, compressed_files=dict(log_data['compressed_files'].items()))
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(exported, f, indent=4, ensure_ascii=False)
+    os.replace(temp_path, path)
+    return len(exported['compressed_files'])
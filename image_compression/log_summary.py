@@ -0,0 +1,103 @@
+import posixpath
+
+# 压缩率分布的区间（百分比），最后一个区间包含 100%
+RATIO_BUCKETS = ('<0', '0-10', '10-20', '20-30', '30-40', '40-50',
+                 '50-60', '60-70', '70-80', '80-90', '90-100')
+
+# by_day / by_dir / by_backend 中每一项的字段
+TOTAL_FIELDS = ('files', 'original_bytes', 'compressed_bytes', 'api_calls')
+
+# 预测节省太少、没有调用 API 的图片（由 skip_action 生成输出）的记录状态，
+# 不计入压缩统计，之后的运行会重新预测
+SKIPPED = 'skipped'
+
+
+def is_skipped(entry):
+    return entry.get('status') == SKIPPED
+
+
+def new_summary():
+    """空的汇总统计
+
+    汇总统计随每条压缩记录增量更新，保存在日志中，报表不需要遍历所有压缩记录。
+    """
+    return {
+        'files': 0,
+        'original_bytes': 0,
+        'compressed_bytes': 0,
+        'api_calls': 0,
+        'duplicates': 0,
+        'ratio_buckets': {bucket: 0 for bucket in RATIO_BUCKETS},
+        # 日期 / 目录 / 后端 -> [文件数, 原始字节数, 压缩后字节数, API 调用次数]
+        'by_day': {},
+        'by_dir': {},
+        'by_backend': {},
+    }
+
+
+def ratio_bucket(original_size, compressed_size):
+    if not original_size:
+        return RATIO_BUCKETS[1]
+    ratio = (1 - compressed_size / original_size) * 100
+    if ratio < 0:
+        return RATIO_BUCKETS[0]
+    return RATIO_BUCKETS[min(int(ratio // 10), 9) + 1]
+
+
+def source_dir(source_path):
+    """压缩记录所在的目录，统一使用 / 分隔"""
+    # 日志可能来自 Windows，路径中是反斜杠
+    directory = posixpath.dirname(source_path.replace('\\', '/'))
+    if directory.startswith('./'):
+        directory = directory[2:]
+    return directory or '.'
+
+
+def add_totals(totals, name, original_size, compressed_size, api_call):
+    row = totals.get(name)
+    if row is None:
+        row = totals[name] = [0] * len(TOTAL_FIELDS)
+    row[0] += 1
+    row[1] += original_size
+    row[2] += compressed_size
+    row[3] += api_call
+
+
+def add_compression(summary, entry, key, calls=1):
+    """把一条压缩记录计入汇总统计
+
+    参数:
+        calls: 这次压缩消耗的 API 次数（服务器端缩放为 2），不使用 key 时不计
+    """
+    if is_skipped(entry):
+        return
+    original_size = entry.get('original_size') or 0
+    compressed_size = entry.get('compressed_size') or 0
+    api_call = calls if key else 0
+
+    summary['files'] += 1
+    summary['original_bytes'] += original_size
+    summary['compressed_bytes'] += compressed_size
+    summary['api_calls'] += api_call
+    summary['ratio_buckets'][ratio_bucket(original_size, compressed_size)] += 1
+    add_totals(summary['by_day'], (entry.get('compressed_at') or '')[:10] or 'unknown',
+               original_size, compressed_size, api_call)
+    add_totals(summary['by_dir'], source_dir(entry.get('source_path', '')),
+               original_size, compressed_size, api_call)
+    add_totals(summary['by_backend'], entry.get('backend') or 'tinypng',
+               original_size, compressed_size, api_call)
+
+
+def add_duplicate(summary):
+    """内容重复的图片复用了已有结果"""
+    summary['duplicates'] += 1
+
+
+def build_summary(compressed_files):
+    """遍历所有压缩记录生成汇总统计（旧版本日志只需要执行一次）"""
+    summary = new_summary()
+    for entry in compressed_files.values():
+        # 旧版本日志没有记录 key，按 api_key_used 判断是否调用了 API
+        add_compression(summary, entry, entry.get('api_key_used'), entry.get('api_calls', 1))
+        summary['duplicates'] += len(entry.get('duplicates', {}))
+    return summary
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# 直方图的桶上限（秒），与 Prometheus 客户端库的默认值相近，覆盖到 API 慢请求
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRIC_PREFIX = 'image_compressor'
+
+
+class StageHistogram:
+    """单个阶段的耗时分布"""
+
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # 每个桶只计落在 (上一个上限, 当前上限] 内的次数，输出时再累加
+        self.buckets = [0] * (len(STAGE_BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for i, upper in enumerate(STAGE_BUCKETS):
+            if seconds <= upper:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def cumulative_buckets(self):
+        """[(上限, 累计次数)]，最后一项上限为 '+Inf'"""
+        result = []
+        running = 0
+        for upper, n in zip(STAGE_BUCKETS + ('+Inf',), self.buckets):
+            running += n
+            result.append((upper, running))
+        return result
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum_seconds': round(self.total, 6),
+            'avg_seconds': round(self.total / self.count, 6) if self.count else 0,
+            'max_seconds': round(self.max, 6),
+            'buckets': {str(upper): n for upper, n in self.cumulative_buckets()}
+        }
+
+
+class RunMetrics:
+    """记录压缩流程各阶段的耗时和传输字节数，多个线程共享
+
+    阶段名称:
+        scan      扫描目录（后台扫描线程实际花在列目录上的时间，不含等待队列）
+        plan      规划模式下扫描目录并读取图片头部估算节省空间
+        hash      计算源文件哈希
+        read      读取源文件
+        resize    本地缩放
+        upload    上传到 TinyPNG 并等待压缩（/shrink）
+        download  下载压缩结果
+        compress  本地后端压缩
+        write     写入输出文件
+        dedup     用已有结果生成重复图片的输出
+        journal   追加 journal
+        save_log  保存日志快照
+        image     处理一张图片的总耗时
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = datetime.now()
+        self.start_time = time.perf_counter()
+        self.stages = {}
+        self.bytes = {'read': 0, 'uploaded': 0, 'downloaded': 0, 'written': 0}
+        # 其他事件的次数，例如 predicted_skip（预测压缩率太低而没有调用 API）
+        self.counters = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = StageHistogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """with metrics.timer('hash'): ... 记录代码块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def add_bytes(self, kind, n):
+        with self.lock:
+            self.bytes[kind] += n
+
+    def increment(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def average(self, stage):
+        """阶段的平均耗时（秒），没有记录时返回 0"""
+        with self.lock:
+            histogram = self.stages.get(stage)
+            return histogram.total / histogram.count if histogram and histogram.count else 0
+
+    def to_dict(self, counts=None, workers=None):
+        with self.lock:
+            return {
+                'started_at': self.started_at.isoformat(),
+                'finished_at': datetime.now().isoformat(),
+                'duration_seconds': round(time.perf_counter() - self.start_time, 3),
+                'workers': workers,
+                'images': dict(counts or {}),
+                'bytes': dict(self.bytes),
+                'counters': dict(self.counters),
+                'stages': {stage: histogram.to_dict()
+                           for stage, histogram in sorted(self.stages.items())}
+            }
+
+    def write_json(self, path, counts=None, workers=None):
+        write_atomic(path, json.dumps(self.to_dict(counts, workers), indent=4, ensure_ascii=False))
+
+    def write_prometheus(self, path, counts=None):
+        """写入 node_exporter textfile collector 格式的指标文件"""
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+
+        with self.lock:
+            metric('stage_seconds', 'histogram', 'Time spent in each stage of the compression pipeline.')
+            for stage, histogram in sorted(self.stages.items()):
+                for upper, n in histogram.cumulative_buckets():
+                    lines.append(f'{METRIC_PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{upper}"}} {n}')
+                lines.append(f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {histogram.total:.6f}')
+                lines.append(f'{METRIC_PREFIX}_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+            metric('bytes_total', 'counter', 'Bytes read, uploaded, downloaded and written.')
+            for kind, n in sorted(self.bytes.items()):
+                lines.append(f'{METRIC_PREFIX}_bytes_total{{kind="{kind}"}} {n}')
+
+            metric('events_total', 'counter', 'Other events, e.g. uploads skipped by the predictor.')
+            for name, n in sorted(self.counters.items()):
+                lines.append(f'{METRIC_PREFIX}_events_total{{event="{name}"}} {n}')
+
+            metric('images_total', 'counter', 'Images processed in this run by result.')
+            for result, n in sorted((counts or {}).items()):
+                lines.append(f'{METRIC_PREFIX}_images_total{{result="{result}"}} {n}')
+
+            metric('run_duration_seconds', 'gauge', 'Wall time of the run so far.')
+            lines.append(f'{METRIC_PREFIX}_run_duration_seconds {time.perf_counter() - self.start_time:.3f}')
+            metric('last_update_timestamp_seconds', 'gauge', 'Unix time the metrics were written.')
+            lines.append(f'{METRIC_PREFIX}_last_update_timestamp_seconds {time.time():.0f}')
+
+        write_atomic(path, '\n'.join(lines) + '\n')
+
+    def summary_lines(self):
+        """按总耗时排序的各阶段统计，用于运行结束时输出"""
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda item: item[1].total, reverse=True)
+            return [f"  {stage:<10}{histogram.count:>8} 次{histogram.total:>10.2f} 秒"
+                    f"  平均 {histogram.total / histogram.count * 1000:.1f} ms"
+                    for stage, histogram in stages]
+
+
+def write_atomic(path, text):
+    """先写临时文件再替换，textfile collector 不会读到写了一半的文件"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temp_path, path)
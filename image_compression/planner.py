@@ -0,0 +1,91 @@
+import os
+
+from skip_predictor import header_features, prior_savings
+
+
+class PlanItem:
+    """规划中的一张图片"""
+
+    __slots__ = ('path', 'size', 'expected_saved', 'predicted', 'resized', 'cost')
+
+    def __init__(self, path, size, expected_saved, predicted=None, resized=False, cost=1):
+        self.path = path
+        self.size = size
+        # 预计节省的字节数（包括缩放的效果）
+        self.expected_saved = expected_saved
+        # 预计 TinyPNG 的压缩率（百分比），无法识别图片头部时为 None
+        self.predicted = predicted
+        # 是否会先在本地缩放
+        self.resized = resized
+        # 处理这张图片消耗的 API 次数（例如每个尚未压缩的变体一次）
+        self.cost = cost
+
+
+def estimate_item(path, size, predictor=None, max_width=None):
+    """只读取文件头估算压缩一张图片能节省多少字节，无法识别时预计为 0
+
+    参数:
+        predictor: SkipPredictor，有历史数据时用它的分组统计，否则使用经验估计
+        max_width: 启用了缩放时的最大宽度，超过的图片按面积比例估算缩放后的大小
+    """
+    features = header_features(path, size, os.path.splitext(path)[1].lower())
+    if features is None:
+        return PlanItem(path, size, 0)
+
+    if predictor:
+        predicted, _ = predictor.predict(features)
+    else:
+        predicted = prior_savings(features)
+
+    scale = 1.0
+    if max_width and features['width'] > max_width:
+        scale = (max_width / features['width']) ** 2
+    expected_size = size * scale * (1 - predicted / 100)
+    return PlanItem(path, size, max(0, int(size - expected_size)), predicted, scale < 1)
+
+
+def select_by_savings(items, quota):
+    """在 quota 次 API 调用内选出预计节省最多的图片
+
+    按每次调用预计节省的字节数从大到小选择，每个图片消耗 item.cost 次，
+    剩余额度不够某个图片时跳过它，继续尝试消耗更少的图片。
+
+    返回:
+        list: 选中的图片，按每次调用预计节省从大到小排列
+        list: 额度不足、推迟到以后处理的图片（保持扫描顺序）
+    """
+    ranked = sorted(items, key=lambda item: (item.expected_saved / max(1, item.cost), item.expected_saved),
+                    reverse=True)
+    selected = []
+    remaining = quota
+    for item in ranked:
+        if item.cost <= remaining:
+            selected.append(item)
+            remaining -= item.cost
+    chosen = {id(item) for item in selected}
+    deferred = [item for item in items if id(item) not in chosen]
+    return selected, deferred
+
+
+def take_in_order(items, quota):
+    """不做规划时按扫描顺序处理，额度用完之前处理到的图片"""
+    taken = []
+    for item in items:
+        if item.cost > quota:
+            break
+        taken.append(item)
+        quota -= item.cost
+    return taken
+
+
+def plan_totals(items):
+    """一组图片的数量、原始字节数和预计节省字节数"""
+    original = sum(item.size for item in items)
+    saved = sum(item.expected_saved for item in items)
+    return {
+        'files': len(items),
+        'calls': sum(item.cost for item in items),
+        'original_bytes': original,
+        'expected_saved_bytes': saved,
+        'expected_saved_percent': round(saved / original * 100, 2) if original else 0,
+    }
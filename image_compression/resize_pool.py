@@ -0,0 +1,177 @@
+import io
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+# resize_mode -> Image.resize 的 reducing_gap 参数
+# quality: 完整解码后 LANCZOS 缩放（原有行为）
+# balanced/fast: JPEG 先在 DCT 域按 1/2、1/4、1/8 缩小解码，再用 reduce 先整数倍缩小，
+# reducing_gap 越小越快，3.0 时与完整缩放几乎看不出差别
+RESIZE_REDUCING_GAP = {
+    'quality': None,
+    'balanced': 3.0,
+    'fast': 2.0,
+}
+
+
+def downscale_image(img, size, resize_mode='quality'):
+    """把刚打开（尚未解码）的图片等比缩小到 size
+
+    返回:
+        Image: 缩放后的新图片
+    """
+    if resize_mode not in RESIZE_REDUCING_GAP:
+        resize_mode = 'quality'
+
+    if resize_mode != 'quality' and img.format == 'JPEG':
+        # draft 只能在解码前调用，解码出的尺寸不小于 size
+        img.draft(img.mode, size)
+
+    return img.resize(size, Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP[resize_mode])
+
+
+def encode_image(img, file_ext, original_format):
+    """按扩展名编码图片，保持较高质量（之后还要交给压缩后端）"""
+    buffer = io.BytesIO()
+    if file_ext in ['.jpg', '.jpeg']:
+        if img.mode not in ('RGB', 'L', 'CMYK'):
+            # 例如 PNG 转为 JPEG 变体，JPEG 不支持透明通道
+            img = img.convert('RGB')
+        img.save(buffer, 'JPEG', quality=95, optimize=True)
+    elif file_ext == '.png':
+        img.save(buffer, 'PNG', optimize=True)
+    elif file_ext == '.webp':
+        img.save(buffer, 'WEBP', quality=95)
+    else:
+        img.save(buffer, original_format)
+    return buffer.getvalue()
+
+
+def resize_image_data(source_data, file_ext, max_width, resize_mode='quality'):
+    """宽度超过 max_width 时等比缩放并重新编码（可以在进程池中执行）
+
+    返回:
+        bytes: 缩放后的图片数据，不需要缩放时为 None
+        tuple: 原尺寸 (宽, 高)
+        tuple: 新尺寸 (宽, 高)
+    """
+    with Image.open(io.BytesIO(source_data)) as img:
+        original_width, original_height = img.size
+        if original_width <= max_width:
+            return None, img.size, img.size
+
+        # 计算新的尺寸（等比缩放）
+        new_size = (max_width, int(original_height * max_width / original_width))
+        resized_img = downscale_image(img, new_size, resize_mode)
+
+        # 保存缩放后的图片到内存，保持原格式和质量
+        data = encode_image(resized_img, file_ext, img.format)
+        resized_img.close()
+
+    return data, (original_width, original_height), new_size
+
+
+def render_variants(source_data, file_ext, variants, resize_mode='quality'):
+    """只解码一次源图片，生成所有尺寸和格式的变体（可以在进程池中执行）
+
+    参数:
+        variants: [(最大宽度（None 为原尺寸）, 输出扩展名)]
+
+    返回:
+        list: 与 variants 顺序相同的 (图片数据, (宽, 高))；
+              尺寸和格式都与源图片相同时图片数据为 None，直接使用源文件
+    """
+    with Image.open(io.BytesIO(source_data)) as img:
+        width, height = img.size
+        original_format = img.format
+        sizes = []
+        for max_width, _ in variants:
+            new_width = min(max_width or width, width)
+            sizes.append((new_width, max(1, int(height * new_width / width))))
+
+        if resize_mode not in RESIZE_REDUCING_GAP:
+            resize_mode = 'quality'
+        if resize_mode != 'quality' and original_format == 'JPEG':
+            # 按最大的变体缩小解码，解码出的尺寸不小于其中任何一个
+            img.draft(img.mode, max(sizes))
+        img.load()
+
+        results = []
+        for (_, output_ext), size in zip(variants, sizes):
+            if size == (width, height) and output_ext == file_ext:
+                results.append((None, size))
+                continue
+            if size == img.size:
+                variant = img
+            else:
+                variant = img.resize(size, Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP[resize_mode])
+            results.append((encode_image(variant, output_ext, original_format), size))
+            if variant is not img:
+                variant.close()
+    return results
+
+
+class ResizePool:
+    """在多个进程中缩放图片，压缩线程只负责网络请求
+
+    缩放和重新编码是 CPU 密集的，受 GIL 限制在线程中无法并行。压缩线程调用
+    resize() 把任务交给进程池并等待结果，等待期间其他线程继续上传和下载。
+
+    - 同时提交的任务数不超过 max_pending，源图片数据不会在内存中无限堆积
+    - 子进程崩溃（例如损坏的图片让解码器崩溃）时重建进程池，
+      受影响的任务重试一次，再次崩溃则抛出 BrokenProcessPool
+    """
+
+    def __init__(self, processes, max_pending=None):
+        self.processes = max(1, processes)
+        self.slots = threading.BoundedSemaphore(max_pending or self.processes * 2)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.restarts = 0
+        # 压缩线程已经启动，fork 可能复制其他线程持有的锁，使用 forkserver（Windows 上为 spawn）
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.context = multiprocessing.get_context(method)
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.processes, mp_context=self.context)
+            return self.executor
+
+    def restart(self, broken):
+        """进程池损坏时重建（多个线程同时发现时只重建一次）"""
+        with self.lock:
+            if self.executor is broken:
+                self.executor = None
+                self.restarts += 1
+                print("[警告] 缩放进程异常退出，已重建进程池")
+        broken.shutdown(wait=False)
+
+    def run(self, func, *args):
+        """在进程池中执行 func(*args) 并等待结果"""
+        with self.slots:
+            for attempt in (1, 2):
+                executor = self.get_executor()
+                try:
+                    return executor.submit(func, *args).result()
+                except BrokenProcessPool as e:
+                    self.restart(executor)
+                    if attempt == 2:
+                        raise BrokenProcessPool("缩放进程连续两次异常退出，图片可能已损坏") from e
+
+    def resize(self, source_data, file_ext, max_width, resize_mode='quality'):
+        """在进程池中执行 resize_image_data，返回值相同"""
+        return self.run(resize_image_data, source_data, file_ext, max_width, resize_mode)
+
+    def render(self, source_data, file_ext, variants, resize_mode='quality'):
+        """在进程池中执行 render_variants，返回值相同"""
+        return self.run(render_variants, source_data, file_ext, variants, resize_mode)
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
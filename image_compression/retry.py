@@ -0,0 +1,95 @@
+import time
+import random
+import threading
+
+import tinify
+
+# 服务器错误和网络错误通常是暂时的，稍后重试即可；
+# AccountError（key 无效或额度用完）和 ClientError（图片本身有问题）重试没有意义
+TRANSIENT_ERRORS = (tinify.ServerError, tinify.ConnectionError)
+
+
+class RetryPolicy:
+    """带上限的指数退避，使用 full jitter 避免多个线程同时重试
+
+    第 n 次重试前等待 random(0, min(max_delay, base_delay * 2 ** (n - 1))) 秒。
+    """
+
+    def __init__(self, max_attempts=4, base_delay=1.0, max_delay=30.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        """第 attempt 次失败后的等待时间（attempt 从 1 开始）"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """连续失败达到阈值时熔断，暂停所有压缩线程
+
+    熔断期间调用 wait() 的线程全部阻塞，cooldown 秒后只放行一个试探请求：
+    成功则恢复，失败则再熔断一个 cooldown。服务中断时不会把整个队列的图片
+    都消耗成失败。
+    """
+
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self.condition = threading.Condition()
+        self.consecutive_failures = 0
+        # 熔断结束的时间（time.monotonic()），为 None 表示未熔断
+        self.open_until = None
+        self.trial_in_flight = False
+        self.trips = 0
+
+    def wait(self):
+        """熔断期间阻塞，冷却结束后只放行一个试探请求"""
+        with self.condition:
+            while self.open_until is not None:
+                remaining = self.open_until - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                elif not self.trial_in_flight:
+                    self.trial_in_flight = True
+                    return
+                else:
+                    # 等待试探请求的结果
+                    self.condition.wait()
+
+    def record_success(self):
+        """请求得到了服务器的正常响应（包括非暂时性的错误响应）"""
+        with self.condition:
+            if self.open_until is not None:
+                print("[恢复] API 请求已恢复正常，继续压缩")
+            self.consecutive_failures = 0
+            self.open_until = None
+            self.trial_in_flight = False
+            self.condition.notify_all()
+
+    def record_failure(self):
+        """请求遇到暂时性错误"""
+        with self.condition:
+            self.consecutive_failures += 1
+            if self.trial_in_flight or self.consecutive_failures >= self.failure_threshold:
+                if self.open_until is None or self.trial_in_flight:
+                    self.trips += 1
+                    print(f"[熔断] 连续 {self.consecutive_failures} 次请求失败，"
+                          f"暂停所有压缩任务 {self.cooldown:.0f} 秒")
+                self.open_until = time.monotonic() + self.cooldown
+                self.trial_in_flight = False
+                self.condition.notify_all()
+
+    def call(self, func, *args):
+        """等待熔断结束后调用 func，并按结果更新熔断状态"""
+        self.wait()
+        try:
+            result = func(*args)
+        except TRANSIENT_ERRORS:
+            self.record_failure()
+            raise
+        except Exception:
+            self.record_success()
+            raise
+        self.record_success()
+        return result
@@ -0,0 +1,142 @@
+import os
+import hashlib
+
+from log_summary import build_summary, is_skipped
+
+SHARD_METHODS = ('path', 'content')
+
+
+def parse_shard(text):
+    """解析命令行的 "序号/总数"（序号从 1 开始），返回 (序号, 总数)"""
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError(f"分片格式应为 序号/总数（如 2/4）: {text}")
+    return index, count
+
+
+def shard_of(value, count):
+    """把路径或文件哈希稳定地映射到 0 ~ count-1
+
+    不使用内置 hash()（每个进程的随机种子不同），所有节点对同一个值得到相同的结果。
+    """
+    digest = hashlib.md5(value.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def node_quota(max_usage, index, count):
+    """把每个 key 的额度平均分给各节点，余数分给序号小的节点"""
+    return max_usage // count + (1 if index - 1 < max_usage % count else 0)
+
+
+def node_id(log_data, path):
+    """日志对应的节点：分片日志为 "序号/总数"，其他日志为文件路径"""
+    shard = log_data.get('shard')
+    if shard:
+        return f"{shard['index']}/{shard['count']}"
+    return os.path.abspath(path)
+
+
+def node_state(log_data):
+    return {
+        'key_usage': dict(log_data.get('key_usage', {})),
+        'total_compressions': log_data.get('total_compressions', 0),
+    }
+
+
+def merge_entry(compressed_files, file_hash, entry):
+    """合并同一哈希的压缩信息：保留较早的一条，另一条的路径记为 duplicates
+
+    预测跳过的记录不与实际压缩的记录合并，只保留实际压缩的一条。
+    """
+    existing = compressed_files.get(file_hash)
+    if existing is None:
+        compressed_files[file_hash] = entry
+        return
+    if is_skipped(existing) != is_skipped(entry):
+        # 预测跳过的记录没有压缩，保留实际压缩的一条
+        if is_skipped(existing):
+            compressed_files[file_hash] = entry
+        return
+    if (entry.get('compressed_at') or '') < (existing.get('compressed_at') or ''):
+        existing, entry = entry, existing
+    duplicates = dict(existing.get('duplicates', {}))
+    duplicates.update(entry.get('duplicates', {}))
+    if entry['source_path'] != existing['source_path']:
+        duplicates[entry['source_path']] = entry['output_path']
+    duplicates.pop(existing['source_path'], None)
+    if duplicates:
+        existing['duplicates'] = duplicates
+    # 重新赋值，紧凑索引和 SQLite 存储取出的是副本
+    compressed_files[file_hash] = existing
+
+
+def merge_logs(logs, compressed_files):
+    """合并多个节点的压缩日志
+
+    参数:
+        logs: [(日志路径, 日志数据)]，日志数据已重放过各自的 journal
+        compressed_files: 合并结果的 compressed_files（空的 dict 或 CompactFileTable）
+
+    - compressed_files 按文件哈希去重，内容相同的图片只保留一条，其他路径记为 duplicates
+    - 每个节点的 key 使用次数单独保存在 merged_nodes 中，合并结果为各节点之和；
+      同一节点出现多次时（例如把上次合并的结果也作为输入）只取压缩次数最多的一份，
+      重复合并不会重复计数
+    - 各节点从 API 得到的总次数取最大值，合并后的使用次数不会低于它
+
+    返回:
+        dict: 合并后的日志
+    """
+    algorithms = {log_data.get('hash_algorithm', 'md5') for _, log_data in logs}
+    if len(algorithms) > 1:
+        raise ValueError(f"各节点的哈希算法不一致（{', '.join(sorted(algorithms))}），"
+                         f"请先统一 hash_algorithm 后在各节点重新运行一次")
+
+    nodes = {}
+    reported = {}
+    key_details = {}
+    current_key_index = 0
+    last_run_time = None
+    for path, log_data in logs:
+        # 合并过的日志带有各节点的记录，未合并的日志本身是一个节点
+        sources = log_data.get('merged_nodes') or {node_id(log_data, path): node_state(log_data)}
+        for name, state in sources.items():
+            if name not in nodes or state['total_compressions'] > nodes[name]['total_compressions']:
+                nodes[name] = state
+
+        for key, count in log_data.get('key_reported_usage', {}).items():
+            reported[key] = max(reported.get(key, 0), count)
+        for key, details in log_data.get('key_details', {}).items():
+            merged = key_details.setdefault(key, dict(details))
+            for name, pick in (('first_used', min), ('last_used', max)):
+                values = [v for v in (merged.get(name), details.get(name)) if v]
+                merged[name] = pick(values) if values else None
+        current_key_index = max(current_key_index, log_data.get('current_key_index', 0))
+        if log_data.get('last_run_time'):
+            last_run_time = max(last_run_time or '', log_data['last_run_time'])
+
+        for file_hash, entry in log_data['compressed_files'].items():
+            merge_entry(compressed_files, file_hash, entry)
+
+    key_usage = {}
+    for state in nodes.values():
+        for key, usage in state['key_usage'].items():
+            key_usage[key] = key_usage.get(key, 0) + usage
+    for key, count in reported.items():
+        key_usage[key] = max(key_usage.get(key, 0), count)
+    for key, details in key_details.items():
+        details['total_usage'] = key_usage.get(key, 0)
+
+    return {
+        'compressed_files': compressed_files,
+        'key_usage': key_usage,
+        'key_details': key_details,
+        'current_key_index': current_key_index,
+        'total_compressions': sum(state['total_compressions'] for state in nodes.values()),
+        'last_run_time': last_run_time,
+        'journal_seq': 0,
+        'hash_algorithm': algorithms.pop() if algorithms else 'md5',
+        'summary': build_summary(compressed_files),
+        'key_reported_usage': reported,
+        'merged_nodes': nodes,
+    }
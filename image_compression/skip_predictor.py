@@ -0,0 +1,213 @@
+import io
+import os
+import json
+import threading
+from datetime import datetime
+
+from PIL import Image
+
+# libjpeg 标准亮度量化表在质量 50 时的平均值，用于估算 JPEG 质量
+STANDARD_LUMA_AVERAGE = 57.625
+
+# 每像素比特数的分组上限
+BPP_BUCKETS = (0.5, 1, 2, 4, 8, 16)
+
+
+def estimate_jpeg_quality(img):
+    """根据亮度量化表估算 JPEG 的保存质量（1-100），无法估算时返回 None"""
+    tables = getattr(img, 'quantization', None)
+    if not tables or 0 not in tables:
+        return None
+    scale = sum(tables[0]) / len(tables[0]) / STANDARD_LUMA_AVERAGE * 100
+    if scale <= 100:
+        quality = (200 - scale) / 2
+    else:
+        quality = 5000 / scale
+    return max(1, min(100, round(quality)))
+
+
+def bpp_bucket(bpp):
+    for upper in BPP_BUCKETS:
+        if bpp < upper:
+            return f"<{upper}"
+    return f">={BPP_BUCKETS[-1]}"
+
+
+def image_features(data, file_ext):
+    """只解析图片头部（不解码像素）得到预测用的特征，无法识别时返回 None"""
+    return header_features(io.BytesIO(data), len(data), file_ext)
+
+
+def header_features(source, file_size, file_ext):
+    """source 为文件路径或文件对象，file_size 为文件大小"""
+    try:
+        with Image.open(source) as img:
+            width, height = img.size
+            mode = img.mode
+            quality = estimate_jpeg_quality(img) if img.format == 'JPEG' else None
+            palette_size = len(img.getpalette() or []) // 3 if mode == 'P' else None
+    except Exception:
+        return None
+    if not width or not height:
+        return None
+
+    bpp = file_size * 8 / (width * height)
+    if file_ext in ('.jpg', '.jpeg'):
+        if quality is None:
+            kind = 'q?'
+        elif quality <= 60:
+            kind = 'q<=60'
+        elif quality <= 80:
+            kind = 'q61-80'
+        elif quality <= 90:
+            kind = 'q81-90'
+        else:
+            kind = 'q>90'
+    elif mode == 'P':
+        kind = 'palette'
+    elif mode in ('RGBA', 'LA', 'PA'):
+        kind = 'alpha'
+    else:
+        kind = mode.lower()
+
+    return {
+        'ext': file_ext,
+        'kind': kind,
+        'width': width,
+        'height': height,
+        'bpp': round(bpp, 3),
+        'jpeg_quality': quality,
+        'palette_size': palette_size,
+        'bucket': f"{file_ext}|{kind}|{bpp_bucket(bpp)}",
+    }
+
+
+def prior_savings(features):
+    """没有历史数据时的经验估计（压缩率百分比）"""
+    ext, kind, bpp = features['ext'], features['kind'], features['bpp']
+    if ext in ('.jpg', '.jpeg'):
+        if kind in ('q<=60', 'q61-80'):
+            return 8 if bpp < 1 else 15
+        if kind == 'q81-90':
+            return 30
+        return 50
+    if ext == '.png':
+        if kind == 'palette':
+            # 已经是调色板图片，通常已经量化过
+            return 10
+        return 15 if bpp < 2 else 55
+    if ext == '.webp':
+        return 15
+    return 30
+
+
+class SkipPredictor:
+    """上传前预测 TinyPNG 能节省多少空间，预计节省太少的图片不调用 API
+
+    按 (格式, 类型, 每像素比特数) 分组统计实际压缩率，预测值是经验估计与
+    该组历史平均值的加权平均（历史样本数达到 min_samples 时各占一半）。
+    分组统计保存在 stats_file 中，每次压缩后更新；首次使用时从压缩日志中
+    源文件仍存在的记录学习。
+    """
+
+    def __init__(self, min_savings, stats_file='skip_stats.json', log_file='skip_decisions.jsonl',
+                 min_samples=5):
+        self.min_savings = min_savings
+        self.stats_file = stats_file
+        self.log_file = log_file
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        # 分组 -> [样本数, 压缩率之和]
+        self.stats = {}
+        self.dirty = False
+        self.loaded = False
+        if os.path.exists(stats_file):
+            try:
+                with open(stats_file, 'r', encoding='utf-8') as f:
+                    self.stats = json.load(f)
+                self.loaded = True
+            except ValueError:
+                print(f"警告: 跳过预测统计已损坏，将重新学习: {stats_file}")
+
+    def predict(self, features):
+        """返回 (预计压缩率百分比, 该分组的历史样本数)"""
+        with self.lock:
+            count, total = self.stats.get(features['bucket'], (0, 0.0))
+        prior = prior_savings(features)
+        predicted = (prior * self.min_samples + total) / (self.min_samples + count)
+        return round(predicted, 2), count
+
+    def should_skip(self, features):
+        predicted, samples = self.predict(features)
+        return predicted < self.min_savings, predicted, samples
+
+    def learn(self, features, savings):
+        """记录一次实际的压缩率（百分比）"""
+        with self.lock:
+            count, total = self.stats.get(features['bucket'], (0, 0.0))
+            self.stats[features['bucket']] = [count + 1, round(total + savings, 4)]
+            self.dirty = True
+
+    def bootstrap(self, compressed_files, limit=2000, max_width=None):
+        """首次使用时，从压缩日志中源文件仍存在的记录学习
+
+        参数:
+            max_width: 启用了缩放时的最大宽度，超过的图片压缩率包含了缩放的效果，不用于学习
+        """
+        if self.loaded:
+            return
+        learned = 0
+        for entry in compressed_files.values():
+            if learned >= limit:
+                break
+            if entry.get('backend', 'tinypng') != 'tinypng' or not entry.get('original_size'):
+                continue
+            if entry.get('variant'):
+                # 变体的压缩率包含了缩放和格式转换的效果
+                continue
+            try:
+                size = os.stat(entry['source_path']).st_size
+            except OSError:
+                continue
+            if size != entry['original_size']:
+                # 源文件已经变化
+                continue
+            features = header_features(entry['source_path'], size,
+                                       os.path.splitext(entry['source_path'])[1].lower())
+            if features is None or (max_width and features['width'] > max_width):
+                continue
+            self.learn(features, (1 - entry['compressed_size'] / entry['original_size']) * 100)
+            learned += 1
+        self.loaded = True
+        # 没有可学习的记录时也保存，之后不再重复扫描日志
+        self.dirty = True
+        if learned:
+            print(f"跳过预测: 已从压缩日志中学习 {learned} 条记录")
+
+    def log_decision(self, source_path, features, predicted, samples, decision, actual=None):
+        """追加一条预测记录，用于调整 skip_min_savings"""
+        if not self.log_file:
+            return
+        record = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'path': source_path,
+            'decision': decision,
+            'predicted': predicted,
+            'samples': samples,
+            'actual': None if actual is None else round(actual, 2),
+        }
+        record.update({name: features[name] for name in ('bucket', 'bpp', 'jpeg_quality', 'palette_size')})
+        line = json.dumps(record, ensure_ascii=False)
+        with self.lock:
+            with open(self.log_file, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            temp_path = self.stats_file + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.stats, f, indent=1, ensure_ascii=False)
+            os.replace(temp_path, self.stats_file)
+            self.dirty = False
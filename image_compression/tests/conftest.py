@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def save_image(path, color, size=(64, 48)):
+    """生成一张纯色测试图片"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new('RGB', size, color).save(path)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """在临时目录中运行（日志、索引等文件都写在当前目录）"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def make_compressor(workdir):
+    """写入 config.json 并创建 ImageCompressor，默认使用 local 后端，不访问网络"""
+    from image_compressor import ImageCompressor
+
+    created = []
+
+    def make(**overrides):
+        config = {
+            'api_keys': ['test-key-1'],
+            'source_folder': './images',
+            'output_folder': './out',
+            'max_compressions_per_key': 500,
+            'enable_resize': False,
+            'concurrency': 1,
+            'backend': 'local',
+            'supported_formats': ['.png', '.jpg'],
+        }
+        config.update(overrides)
+        with open('config.json', 'w', encoding='utf-8') as f:
+            json.dump(config, f)
+        compressor = ImageCompressor()
+        created.append(compressor)
+        return compressor
+
+    yield make
+    for compressor in created:
+        compressor.close()
@@ -0,0 +1,62 @@
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+from conftest import save_image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from mock_tinypng import MockTinyPNGServer
+
+
+@pytest.fixture
+def mock_server():
+    """在后台线程中运行本地模拟的 TinyPNG API"""
+    server = MockTinyPNGServer().start()
+    yield server
+    server.stop()
+
+
+def async_options(server, **overrides):
+    options = {'backend': 'tinypng', 'concurrency': 4,
+               'tinypng_options': {'engine': 'async', 'api_endpoint': server.endpoint}}
+    options.update(overrides)
+    return options
+
+
+def test_async_engine_compresses_and_resumes(make_compressor, mock_server):
+    for i in range(6):
+        save_image(f'images/sub{i % 2}/{i}.png', (i * 40, 20, 20))
+    compressor = make_compressor(**async_options(mock_server))
+    compressor.run()
+
+    assert compressor.counts['compressed'] == 6 and compressor.counts['failed'] == 0
+    for i in range(6):
+        # 模拟服务原样返回上传的数据
+        with open(f'images/sub{i % 2}/{i}.png', 'rb') as f, open(f'out/sub{i % 2}/{i}.png', 'rb') as g:
+            assert f.read() == g.read()
+    records = compressor.log_data['compressed_files']
+    assert len(records) == 6
+    assert {entry['backend'] for entry in records.values()} == {'tinypng'}
+    # 记录的使用次数与服务器返回的 Compression-Count 一致
+    assert compressor.log_data['key_usage'] == {'test-key-1': 6} == mock_server.counts
+    compressor.close()
+
+    # 再次运行全部跳过，不调用 API
+    compressor = make_compressor(**async_options(mock_server))
+    compressor.run()
+    assert compressor.counts['compressed'] == 0 and compressor.counts['skipped'] == 6
+    assert mock_server.counts == {'test-key-1': 6}
+
+
+def test_async_engine_resize_on_server_counts_two_calls(make_compressor, mock_server):
+    save_image('images/wide.png', (30, 120, 200), size=(64, 48))
+    compressor = make_compressor(**async_options(mock_server, enable_resize=True, max_width=32,
+                                                 resize_on_server=True))
+    compressor.run()
+
+    assert compressor.counts['compressed'] == 1
+    with Image.open('out/wide.png') as image:
+        assert image.width == 32
+    assert compressor.log_data['key_usage'] == {'test-key-1': 2} == mock_server.counts
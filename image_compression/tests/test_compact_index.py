@@ -0,0 +1,105 @@
+import io
+import json
+
+from conftest import save_image
+from compact_index import CompactFileTable, LazyFileTable, load_compact_log, dump_log
+
+
+def make_entry(i):
+    return {
+        'source_path': f"./images/{i}.png",
+        'output_path': f"./out/图片{i}.png",
+        'original_size': 1000 + i,
+        'compressed_size': 500,
+        'compression_ratio': f"{(1 - 500 / (1000 + i)) * 100:.2f}%",
+        'compressed_at': "2025-01-02T03:04:05.000006",
+        'duplicates': [{'source_path': f"./images/copy{i}.png", 'nested': {}}],
+    }
+
+
+def write_log(path, compressed_files, indent=4):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'compressed_files': compressed_files, 'key_usage': {'k': 3}, 'journal_seq': 7},
+                  f, indent=indent, ensure_ascii=False)
+
+
+def test_lazy_table_reads_entries_on_demand(tmp_path):
+    path = str(tmp_path / 'compression_log.json')
+    expected = {f"{i:032x}": make_entry(i) for i in range(5)}
+    write_log(path, expected)
+
+    log_data = load_compact_log(path)
+    table = log_data['compressed_files']
+    assert isinstance(table, LazyFileTable)
+    assert not table.entries
+    assert log_data['key_usage'] == {'k': 3} and log_data['journal_seq'] == 7
+    assert len(table) == 5 and f"{1:032x}" in table and 'missing' not in table
+    assert table[f"{3:032x}"] == expected[f"{3:032x}"]
+    # 未修改时写回与 json.dump 相同
+    buffer = io.StringIO()
+    dump_log(log_data, buffer)
+    with open(path, encoding='utf-8') as f:
+        assert buffer.getvalue() == f.read()
+    table.close()
+
+
+def test_lazy_table_switches_to_saved_snapshot(tmp_path):
+    path = str(tmp_path / 'compression_log.json')
+    expected = {f"{i:032x}": make_entry(i) for i in range(5)}
+    write_log(path, expected)
+    log_data = load_compact_log(path)
+    table = log_data['compressed_files']
+
+    entry = table[f"{1:032x}"]
+    entry['compressed_size'] = 1
+    table[f"{1:032x}"] = entry
+    table['new'] = make_entry(9)
+    del table[f"{2:032x}"]
+    expected[f"{1:032x}"]['compressed_size'] = 1
+    expected['new'] = make_entry(9)
+    del expected[f"{2:032x}"]
+    assert len(table) == len(expected)
+
+    with open(path + '.tmp', 'w', encoding='utf-8', newline='\n') as f:
+        offsets = dump_log(log_data, f)
+    table.close()
+    (tmp_path / 'compression_log.json.tmp').replace(path)
+    table.reopen(path, offsets)
+
+    assert not table.entries
+    assert dict(table.items()) == expected
+    # 写回时记录的位置与重新读取时找到的位置相同
+    reloaded = load_compact_log(path)['compressed_files']
+    assert reloaded.offsets == offsets
+    table.close()
+    reloaded.close()
+
+
+def test_reformatted_log_is_parsed_fully(tmp_path):
+    path = str(tmp_path / 'compression_log.json')
+    expected = {f"{i:032x}": make_entry(i) for i in range(3)}
+    write_log(path, expected, indent=2)
+
+    table = load_compact_log(path)['compressed_files']
+    assert type(table) is CompactFileTable
+    assert dict(table.items()) == expected
+
+
+def test_second_run_keeps_reading_lazily(make_compressor):
+    save_image('images/a.png', (200, 30, 30))
+    save_image('images/b.png', (30, 200, 30))
+    compressor = make_compressor()
+    compressor.run()
+    compressor.close()
+
+    save_image('images/c.png', (30, 30, 200))
+    compressor = make_compressor()
+    table = compressor.log_data['compressed_files']
+    assert isinstance(table, LazyFileTable) and len(table) == 2
+    compressor.run()
+    assert len(compressor.log_data['compressed_files']) == 3
+    compressor.close()
+    with open('compression_log.json', encoding='utf-8') as f:
+        saved = json.load(f)['compressed_files']
+    assert sorted(entry['source_path'] for entry in saved.values()) == [
+        './images/a.png', './images/b.png', './images/c.png']
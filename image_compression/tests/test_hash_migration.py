@@ -0,0 +1,61 @@
+import os
+import json
+
+from conftest import save_image
+from hashing import hash_algorithm_of, hash_file
+
+
+def saved_log():
+    with open('compression_log.json', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_md5_to_blake2b_round_trip(make_compressor):
+    save_image('images/a.png', (200, 30, 30))
+    save_image('images/b.png', (30, 200, 30))
+    save_image('images/gone.png', (30, 30, 200))
+    compressor = make_compressor(hash_algorithm='md5')
+    compressor.run()
+    compressor.close()
+    gone_hash = hash_file('images/gone.png', 'md5')
+    os.remove('images/gone.png')
+
+    # 改用 blake2b：源文件仍存在的记录换成新哈希，已删除的保留旧哈希，不重新压缩
+    compressor = make_compressor(hash_algorithm='blake2b')
+    compressor.run()
+    compressor.close()
+    assert compressor.counts['compressed'] == 0 and compressor.counts['skipped'] == 2
+    log_data = saved_log()
+    assert log_data['hash_algorithm'] == 'blake2b'
+    assert sorted(hash_algorithm_of(h) for h in log_data['compressed_files']) == ['blake2b', 'blake2b', 'md5']
+    assert hash_file('images/a.png', 'blake2b') in log_data['compressed_files']
+    assert log_data['compressed_files'][gone_hash]['source_path'] == './images/gone.png'
+    assert log_data['summary']['files'] == 3
+
+    # 再改回 md5：同样只迁移，不重新压缩，记录与最初一致
+    compressor = make_compressor(hash_algorithm='md5')
+    compressor.run()
+    compressor.close()
+    assert compressor.counts['compressed'] == 0 and compressor.counts['skipped'] == 2
+    log_data = saved_log()
+    assert log_data['hash_algorithm'] == 'md5'
+    assert set(log_data['compressed_files']) == {
+        hash_file('images/a.png', 'md5'), hash_file('images/b.png', 'md5'), gone_hash}
+    assert log_data['total_compressions'] == 3
+
+
+def test_changed_source_keeps_old_hash_and_is_recompressed(make_compressor):
+    save_image('images/a.png', (200, 30, 30))
+    compressor = make_compressor(hash_algorithm='md5')
+    compressor.run()
+    compressor.close()
+    old_hash = hash_file('images/a.png', 'md5')
+
+    # 迁移前源文件已经变化：旧哈希对不上，保留旧记录，新内容正常压缩
+    save_image('images/a.png', (30, 30, 200), size=(80, 60))
+    compressor = make_compressor(hash_algorithm='blake2b')
+    compressor.run()
+    compressor.close()
+    assert compressor.counts['compressed'] == 1
+    log_data = saved_log()
+    assert set(log_data['compressed_files']) == {old_hash, hash_file('images/a.png', 'blake2b')}
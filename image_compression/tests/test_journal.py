@@ -0,0 +1,33 @@
+import json
+
+from image_compressor import read_journal
+
+
+def test_append_after_torn_tail_keeps_new_record(make_compressor):
+    compressor = make_compressor()
+    first = {'seq': 1, 'type': 'duplicate', 'hash': 'a'}
+    # 上次运行在写第二条记录时被杀死，只留下半行
+    with open(compressor.journal_file, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(first) + '\n' + '{"seq": 2, "type": "dup')
+
+    record = {'seq': 2, 'type': 'duplicate', 'hash': 'b'}
+    with compressor.lock:
+        compressor.append_journal(record)
+    compressor.journal.close()
+    compressor.journal = None
+
+    assert list(read_journal(compressor.journal_file)) == [first, record]
+
+
+def test_torn_tail_without_newline_is_dropped(make_compressor):
+    compressor = make_compressor()
+    with open(compressor.journal_file, 'w', encoding='utf-8') as f:
+        f.write('{"seq": 1, "ty')
+
+    record = {'seq': 1, 'type': 'duplicate', 'hash': 'b'}
+    with compressor.lock:
+        compressor.append_journal(record)
+    compressor.journal.close()
+    compressor.journal = None
+
+    assert list(read_journal(compressor.journal_file)) == [record]
@@ -0,0 +1,79 @@
+import threading
+
+import pytest
+
+from key_scheduler import KeyScheduler
+from log_summary import new_summary, add_compression, build_summary
+
+
+def make_scheduler(usage, max_usage=10, keys=('k1',)):
+    log_data = {'key_usage': dict(usage)}
+    return KeyScheduler(list(keys), log_data, max_usage, threading.Condition(threading.RLock()))
+
+
+def test_acquire_reserves_all_calls():
+    scheduler = make_scheduler({'k1': 7})
+    key, _ = scheduler.acquire(2)
+    assert key == 'k1'
+    assert scheduler.remaining('k1') == 1
+    scheduler.release(key, 2)
+    assert scheduler.remaining('k1') == 3
+
+
+def test_acquire_rejects_key_without_enough_quota():
+    scheduler = make_scheduler({'k1': 9})
+    with pytest.raises(Exception):
+        scheduler.acquire(2)
+    assert scheduler.acquire(1) == ('k1', 0)
+
+
+def test_summary_counts_server_resize_calls():
+    entry = {'source_path': 'a.png', 'original_size': 100, 'compressed_size': 50,
+             'compressed_at': '2024-01-01T00:00:00', 'api_key_used': 'k1...', 'api_calls': 2}
+    summary = new_summary()
+    add_compression(summary, entry, 'k1', 2)
+    assert summary['api_calls'] == 2
+    assert summary['by_day']['2024-01-01'][3] == 2
+    assert build_summary({'h': entry})['api_calls'] == 2
+
+
+def acquire_in_thread(scheduler):
+    result = {}
+
+    def target():
+        try:
+            result['key'] = scheduler.acquire()
+        except Exception as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    return thread, result
+
+
+def test_acquire_waits_for_in_flight_requests():
+    scheduler = make_scheduler({'k1': 9})
+    key, _ = scheduler.acquire()
+    thread, result = acquire_in_thread(scheduler)
+    thread.join(0.2)
+    # 额度被进行中的请求占用，不报错而是等待
+    assert thread.is_alive()
+
+    # 请求失败，额度释放后分配给等待的线程
+    scheduler.release(key)
+    thread.join(5)
+    assert result == {'key': ('k1', 0)}
+
+
+def test_acquire_fails_once_quota_is_used():
+    scheduler = make_scheduler({'k1': 9})
+    key, _ = scheduler.acquire()
+    thread, result = acquire_in_thread(scheduler)
+    thread.join(0.2)
+    assert thread.is_alive()
+
+    with scheduler.lock:
+        scheduler.log_data['key_usage'][key] = 10
+    scheduler.release(key)
+    thread.join(5)
+    assert 'error' in result
@@ -0,0 +1,110 @@
+import time
+import sqlite3
+
+from conftest import save_image
+from log_store import SQLiteLogStore
+from log_summary import new_summary, build_summary
+
+
+def make_log(journal_seq):
+    return {'compressed_files': {}, 'key_usage': {'k1': journal_seq}, 'key_details': {},
+            'journal_seq': journal_seq, 'summary': new_summary()}
+
+
+def test_summary_is_only_written_at_checkpoints(tmp_path):
+    store = SQLiteLogStore(str(tmp_path / 'log.db'))
+    log_data = store.import_log(make_log(1))
+    log_data['summary']['files'] = 5
+    log_data['journal_seq'] = 2
+    log_data['key_usage']['k1'] = 2
+    store.save(log_data, checkpoint=False)
+
+    # key 使用次数每条记录都写入
+    loaded = store.load()
+    assert loaded['key_usage'] == {'k1': 2}
+    # 检查点之后又有新的记录，汇总统计已经落后，读取时丢弃
+    assert 'summary' not in loaded
+
+    store.save(log_data)
+    loaded = store.load()
+    assert loaded['summary']['files'] == 5
+    assert 'summary_seq' not in loaded
+    store.close()
+
+
+def test_sqlite_run_keeps_summary_consistent(make_compressor):
+    for i in range(3):
+        save_image(f'images/{i}.png', (i * 60, 10, 10))
+    compressor = make_compressor(log_store='sqlite')
+    compressor.run()
+    compressor.close()
+
+    compressor = make_compressor(log_store='sqlite')
+    summary = compressor.log_data['summary']
+    assert summary == build_summary(compressor.log_data['compressed_files'])
+    assert summary['files'] == 3
+
+
+def test_deleting_database_does_not_reimport_json_log(make_compressor):
+    import os
+    save_image('images/a.png', (10, 10, 200))
+    compressor = make_compressor()
+    compressor.run()
+    compressor.close()
+
+    # 切换到 SQLite：导入 JSON 日志
+    compressor = make_compressor(log_store='sqlite')
+    assert len(compressor.log_data['compressed_files']) == 1
+    compressor.close()
+    assert not os.path.exists('compression_log.json')
+    assert os.path.exists('compression_log.json.imported')
+
+    # 按说明删除数据库重新开始：不应再次导入旧的 JSON 日志
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists('compression_log.db' + suffix):
+            os.remove('compression_log.db' + suffix)
+    compressor = make_compressor(log_store='sqlite')
+    assert len(compressor.log_data['compressed_files']) == 0
+
+
+def committed_usage(path):
+    """另一个连接（例如查看统计）能看到的 key 使用次数"""
+    conn = sqlite3.connect(path)
+    try:
+        return dict(conn.execute("SELECT api_key, usage FROM api_keys").fetchall())
+    finally:
+        conn.close()
+
+
+def test_records_are_committed_in_batches(tmp_path):
+    path = str(tmp_path / 'log.db')
+    store = SQLiteLogStore(path, batch_size=3, batch_ms=60000)
+    log_data = store.import_log(make_log(1))
+    for usage in (2, 3):
+        log_data['key_usage']['k1'] = usage
+        store.save(log_data, checkpoint=False)
+    # 未满一批时其他连接只能看到上次提交的结果，本连接能看到最新的
+    assert committed_usage(path) == {'k1': 1}
+    assert store.load()['key_usage'] == {'k1': 3}
+
+    log_data['key_usage']['k1'] = 4
+    store.save(log_data, checkpoint=False)
+    assert committed_usage(path) == {'k1': 4}
+
+    log_data['key_usage']['k1'] = 5
+    store.save(log_data, checkpoint=False)
+    store.close()
+    assert committed_usage(path) == {'k1': 5}
+
+
+def test_pending_records_are_committed_after_batch_ms(tmp_path):
+    path = str(tmp_path / 'log.db')
+    store = SQLiteLogStore(path, batch_size=100, batch_ms=50)
+    log_data = store.import_log(make_log(1))
+    log_data['key_usage']['k1'] = 2
+    store.save(log_data, checkpoint=False)
+    deadline = time.monotonic() + 5
+    while committed_usage(path) != {'k1': 2} and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert committed_usage(path) == {'k1': 2}
+    store.close()
@@ -0,0 +1,19 @@
+import os
+import re
+
+from conftest import save_image
+
+
+def test_concurrent_output_is_grouped_per_image(make_compressor, capsys):
+    for i in range(24):
+        save_image(f'images/{i}.png', (i * 10, 80, 160), size=(120 + i, 90))
+    compressor = make_compressor(concurrency=8)
+    compressor.run()
+    lines = capsys.readouterr().out.splitlines()
+
+    headers = [n for n, line in enumerate(lines) if re.match(r'\[\d+/\d+\] 处理: ', line)]
+    assert len(headers) == 24
+    for n in headers:
+        name = os.path.basename(lines[n].split('处理: ')[1])
+        # 每张图片的结果紧跟在它自己的标题之后
+        assert lines[n + 1] == f"[OK] 压缩成功: {name}"
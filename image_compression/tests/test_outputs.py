@@ -0,0 +1,150 @@
+import os
+import json
+
+from conftest import save_image
+
+
+def test_recompress_does_not_change_hardlinked_duplicate(make_compressor):
+    # 内容相同的两张图片，第二张复用第一张的结果（auto 时通常为硬链接）
+    save_image('images/a.png', (200, 30, 30))
+    save_image('images/b.png', (200, 30, 30))
+    compressor = make_compressor()
+    compressor.run()
+    compressor.close()
+    with open('out/b.png', 'rb') as f:
+        duplicate = f.read()
+
+    # 修改 a.png 后重新压缩，b.png 的输出不应随之改变
+    save_image('images/a.png', (30, 30, 200), size=(80, 60))
+    compressor = make_compressor()
+    compressor.run()
+
+    with open('out/b.png', 'rb') as f:
+        assert f.read() == duplicate
+    with open('out/a.png', 'rb') as f:
+        assert f.read() != duplicate
+    assert not os.path.exists('out/a.png.tmp')
+
+
+def test_new_variant_is_generated_for_completed_directory(make_compressor):
+    save_image('images/sub/a.png', (20, 120, 40), size=(200, 100))
+    compressor = make_compressor(prune_unchanged_dirs=True)
+    compressor.run()
+    compressor.close()
+    assert os.path.exists('out/sub/a.png')
+
+    # 目录已记录为完成，新增变体后仍需要处理其中的图片
+    compressor = make_compressor(prune_unchanged_dirs=True,
+                                 variants=[{'name': 'small', 'max_width': 50}])
+    compressor.run()
+    assert os.path.exists('out/sub/a-small.png')
+
+
+def test_unsharded_run_after_shard_does_not_prune(make_compressor):
+    for i in range(6):
+        save_image(f'images/sub/{i}.png', (i * 40, 60, 90))
+    compressor = make_compressor(prune_unchanged_dirs=True, shard_index=1, shard_count=2)
+    compressor.run()
+    compressor.close()
+    assert 0 < len(os.listdir('out/sub')) < 6
+
+    # 不分片运行时，上次只完成了分片 1 的目录不能跳过
+    compressor = make_compressor(prune_unchanged_dirs=True)
+    compressor.run()
+    assert len(os.listdir('out/sub')) == 6
+
+
+def test_source_is_read_once(make_compressor, monkeypatch):
+    import image_compressor
+
+    def fail(*args):
+        raise AssertionError("源文件已读入内存，不应再次读取计算哈希")
+
+    monkeypatch.setattr(image_compressor, 'hash_file', fail)
+    save_image('images/a.png', (10, 200, 10))
+    compressor = make_compressor()
+    compressor.run()
+    assert os.path.exists('out/a.png')
+    assert compressor.metrics.bytes['read'] == os.path.getsize('images/a.png')
+
+
+def test_crashed_resize_pool_marks_image_failed(make_compressor):
+    from concurrent.futures.process import BrokenProcessPool
+
+    class CrashingPool:
+        def resize(self, *args):
+            raise BrokenProcessPool("crashed")
+
+        def close(self):
+            pass
+
+    save_image('images/a.png', (90, 90, 10), size=(300, 200))
+    compressor = make_compressor(enable_resize=True, max_width=100)
+    compressor.resize_pool = CrashingPool()
+    compressor.run()
+    # 不上传未缩放的原图
+    assert not os.path.exists('out/a.png')
+    assert compressor.counts['failed'] == 1
+    assert os.path.abspath('images/a.png') in {os.path.abspath(p) for p in compressor.failed_paths}
+
+
+def test_deleting_log_recompresses_pruned_directories(make_compressor):
+    save_image('images/sub/a.png', (120, 40, 200))
+    compressor = make_compressor(prune_unchanged_dirs=True)
+    compressor.run()
+    compressor.close()
+
+    # 按说明删除日志重新压缩：旧的汇总文件和目录索引不应再生效
+    os.remove('compression_log.json')
+    os.remove('out/sub/a.png')
+    compressor = make_compressor(prune_unchanged_dirs=True)
+    if os.path.exists('compression_summary.json'):
+        with open('compression_summary.json', encoding='utf-8') as f:
+            assert json.load(f)['summary']['files'] == 0
+    compressor.run()
+    assert os.path.exists('out/sub/a.png')
+
+
+def test_reuse_skips_outputs_overwritten_by_newer_compression(make_compressor):
+    save_image('images/a.png', (200, 30, 30))
+    save_image('images/b.png', (200, 30, 30))
+    compressor = make_compressor()
+    compressor.run()
+    compressor.close()
+    with open('out/b.png', 'rb') as f:
+        old_output = f.read()
+
+    # a.png 修改后重新压缩到同一个输出路径，旧记录的 output_path 已是新内容
+    save_image('images/a.png', (30, 30, 200), size=(80, 60))
+    compressor = make_compressor()
+    compressor.run()
+    compressor.close()
+
+    # 内容与旧 a.png 相同的新图片应复用 b.png 的输出，而不是 a.png 的新输出
+    save_image('images/c.png', (200, 30, 30))
+    compressor = make_compressor()
+    compressor.run()
+    with open('out/c.png', 'rb') as f:
+        assert f.read() == old_output
+
+
+def test_stale_entry_is_recompressed(make_compressor):
+    save_image('images/a.png', (200, 30, 30))
+    compressor = make_compressor()
+    compressor.run()
+    compressor.close()
+    with open('out/a.png', 'rb') as f:
+        old_output = f.read()
+
+    save_image('images/a.png', (30, 30, 200), size=(80, 60))
+    compressor = make_compressor()
+    compressor.run()
+    compressor.close()
+
+    # 旧内容唯一的输出已被覆盖，只能重新压缩
+    save_image('images/c.png', (200, 30, 30))
+    compressor = make_compressor()
+    compressor.run()
+    assert compressor.counts['compressed'] == 1
+    with open('out/c.png', 'rb') as f:
+        assert f.read() == old_output
@@ -0,0 +1,74 @@
+import os
+
+from conftest import save_image
+
+
+def test_plan_does_not_spend_quota_on_compressed_files(make_compressor):
+    save_image('images/a.png', (200, 10, 10))
+    compressor = make_compressor()
+    compressor.run()
+    compressor.close()
+
+    # 没有哈希索引（例如删除了 hash_index.json）时，已压缩的图片不应占用额度
+    os.remove('hash_index.json')
+    save_image('images/b.png', (10, 200, 10))
+    compressor = make_compressor(backend='tinypng', max_compressions_per_key=1)
+    work_queue = compressor.start_plan('./images')
+
+    paths = []
+    while True:
+        item = work_queue.get()
+        if item is None:
+            break
+        paths.append(os.path.basename(item[1]))
+    assert sorted(paths) == ['a.png', 'b.png']
+    assert compressor.deferred_paths == []
+
+
+def drain_paths(work_queue):
+    paths = []
+    while True:
+        item = work_queue.get()
+        if item is None:
+            return paths
+        paths.append(os.path.basename(item[1]))
+
+
+def test_select_by_savings_charges_item_cost():
+    from planner import PlanItem, select_by_savings
+
+    items = [PlanItem('a', 100, 90, cost=3), PlanItem('b', 100, 50, cost=1), PlanItem('c', 100, 40, cost=1)]
+    selected, deferred = select_by_savings(items, 3)
+    assert [item.path for item in selected] == ['b', 'c']
+    assert [item.path for item in deferred] == ['a']
+    assert sum(item.cost for item in selected) <= 3
+
+
+def test_plan_charges_each_missing_variant(make_compressor):
+    variants = [{'name': 'small', 'max_width': 40}, {'name': 'medium', 'max_width': 80}]
+    for i in range(3):
+        save_image(f'images/{i}.png', (i * 80, 20, 20), size=(160, 100))
+    # 先用本地后端只生成 small，0.png 的 small 已压缩
+    compressor = make_compressor(variants=variants[:1], include=['0.png'])
+    compressor.run()
+    compressor.close()
+
+    compressor = make_compressor(backend='tinypng', max_compressions_per_key=4, variants=variants)
+    work_queue = compressor.start_plan('./images')
+    paths = drain_paths(work_queue)
+    # 0.png 只缺 medium（1 次），另外两张各 2 次，额度 4 只够其中一张
+    assert '0.png' in paths
+    assert len(paths) == 2
+    assert len(compressor.deferred_paths) == 1
+
+
+def test_plan_charges_two_calls_for_server_resize(make_compressor):
+    for i in range(4):
+        save_image(f'images/{i}.png', (i * 60, 20, 20), size=(300, 200))
+    compressor = make_compressor(backend='tinypng', max_compressions_per_key=5, enable_resize=True,
+                                 max_width=100, resize_on_server=True,
+                                 tinypng_options={'engine': 'async', 'api_endpoint': 'http://127.0.0.1:9'})
+    paths = drain_paths(compressor.start_plan('./images'))
+    # 每张图片 2 次，额度 5 只够两张
+    assert len(paths) == 2
+    assert len(compressor.deferred_paths) == 2
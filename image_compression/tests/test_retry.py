@@ -0,0 +1,155 @@
+import os
+import time
+import threading
+
+import tinify
+
+from conftest import save_image
+from retry import CircuitBreaker, RetryPolicy
+
+
+def start_waiter(breaker, passed):
+    """在线程中调用 breaker.wait()，返回后记入 passed"""
+    def run():
+        breaker.wait()
+        passed.append(threading.current_thread().name)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_breaker_opens_after_threshold_and_blocks_callers():
+    breaker = CircuitBreaker(failure_threshold=3, cooldown=60)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.open_until is None
+    breaker.record_failure()
+    assert breaker.open_until is not None and breaker.trips == 1
+
+    passed = []
+    thread = start_waiter(breaker, passed)
+    thread.join(0.1)
+    assert thread.is_alive() and not passed
+
+    # 非暂时性的错误响应也说明服务器正常，恢复并放行等待的线程
+    breaker.record_success()
+    thread.join(1)
+    assert len(passed) == 1 and breaker.open_until is None
+
+
+def test_half_open_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+
+    passed = []
+    threads = [start_waiter(breaker, passed) for _ in range(3)]
+    time.sleep(0.1)
+    # 冷却结束后只放行一个试探请求，其他线程等待试探结果
+    assert len(passed) == 1 and breaker.trial_in_flight
+
+    # 试探失败：再熔断一个 cooldown
+    breaker.record_failure()
+    assert breaker.trips == 2 and not breaker.trial_in_flight
+    time.sleep(0.1)
+    assert len(passed) == 2
+
+    # 第二次试探成功：所有线程恢复
+    breaker.record_success()
+    for thread in threads:
+        thread.join(1)
+    assert len(passed) == 3 and breaker.open_until is None
+
+
+def test_call_counts_only_transient_errors_as_failures():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=60)
+
+    def client_error():
+        raise tinify.ClientError("bad image")
+
+    try:
+        breaker.call(client_error)
+    except tinify.ClientError:
+        pass
+    assert breaker.open_until is None and breaker.consecutive_failures == 0
+
+
+def test_retry_delay_is_capped():
+    policy = RetryPolicy(max_attempts=10, base_delay=1, max_delay=4)
+    assert all(0 <= policy.delay(attempt) <= min(4, 2 ** (attempt - 1)) for attempt in range(1, 10))
+
+
+def flaky(compress, failures):
+    """前 failures 次调用抛出服务器错误，之后正常压缩"""
+    calls = []
+
+    def wrapper(data, file_ext, key=None):
+        calls.append(key)
+        if len(calls) <= failures:
+            raise tinify.ServerError("503 Service Unavailable")
+        return compress(data, file_ext, key)
+    return wrapper, calls
+
+
+def test_transient_errors_are_retried(make_compressor):
+    save_image('images/a.png', (200, 30, 30))
+    compressor = make_compressor(retry_base_delay=0, retry_max_attempts=4)
+    backend = compressor.get_backend('images/a.png')
+    backend.compress, calls = flaky(backend.compress, failures=2)
+    compressor.run()
+
+    assert len(calls) == 3
+    assert compressor.counts['compressed'] == 1 and compressor.counts['failed'] == 0
+    assert compressor.breaker.trips == 0
+
+
+def test_breaker_pauses_and_recovers_during_run(make_compressor):
+    save_image('images/a.png', (200, 30, 30))
+    compressor = make_compressor(retry_base_delay=0, retry_max_attempts=5,
+                                 circuit_failure_threshold=2, circuit_cooldown=0.05)
+    backend = compressor.get_backend('images/a.png')
+    backend.compress, calls = flaky(backend.compress, failures=3)
+    compressor.run()
+
+    # 连续两次失败后熔断，冷却后的试探失败再熔断一次，第二次试探成功
+    assert len(calls) == 4
+    assert compressor.breaker.trips == 2 and compressor.breaker.open_until is None
+    assert compressor.counts['compressed'] == 1
+
+
+def test_failure_after_max_attempts_is_recorded(make_compressor):
+    save_image('images/a.png', (200, 30, 30))
+    compressor = make_compressor(retry_base_delay=0, retry_max_attempts=2, requeue_failed=False)
+    backend = compressor.get_backend('images/a.png')
+    backend.compress, calls = flaky(backend.compress, failures=10)
+    compressor.run()
+
+    assert len(calls) == 2
+    assert compressor.counts['failed'] == 1
+    assert compressor.failed_paths == ['./images/a.png']
+
+
+def test_failed_list_is_only_written_when_there_are_failures(make_compressor):
+    save_image('images/a.png', (200, 30, 30))
+    save_image('images/b.png', (30, 200, 30))
+    compressor = make_compressor(retry_base_delay=0, retry_max_attempts=1, requeue_failed=False)
+    backend = compressor.get_backend('images/a.png')
+    backend.compress, _ = flaky(backend.compress, failures=1)
+    compressor.run()
+    compressor.close()
+    assert compressor.counts['failed'] == 1
+    assert os.path.exists('failed_images.json')
+
+    # 重新处理成功后删除失败列表
+    compressor = make_compressor()
+    compressor.run(retry_failed=True)
+    compressor.close()
+    assert compressor.counts['compressed'] == 1
+    assert not os.path.exists('failed_images.json')
+
+    # 没有失败的运行不创建失败列表
+    save_image('images/c.png', (30, 30, 200))
+    compressor = make_compressor()
+    compressor.run()
+    assert compressor.counts['compressed'] == 1
+    assert not os.path.exists('failed_images.json')
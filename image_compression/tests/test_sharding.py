@@ -0,0 +1,107 @@
+import json
+
+import pytest
+
+from sharding import merge_logs
+
+
+def make_entry(source_path, compressed_at, **extra):
+    entry = {
+        'source_path': source_path,
+        'output_path': source_path.replace('images', 'out'),
+        'original_size': 1000,
+        'compressed_size': 400,
+        'compression_ratio': "60.00%",
+        'compressed_at': compressed_at,
+        'api_key_index': 0,
+        'api_key_used': 'key-a...',
+        'backend': 'tinypng',
+    }
+    entry.update(extra)
+    return entry
+
+
+def make_shard_log(index, compressed_files, usage, reported=None):
+    return {
+        'compressed_files': compressed_files,
+        'key_usage': {'key-a': usage},
+        'key_details': {'key-a': {'first_used': f"2025-01-0{index}T00:00:00",
+                                  'last_used': f"2025-01-0{index}T12:00:00", 'total_usage': usage}},
+        'total_compressions': len(compressed_files),
+        'shard': {'index': index, 'count': 2},
+        'key_reported_usage': {'key-a': reported} if reported else {},
+        'hash_algorithm': 'md5',
+    }
+
+
+def test_conflicting_entries_keep_earliest_and_record_duplicates():
+    node1 = make_shard_log(1, {
+        'same': make_entry('./images/a.png', '2025-01-02T00:00:00'),
+        'only1': make_entry('./images/b.png', '2025-01-02T00:00:00'),
+    }, usage=2)
+    node2 = make_shard_log(2, {
+        'same': make_entry('./images/copy/a.png', '2025-01-01T00:00:00',
+                           duplicates={'./images/c.png': './out/c.png'}),
+    }, usage=1, reported=10)
+
+    merged = merge_logs([('1.json', node1), ('2.json', node2)], {})
+
+    entry = merged['compressed_files']['same']
+    # 较早的一条保留，另一条的路径和它的 duplicates 都记为 duplicates
+    assert entry['source_path'] == './images/copy/a.png'
+    assert entry['duplicates'] == {'./images/c.png': './out/c.png', './images/a.png': './out/a.png'}
+    assert set(merged['compressed_files']) == {'same', 'only1'}
+    # 各节点的使用次数相加，但不低于 API 返回的总次数
+    assert merged['key_usage'] == {'key-a': 10}
+    assert merged['total_compressions'] == 3
+    assert merged['key_details']['key-a']['first_used'] == "2025-01-01T00:00:00"
+    assert merged['key_details']['key-a']['last_used'] == "2025-01-02T12:00:00"
+    assert merged['summary']['files'] == 2 and merged['summary']['duplicates'] == 2
+
+    # 再次合并（上次的结果也作为输入）不会重复计数
+    again = merge_logs([('merged.json', merged), ('2.json', node2)], {})
+    assert again['key_usage'] == merged['key_usage']
+    assert again['total_compressions'] == merged['total_compressions']
+    assert again['compressed_files']['same']['duplicates'] == entry['duplicates']
+
+
+def test_real_compression_wins_over_predicted_skip():
+    node1 = make_shard_log(1, {'same': make_entry('./images/a.png', '2025-01-01T00:00:00',
+                                                  backend='copy', status='skipped')}, usage=0)
+    node2 = make_shard_log(2, {'same': make_entry('./images/b.png', '2025-01-02T00:00:00')}, usage=1)
+
+    for logs in ([('1.json', node1), ('2.json', node2)], [('2.json', node2), ('1.json', node1)]):
+        entry = merge_logs(logs, {})['compressed_files']['same']
+        assert entry['source_path'] == './images/b.png' and 'duplicates' not in entry
+
+
+def test_different_hash_algorithms_are_rejected():
+    node1 = make_shard_log(1, {}, usage=0)
+    node2 = dict(make_shard_log(2, {}, usage=0), hash_algorithm='blake2b')
+    with pytest.raises(ValueError):
+        merge_logs([('1.json', node1), ('2.json', node2)], {})
+
+
+def test_merge_command_reads_shard_logs_and_journals(make_compressor, workdir):
+    node1 = make_shard_log(1, {'same': make_entry('./images/a.png', '2025-01-02T00:00:00')}, usage=1)
+    node2 = make_shard_log(2, {}, usage=0)
+    for name, log_data in (('a', node1), ('b', node2)):
+        (workdir / name).mkdir()
+        with open(workdir / name / 'compression_log.json', 'w', encoding='utf-8') as f:
+            json.dump(dict(log_data, journal_seq=0), f, indent=4, ensure_ascii=False)
+    # 节点 2 的记录还在 journal 中，尚未合并进快照
+    record = {'seq': 1, 'hash': 'same', 'key': 'key-a', 'compression_count': None, 'calls': 1,
+              'entry': make_entry('./images/copy/a.png', '2025-01-01T00:00:00')}
+    with open(workdir / 'b' / 'compression_log.journal', 'w', encoding='utf-8') as f:
+        f.write(json.dumps(record) + '\n')
+
+    compressor = make_compressor()
+    compressor.merge_logs(['a/compression_log.json', 'b/compression_log.json'])
+
+    with open('compression_log.json', encoding='utf-8') as f:
+        saved = json.load(f)
+    entry = saved['compressed_files']['same']
+    assert entry['source_path'] == './images/copy/a.png'
+    assert entry['duplicates'] == {'./images/a.png': './out/a.png'}
+    assert saved['key_usage'] == {'key-a': 2}
+    assert set(saved['merged_nodes']) == {'1/2', '2/2'}
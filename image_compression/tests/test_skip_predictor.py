@@ -0,0 +1,44 @@
+import os
+import json
+
+from conftest import save_image
+
+
+def test_predicted_skip_is_not_recorded_as_compressed(make_compressor):
+    save_image('images/a.png', (200, 30, 30))
+    # 所有图片的预计压缩率都低于 100%，全部跳过，不会访问网络
+    compressor = make_compressor(backend='tinypng', skip_min_savings=100)
+    compressor.run()
+    compressor.close()
+
+    assert compressor.counts['predicted_skip'] == 1 and compressor.counts['compressed'] == 0
+    entry, = compressor.log_data['compressed_files'].values()
+    assert entry['status'] == 'skipped' and entry['backend'] == 'copy'
+    assert compressor.log_data['summary']['files'] == 0
+    assert compressor.log_data['total_compressions'] == 0
+    assert os.path.exists('out/a.png')
+
+    # 再次运行时重新预测，仍然跳过且输出未变时不再重新生成
+    mtime = os.stat('out/a.png').st_mtime_ns
+    compressor = make_compressor(backend='tinypng', skip_min_savings=100)
+    compressor.run()
+    compressor.close()
+    assert compressor.counts['predicted_skip'] == 1 and compressor.counts['skipped'] == 0
+    assert os.stat('out/a.png').st_mtime_ns == mtime
+
+
+def test_predicted_skip_is_compressed_in_later_run(make_compressor):
+    save_image('images/a.png', (200, 30, 30))
+    compressor = make_compressor(backend='tinypng', skip_min_savings=100, prune_unchanged_dirs=True)
+    compressor.run()
+    compressor.close()
+
+    # 不再跳过时（这里改用本地后端）实际压缩，记录替换为压缩结果并计入统计
+    compressor = make_compressor(backend='local', prune_unchanged_dirs=True)
+    compressor.run()
+    assert compressor.counts['compressed'] == 1 and compressor.pruned_images == 0
+    entry, = compressor.log_data['compressed_files'].values()
+    assert 'status' not in entry and entry['backend'] == 'local'
+    with open('compression_summary.json', encoding='utf-8') as f:
+        summary = json.load(f)['summary']
+    assert summary['files'] == 1
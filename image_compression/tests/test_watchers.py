@@ -0,0 +1,33 @@
+import os
+
+from conftest import save_image
+from watchers import PollingWatcher
+
+
+def accept_all(rel_path, is_dir=False):
+    return True
+
+
+def test_polling_detects_in_place_overwrite(tmp_path):
+    path = str(tmp_path / 'sub' / 'a.png')
+    save_image(path, (200, 30, 30))
+    watcher = PollingWatcher(str(tmp_path), accept_all)
+    assert watcher.poll() == []
+
+    # 原地覆盖写入不会改变目录的修改时间
+    dir_mtime = os.stat(os.path.dirname(path)).st_mtime_ns
+    save_image(path, (30, 30, 200), size=(80, 60))
+    assert os.stat(os.path.dirname(path)).st_mtime_ns == dir_mtime
+    assert watcher.poll() == [path]
+    assert watcher.poll() == []
+
+
+def test_overwrite_waits_for_full_scan_without_stat_files(tmp_path):
+    path = str(tmp_path / 'a.png')
+    save_image(path, (200, 30, 30))
+    watcher = PollingWatcher(str(tmp_path), accept_all, full_scan_interval=600, stat_files=False)
+
+    save_image(path, (30, 30, 200), size=(80, 60))
+    assert watcher.poll() == []
+    watcher.last_full_scan -= 600
+    assert watcher.poll() == [path]
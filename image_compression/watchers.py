@@ -0,0 +1,227 @@
+import os
+import time
+import threading
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+def relative_path(folder, path):
+    """相对 folder 的路径，使用 / 分隔"""
+    return os.path.relpath(path, folder).replace(os.sep, '/')
+
+
+class PollingWatcher:
+    """轮询目录修改时间，发现新增或修改的图片
+
+    新增、删除、重命名文件都会改变所在目录的修改时间，因此每次轮询只需要
+    stat 所有目录，只有修改时间变化的目录才重新列出文件。原地覆盖写入不会
+    改变目录修改时间：stat_files 为 True 时每次轮询还会 stat 已知的图片（每个文件
+    约几微秒），否则只能由每隔 full_scan_interval 秒一次的完整比对发现。
+    """
+
+    name = '目录轮询'
+
+    def __init__(self, folder, accept_path, full_scan_interval=600, stat_files=True):
+        self.folder = folder
+        self.accept_path = accept_path
+        self.full_scan_interval = full_scan_interval
+        self.stat_files = stat_files
+        # 目录路径 -> (修改时间, 其中的图片路径集合, 子目录路径集合)
+        self.dirs = {}
+        # 图片路径 -> (大小, 修改时间)
+        self.files = {}
+        # 建立初始快照，启动时已存在的图片由 run() 处理
+        self.scan_dir(folder, [], full=True)
+        self.last_full_scan = time.monotonic()
+
+    def scan_dir(self, directory, changed, full):
+        """列出目录，把新增或变化的图片加入 changed
+
+        新出现的子目录总是递归扫描；full 为 True 时递归扫描所有子目录。
+        """
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError:
+            self.forget_dir(directory)
+            return
+
+        files = set()
+        subdirs = set()
+        for entry in entries:
+            rel_path = relative_path(self.folder, entry.path)
+            try:
+                if entry.is_dir():
+                    if entry.is_symlink() or not self.accept_path(rel_path, is_dir=True):
+                        continue
+                    subdirs.add(entry.path)
+                    if full or entry.path not in self.dirs:
+                        self.scan_dir(entry.path, changed, full)
+                elif self.accept_path(rel_path):
+                    stat = entry.stat()
+                    signature = (stat.st_size, stat.st_mtime_ns)
+                    files.add(entry.path)
+                    if self.files.get(entry.path) != signature:
+                        self.files[entry.path] = signature
+                        changed.append(entry.path)
+            except OSError:
+                # 列出目录后文件被删除
+                continue
+
+        previous = self.dirs.get(directory)
+        if previous:
+            for path in previous[1] - files:
+                self.files.pop(path, None)
+            for path in previous[2] - subdirs:
+                self.forget_dir(path)
+        self.dirs[directory] = (mtime_ns, files, subdirs)
+
+    def forget_dir(self, directory):
+        """目录被删除或无法读取，移除其中所有记录"""
+        record = self.dirs.pop(directory, None)
+        if record is None:
+            return
+        for path in record[1]:
+            self.files.pop(path, None)
+        for path in record[2]:
+            self.forget_dir(path)
+
+    def poll(self):
+        """返回上次轮询以来新增或修改的图片路径"""
+        changed = []
+        if time.monotonic() - self.last_full_scan >= self.full_scan_interval:
+            self.scan_dir(self.folder, changed, full=True)
+            self.last_full_scan = time.monotonic()
+            return changed
+
+        for directory in list(self.dirs):
+            record = self.dirs.get(directory)
+            if record is None:
+                continue
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except OSError:
+                self.forget_dir(directory)
+                continue
+            if mtime_ns != record[0]:
+                self.scan_dir(directory, changed, full=False)
+
+        if self.stat_files:
+            self.check_files(changed)
+        return changed
+
+    def check_files(self, changed):
+        """stat 已知的图片，把原地覆盖写入的图片加入 changed"""
+        for path, signature in list(self.files.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # 已被删除，所在目录的修改时间会变化，下次轮询时移除
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != signature:
+                self.files[path] = current
+                changed.append(path)
+
+    def stop(self):
+        pass
+
+
+class WatchdogWatcher(FileSystemEventHandler):
+    """使用 watchdog 接收文件系统事件（Linux 上为 inotify，Windows 上为 ReadDirectoryChangesW）"""
+
+    name = '文件系统事件'
+
+    def __init__(self, folder, accept_path):
+        self.folder = folder
+        self.accept_path = accept_path
+        self.changed = set()
+        self.changed_lock = threading.Lock()
+        self.observer = Observer()
+        self.observer.schedule(self, folder, recursive=True)
+        self.observer.start()
+
+    def accept_file(self, path):
+        """检查文件及其所在的每一级目录是否符合扫描规则"""
+        rel_path = relative_path(self.folder, path)
+        parts = rel_path.split('/')
+        for i in range(1, len(parts)):
+            if not self.accept_path('/'.join(parts[:i]), is_dir=True):
+                return False
+        return self.accept_path(rel_path)
+
+    def add_file(self, path):
+        if self.accept_file(path):
+            with self.changed_lock:
+                self.changed.add(path)
+
+    def on_any_event(self, event):
+        if event.event_type not in ('created', 'modified', 'moved', 'closed'):
+            return
+        path = getattr(event, 'dest_path', '') or event.src_path
+        if not event.is_directory:
+            self.add_file(path)
+        elif event.event_type == 'moved':
+            # 移入的目录不会为其中的文件单独产生事件
+            for root, dirs, files in os.walk(path):
+                for file in files:
+                    self.add_file(os.path.join(root, file))
+
+    def poll(self):
+        """返回上次轮询以来新增或修改的图片路径"""
+        with self.changed_lock:
+            changed, self.changed = self.changed, set()
+        return list(changed)
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
+
+
+def create_watcher(folder, accept_path, full_scan_interval=600, stat_files=True):
+    """安装了 watchdog 时使用文件系统事件，否则退回目录轮询"""
+    if Observer is not None:
+        return WatchdogWatcher(folder, accept_path)
+    return PollingWatcher(folder, accept_path, full_scan_interval, stat_files)
+
+
+class Debouncer:
+    """等待文件写入完成
+
+    文件大小和修改时间在 settle_seconds 内都没有变化时才认为写入完成，
+    避免处理还在复制中的文件。
+    """
+
+    def __init__(self, settle_seconds=2):
+        self.settle_seconds = settle_seconds
+        # 文件路径 -> (上次看到的 (大小, 修改时间), 从何时起未变化)
+        self.pending = {}
+
+    def add(self, path):
+        self.pending[path] = (None, time.monotonic())
+
+    def ready(self):
+        """返回已经写入完成的文件路径"""
+        now = time.monotonic()
+        ready = []
+        for path, (signature, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # 文件已被删除
+                del self.pending[path]
+                continue
+
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != signature:
+                self.pending[path] = (current, now)
+            elif now - since >= self.settle_seconds:
+                ready.append(path)
+                del self.pending[path]
+        return ready
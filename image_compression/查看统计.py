@@ -1,73 +1,247 @@
 import json
 import os
+import csv
+import sys
+import argparse
 
-def view_stats():
-    """快速查看 API key 使用统计"""
+from image_compressor import read_journal, apply_journal_record
+from log_store import SQLiteLogStore
+from log_summary import RATIO_BUCKETS, build_summary
+
+def load_log_data(config):
+    """读取压缩日志中的计数和汇总统计
+
+    优先读取 compression_summary.json（或 SQLite 的 meta 表），不需要读取所有压缩记录；
+    找不到时退回读取完整日志。没有任何压缩记录时返回 None。
+    """
     log_file = 'compression_log.json'
-    config_file = 'config.json'
-    
-    if not os.path.exists(log_file):
-        print("还没有压缩记录！")
-        return
-    
-    # 读取配置
-    with open(config_file, 'r', encoding='utf-8') as f:
-        config = json.load(f)
-    
-    # 读取日志
-    with open(log_file, 'r', encoding='utf-8') as f:
-        log_data = json.load(f)
-    
+    journal_file = 'compression_log.journal'
+    summary_file = 'compression_summary.json'
+
+    if config.get('log_store', 'json') == 'sqlite':
+        db_file = config.get('log_db', 'compression_log.db')
+        if not os.path.exists(db_file):
+            return None
+        log_data = SQLiteLogStore(db_file).load()
+    elif os.path.exists(summary_file):
+        with open(summary_file, 'r', encoding='utf-8') as f:
+            log_data = json.load(f)
+        # 只合并计数和汇总统计，journal 中已包含在汇总文件里的记录会被跳过
+        for record in read_journal(journal_file):
+            apply_journal_record(log_data, record, files=False)
+    else:
+        if not os.path.exists(log_file) and not os.path.exists(journal_file):
+            return None
+
+        # 读取日志
+        log_data = {'compressed_files': {}, 'key_usage': {}, 'key_details': {}}
+        if os.path.exists(log_file):
+            with open(log_file, 'r', encoding='utf-8') as f:
+                log_data.update(json.load(f))
+        if 'summary' not in log_data:
+            log_data['summary'] = build_summary(log_data['compressed_files'])
+
+        # 合并尚未写入快照的压缩记录
+        for record in read_journal(journal_file):
+            apply_journal_record(log_data, record)
+
+    if 'summary' not in log_data:
+        log_data['summary'] = build_summary(log_data['compressed_files'])
+    return log_data
+
+def key_rows(log_data, config):
+    """各 API key 的使用情况"""
     max_usage = config.get('max_compressions_per_key', 500)
-    
+    current_index = log_data.get('current_key_index', 0)
+    rows = []
+    for i, key in enumerate(config['api_keys'], 1):
+        usage = log_data.get('key_usage', {}).get(key, 0)
+        details = log_data.get('key_details', {}).get(key, {})
+        rows.append({
+            'key': i,
+            'id': f"{key[:10]}...{key[-4:]}",
+            'current': i - 1 == current_index,
+            'usage': usage,
+            'remaining': max_usage - usage,
+            'percent': round(usage / max_usage * 100, 1) if max_usage > 0 else 0,
+            'first_used': details.get('first_used'),
+            'last_used': details.get('last_used'),
+        })
+    return rows
+
+def saved_fields(original_bytes, compressed_bytes):
+    saved = original_bytes - compressed_bytes
+    return {
+        'saved_bytes': saved,
+        'saved_percent': round(saved / original_bytes * 100, 2) if original_bytes else 0,
+    }
+
+def totals(log_data):
+    """总体统计"""
+    summary = log_data['summary']
+    result = {
+        'files': summary['files'],
+        'duplicates': summary['duplicates'],
+        'api_calls': summary['api_calls'],
+        'total_compressions': log_data.get('total_compressions', 0),
+        'original_bytes': summary['original_bytes'],
+        'compressed_bytes': summary['compressed_bytes'],
+    }
+    result.update(saved_fields(summary['original_bytes'], summary['compressed_bytes']))
+    result['last_run_time'] = log_data.get('last_run_time')
+    return result
+
+def dimension_rows(log_data, by, depth=None, days=None, limit=None):
+    """按日期、目录、后端或压缩率区间分组的统计"""
+    summary = log_data['summary']
+    if by == 'ratio':
+        files = summary['files'] or 1
+        return [{'ratio': bucket, 'files': summary['ratio_buckets'].get(bucket, 0),
+                 'percent': round(summary['ratio_buckets'].get(bucket, 0) / files * 100, 1)}
+                for bucket in RATIO_BUCKETS]
+
+    groups = summary[f'by_{by}']
+    if by == 'dir' and depth:
+        # 按前 depth 级目录合并
+        merged = {}
+        for name, values in groups.items():
+            prefix = '/'.join(name.split('/')[:depth])
+            row = merged.setdefault(prefix, [0] * len(values))
+            for i, value in enumerate(values):
+                row[i] += value
+        groups = merged
+
+    rows = []
+    for name, (files, original_bytes, compressed_bytes, api_calls) in groups.items():
+        row = {by: name, 'files': files, 'api_calls': api_calls,
+               'original_bytes': original_bytes, 'compressed_bytes': compressed_bytes}
+        row.update(saved_fields(original_bytes, compressed_bytes))
+        rows.append(row)
+
+    if by == 'day':
+        rows.sort(key=lambda row: row['day'])
+        if days:
+            rows = rows[-days:]
+    else:
+        rows.sort(key=lambda row: row['saved_bytes'], reverse=True)
+    if limit:
+        rows = rows[:limit]
+    return rows
+
+def format_size(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n) < 1024 or unit == 'GB':
+            return f"{n:.1f} {unit}" if unit != 'B' else f"{n} B"
+        n /= 1024
+
+def print_keys(rows):
     print("\n" + "="*60)
     print("API Keys 使用统计")
     print("="*60 + "\n")
-    
-    for i, key in enumerate(config['api_keys'], 1):
-        usage = log_data.get('key_usage', {}).get(key, 0)
-        remaining = max_usage - usage
-        percentage = (usage / max_usage) * 100 if max_usage > 0 else 0
-        
+
+    for row in rows:
         # 进度条
         bar_length = 30
-        filled = int(bar_length * usage / max_usage) if max_usage > 0 else 0
+        filled = min(bar_length, int(bar_length * row['percent'] / 100))
         bar = '#' * filled + '-' * (bar_length - filled)
-        
+
         # 当前使用标记
-        current_index = log_data.get('current_key_index', 0)
-        current_marker = " <- 当前使用" if i - 1 == current_index else ""
-        
-        print(f"Key {i}{current_marker}")
-        print(f"  标识: {key[:10]}...{key[-4:]}")
-        print(f"  已使用: {usage} 次")
-        print(f"  剩余: {remaining} 次")
-        print(f"  进度: [{bar}] {percentage:.1f}%")
-        
+        current_marker = " <- 当前使用" if row['current'] else ""
+
+        print(f"Key {row['key']}{current_marker}")
+        print(f"  标识: {row['id']}")
+        print(f"  已使用: {row['usage']} 次")
+        print(f"  剩余: {row['remaining']} 次")
+        print(f"  进度: [{bar}] {row['percent']:.1f}%")
+
         # 详细信息
-        if key in log_data.get('key_details', {}):
-            details = log_data['key_details'][key]
-            if details.get('first_used'):
-                first_used = details['first_used'][:19].replace('T', ' ')
-                print(f"  首次使用: {first_used}")
-            if details.get('last_used'):
-                last_used = details['last_used'][:19].replace('T', ' ')
-                print(f"  最后使用: {last_used}")
-        
+        if row['first_used']:
+            print(f"  首次使用: {row['first_used'][:19].replace('T', ' ')}")
+        if row['last_used']:
+            print(f"  最后使用: {row['last_used'][:19].replace('T', ' ')}")
+
         print()
-    
+
+def print_totals(result):
     print("="*60)
-    print(f"历史总压缩次数: {log_data.get('total_compressions', 0)}")
-    
-    if log_data.get('last_run_time'):
-        last_run = log_data['last_run_time'][:19].replace('T', ' ')
+    print(f"历史总压缩次数: {result['total_compressions']}")
+
+    if result['last_run_time']:
+        last_run = result['last_run_time'][:19].replace('T', ' ')
         print(f"上次运行时间: {last_run}")
-    
-    # 显示已压缩文件数
-    compressed_count = len(log_data.get('compressed_files', {}))
-    print(f"已压缩文件数: {compressed_count}")
+
+    print(f"已压缩文件数: {result['files']}")
+    print(f"复用已有结果: {result['duplicates']}")
+    print(f"API 调用次数: {result['api_calls']}")
+    print(f"原始总大小: {format_size(result['original_bytes'])}")
+    print(f"压缩后总大小: {format_size(result['compressed_bytes'])}")
+    print(f"共节省: {format_size(result['saved_bytes'])}（{result['saved_percent']:.2f}%）")
     print("="*60)
 
+def print_table(rows):
+    """对齐输出分组统计表"""
+    if not rows:
+        print("没有数据")
+        return
+    headers = list(rows[0])
+    cells = [[format_size(row[h]) if h.endswith('_bytes') else str(row[h]) for h in headers]
+             for row in rows]
+    widths = [max(len(h), *(len(cell[i]) for cell in cells)) for i, h in enumerate(headers)]
+    print("  ".join(h.ljust(w) for h, w in zip(headers, widths)))
+    print("  ".join('-' * w for w in widths))
+    for cell in cells:
+        # 第一列是名称，左对齐，其余数字右对齐
+        print("  ".join(c.ljust(w) if i == 0 else c.rjust(w)
+                        for i, (c, w) in enumerate(zip(cell, widths))))
+
+def view_stats(args=None):
+    """查看 API key 使用统计和压缩汇总报表"""
+    parser = argparse.ArgumentParser(description="查看压缩统计")
+    parser.add_argument('--by', choices=['keys', 'day', 'dir', 'backend', 'ratio'], default=None,
+                        help="按 API key、日期、目录、压缩后端或压缩率区间分组")
+    parser.add_argument('--format', choices=['table', 'json', 'csv'], default='table',
+                        help="输出格式（默认 table）")
+    parser.add_argument('--depth', type=int, default=None, help="--by dir 时按前 N 级目录合并")
+    parser.add_argument('--days', type=int, default=None, help="--by day 时只显示最近 N 天")
+    parser.add_argument('--limit', type=int, default=None, help="最多显示多少行")
+    args = parser.parse_args(args)
+
+    config_file = 'config.json'
+
+    # 读取配置
+    with open(config_file, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    log_data = load_log_data(config)
+    if log_data is None:
+        print("还没有压缩记录！")
+        return
+
+    if args.by == 'keys':
+        rows = key_rows(log_data, config)
+    elif args.by:
+        rows = dimension_rows(log_data, args.by, args.depth, args.days, args.limit)
+    else:
+        rows = None
+
+    if args.format == 'json':
+        report = {'totals': totals(log_data), 'keys': key_rows(log_data, config)}
+        if args.by and args.by != 'keys':
+            report[f'by_{args.by}'] = rows
+        json.dump(report, sys.stdout, indent=4, ensure_ascii=False)
+        print()
+    elif args.format == 'csv':
+        if rows is None:
+            rows = dimension_rows(log_data, 'day', days=args.days, limit=args.limit)
+        if rows:
+            writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    elif rows is not None:
+        print_table(rows)
+    else:
+        print_keys(key_rows(log_data, config))
+        print_totals(totals(log_data))
+
 if __name__ == '__main__':
     view_stats()
-